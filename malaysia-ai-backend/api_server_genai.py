@@ -5,45 +5,433 @@ using the unified Google Gen AI SDK for better compatibility.
 Optimized for Render cloud deployment.
 """
 
+import asyncio
+import atexit
+import contextvars
+import heapq
+import hashlib
+import hmac
+import itertools
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
 import json
 import requests
 import base64
 import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, asdict
+from functools import lru_cache
 from typing import Optional, List, Dict
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Request, BackgroundTasks
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from pydantic import BaseModel, ValidationError
 import tempfile
 from google.oauth2 import service_account
 from enum import Enum
-from PIL import Image
+from PIL import Image, ImageOps, features
 import io
+import zlib
+import csv
+import math
+import bisect
+
+# flock-based cross-process slots are only available on Unix hosts
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging - records are handed to a queue unformatted and written by a background
+# thread, so request handlers never format messages or block on stdout. LOG_FORMAT=json
+# emits one JSON object per line; every line carries the request ID.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text or json
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records beyond this are dropped and counted
+# Fraction of requests per path whose INFO/DEBUG lines are kept; warnings and errors always are
+LOG_SAMPLE_RATES = json.loads(os.getenv("LOG_SAMPLE_RATES", "{}"))  # e.g. {"/chat": 0.1, "default": 1.0}
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# (request_id, path, sampled) for the request being handled; inherited by tasks and to_thread
+log_context = contextvars.ContextVar("log_context", default=None)
+
+class RequestLogFilter(logging.Filter):
+    """Tags records with the request ID and path; drops INFO and below for unsampled requests"""
+
+    def __init__(self):
+        super().__init__()
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        if context is None:
+            record.request_id = record.request_path = None
+            return True
+        record.request_id, record.request_path, sampled = context
+        if not sampled and record.levelno < logging.WARNING:
+            self.sampled_out += 1
+            return False
+        return True
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """Queues records as they are; the listener thread formats and writes them"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock handler formats here, on the caller's thread; the queue never leaves the process
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class TextLogFormatter(logging.Formatter):
+    """basicConfig's LEVEL:logger:message line plus structured fields and the request ID"""
+
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suffix = ""
+        if getattr(record, "fields", None):
+            suffix += " " + json.dumps(record.fields, ensure_ascii=False, default=str)
+        if getattr(record, "request_id", None):
+            suffix += f" [{record.request_id}]"
+        # Keep the suffix on the first line when a traceback follows
+        first, newline, rest = line.partition("\n")
+        return first + suffix + newline + rest
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; `extra={"fields": {...}}` are merged in as top-level keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+            entry["path"] = record.request_path
+        if getattr(record, "fields", None):
+            entry.update(record.fields)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging():
+    """Root logging through the request filter and, with LOG_ASYNC, a background queue listener"""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+    request_filter = RequestLogFilter()
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if not LOG_ASYNC:
+        stream_handler.addFilter(request_filter)
+        root.addHandler(stream_handler)
+        return request_filter, None, None
+
+    queue_handler = BackgroundLogHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(request_filter)
+    root.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    # Flush whatever is still queued when the worker exits
+    atexit.register(listener.stop)
+    return request_filter, queue_handler, listener
+
+request_log_filter, log_queue_handler, log_listener = configure_logging()
 logger = logging.getLogger("api_server_genai")
 
+def logging_stats() -> dict:
+    return {
+        "format": LOG_FORMAT,
+        "async": LOG_ASYNC,
+        "queued": log_queue_handler.queue.qsize() if log_queue_handler else 0,
+        "dropped": log_queue_handler.dropped if log_queue_handler else 0,
+        "sampled_out": request_log_filter.sampled_out,
+        "sample_rates": LOG_SAMPLE_RATES,
+    }
+
+class RequestContextMiddleware:
+    """Gives each HTTP request an ID (the client's X-Request-ID or a new one), echoes it in the
+    response and decides once whether the request's INFO logs are sampled"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        if not request_id or not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex[:16]
+        path = scope["path"]
+        rate = LOG_SAMPLE_RATES.get(path, LOG_SAMPLE_RATES.get("default", 1.0))
+        token = log_context.set((request_id, path, rate >= 1 or random.random() < rate))
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", ())) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            log_context.reset(token)
+
+# Tracing - one trace per HTTP request with a span per pipeline stage (image checks,
+# prompt build, model queue/open/stream, directives, Unsplash). A W3C traceparent from
+# the client continues its trace. Finished traces are kept in an in-memory ring (the
+# slowest are served at /debug/traces) and optionally appended to a JSON lines file.
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # Client traces flagged as sampled are always kept
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))  # Recent traces kept in memory
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")  # JSON lines file; empty keeps traces in memory only
+TRACE_EXPORT_MAX_BYTES = 50 * 1024 * 1024  # Rotated to <path>.1 beyond this
+TRACE_IGNORED_PATHS = ("/health", "/metrics", "/debug/", "/admin/")
+_TRACEPARENT_PATTERN = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+def _new_span_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float  # time.monotonic()
+    end: Optional[float] = None
+    attributes: Optional[dict] = None
+    error: Optional[str] = None
+
+class Trace:
+    """Spans of one request; added from the event loop and worker threads (list.append is atomic)"""
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], name: str, attributes: dict):
+        self.trace_id = trace_id
+        self.started_at = time.time()
+        self.root = Span(name, _new_span_id(), parent_id, time.monotonic(), attributes=attributes)
+        self.spans: List[Span] = [self.root]
+
+    @property
+    def duration(self) -> float:
+        return (self.root.end or time.monotonic()) - self.root.start
+
+    def add(self, name: str, parent_id: str, start: float, end: Optional[float] = None,
+            attributes: Optional[dict] = None) -> Span:
+        span = Span(name, _new_span_id(), parent_id, start, end, attributes or {})
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> dict:
+        origin = self.root.start
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.root.span_id,
+            "parent_id": self.root.parent_id,  # The client's span, from traceparent
+            "name": self.root.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 2),
+            "attributes": self.root.attributes,
+            "spans": [{
+                "name": span.name,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "offset_ms": round((span.start - origin) * 1000, 2),
+                "duration_ms": round((span.end - span.start) * 1000, 2) if span.end is not None else None,
+                "attributes": span.attributes,
+                "error": span.error,
+            } for span in sorted(self.spans[1:], key=lambda span: span.start)],
+        }
+
+# (trace, current span ID) for the request being handled; inherited by tasks and to_thread
+trace_context = contextvars.ContextVar("trace_context", default=None)
+
+@contextmanager
+def trace_span(name: str, **attributes):
+    """Time a block as a child of the current span; yields None outside a traced request"""
+    context = trace_context.get()
+    if context is None:
+        yield None
+        return
+    trace, parent_id = context
+    span = trace.add(name, parent_id, time.monotonic(), attributes=attributes)
+    token = trace_context.set((trace, span.span_id))
+    try:
+        yield span
+    except BaseException as e:
+        span.error = type(e).__name__
+        raise
+    finally:
+        span.end = time.monotonic()
+        trace_context.reset(token)
+
+def record_span(name: str, start: Optional[float], end: Optional[float], **attributes) -> None:
+    """Add a finished child span from time.monotonic() timestamps taken earlier"""
+    context = trace_context.get()
+    if context is not None and start is not None and end is not None:
+        trace, parent_id = context
+        trace.add(name, parent_id, start, end, attributes)
+
+class TraceExporter:
+    """Ring buffer of finished traces, appended to TRACE_EXPORT_PATH by a background thread"""
+
+    def __init__(self, capacity: int, export_path: str):
+        self.export_path = export_path
+        self._recent = deque(maxlen=capacity)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export") if export_path else None
+        self.finished = 0
+        self.exported = 0
+        self.export_errors = 0
+
+    def export(self, trace: Trace) -> None:
+        self._recent.append(trace)
+        self.finished += 1
+        if self._executor is not None:
+            self._executor.submit(self._write, trace)
+
+    def _write(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + "\n"
+        try:
+            if os.path.exists(self.export_path) and os.path.getsize(self.export_path) > TRACE_EXPORT_MAX_BYTES:
+                os.replace(self.export_path, self.export_path + ".1")
+            with open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.exported += 1
+        except OSError as e:
+            self.export_errors += 1
+            logger.warning(f"⚠️ Could not export trace to {self.export_path}: {e}")
+
+    def slowest(self, limit: int, route: Optional[str] = None) -> list:
+        traces = [trace for trace in self._recent.copy() if route is None or trace.root.attributes.get("route") == route]
+        return [trace.to_dict() for trace in heapq.nlargest(limit, traces, key=lambda trace: trace.duration)]
+
+    def find(self, trace_id: str) -> list:
+        """Every kept request in a trace (a client may reuse one trace across retries)"""
+        return [trace.to_dict() for trace in self._recent.copy() if trace.trace_id == trace_id]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": TRACING_ENABLED,
+            "sample_rate": TRACE_SAMPLE_RATE,
+            "buffered": len(self._recent),
+            "finished": self.finished,
+            "export_path": self.export_path or None,
+            "exported": self.exported,
+            "export_errors": self.export_errors,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+trace_exporter = TraceExporter(TRACE_BUFFER_SIZE, TRACE_EXPORT_PATH)
+
+class TracingMiddleware:
+    """Opens a trace per HTTP request, continuing the client's traceparent, and exports it when the
+    request is done. The root span ends with the response body; background tasks show up after it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED or scope["path"].startswith(TRACE_IGNORED_PATHS):
+            return await self.app(scope, receive, send)
+        trace_id = parent_id = None
+        sampled = False
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                match = _TRACEPARENT_PATTERN.match(value.decode("latin-1").strip().lower())
+                if match:
+                    trace_id, parent_id, flags = match.groups()
+                    sampled = bool(int(flags, 16) & 1)
+                break
+        if not sampled and random.random() >= TRACE_SAMPLE_RATE:
+            return await self.app(scope, receive, send)
+
+        context = log_context.get()
+        trace = Trace(trace_id or f"{random.getrandbits(128):032x}", parent_id, f"{scope['method']} {scope['path']}",
+                      {"method": scope["method"], "path": scope["path"], "request_id": context[0] if context else None})
+        token = trace_context.set((trace, trace.root.span_id))
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.root.attributes["status"] = message["status"]
+                message["headers"] = list(message.get("headers", ())) + [(b"x-trace-id", trace.trace_id.encode("latin-1"))]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                trace.root.end = time.monotonic()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            trace_context.reset(token)
+            if trace.root.end is None:
+                trace.root.end = time.monotonic()
+            route = scope.get("route")
+            trace.root.attributes["route"] = route.path if route is not None else "unmatched"
+            if route is not None:
+                trace.root.name = f"{scope['method']} {route.path}"
+            trace_exporter.export(trace)
+
+# NumPy is only needed for the optional semantic response cache
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Import Google Gen AI SDK
 try:
     from google import genai
-    from google.genai import types
+    from google.genai import errors, types
+    import httpx  # Transport used by the Gen AI SDK
     logger.info("✅ Google Gen AI SDK imported successfully")
 except ImportError as e:
     logger.error(f"❌ Failed to import Google Gen AI SDK: {e}")
     raise
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize the backend before the first request and release its resources on shutdown"""
+    await startup_event()
+    yield
+    await shutdown_event()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="🇲🇾 Malaysia Tourism AI Backend",
     description="Advanced AI Chat Backend using Google Gen AI SDK with fine-tuned Gemini model",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware - Allow all origins for cloud deployment
@@ -55,6 +443,253 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Metrics - Prometheus text format at /metrics. Recording is a deque append (atomic
+# in CPython, no lock); observations are folded into totals when scraped.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PREFIX = "aiman_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_FOLD_THRESHOLD = 4096  # Pending observations before the recording thread folds them itself
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", " ").replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    """Label set in exposition format; extra is one more (name, value) pair, e.g. a bucket's le"""
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names + extra[:1], values + extra[1:])]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    """Base for pushed metrics: observations queue up lock-free and are folded under a lock"""
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.label_names = label_names
+        self._pending = deque()
+        self._fold_lock = threading.Lock()
+
+    def _push(self, labels: dict, value: float) -> None:
+        if not METRICS_ENABLED:
+            return
+        self._pending.append((tuple(labels.get(name, "") for name in self.label_names), value))
+        # Keep the backlog bounded without ever blocking the hot path on the lock
+        if len(self._pending) > METRICS_FOLD_THRESHOLD and self._fold_lock.acquire(blocking=False):
+            try:
+                self._fold()
+            finally:
+                self._fold_lock.release()
+
+    def _fold(self) -> None:
+        pending = self._pending
+        while True:
+            try:
+                labels, value = pending.popleft()
+            except IndexError:
+                return
+            self._apply(labels, value)
+
+    def render(self) -> List[str]:
+        with self._fold_lock:
+            self._fold()
+            return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._lines()
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        self._push(labels, amount)
+
+    def _apply(self, labels: tuple, value: float) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + value
+
+    def _lines(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, labels)} {value:g}" for labels, value in self._values.items()]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+        self._counts: Dict[tuple, List[int]] = {}
+        self._sums: Dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        self._push(labels, value)
+
+    def _apply(self, labels: tuple, value: float) -> None:
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def _lines(self) -> List[str]:
+        lines = []
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {self._sums[labels]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter read from existing state at scrape time, so it costs nothing per request.
+
+    The callback returns a number, or a dict of label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, help_text: str, kind: str, label_names: tuple, callback):
+        self.name = METRICS_PREFIX + name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self._callback = callback
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self._callback()
+        except Exception as e:
+            logger.warning(f"⚠️ Metric {self.name} failed: {e}")
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {float(value):g}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str = "gauge", label_names: tuple = ()):
+        """Decorator registering a scrape-time metric"""
+        def register(fn):
+            self._register(CallbackMetric(name, help_text, kind, label_names, fn))
+            return fn
+        return register
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds", "Time from request to the end of the response body", ("method", "route", "status"))
+model_ttft_seconds = metrics.histogram(
+    "model_ttft_seconds", "Time from request to the first model chunk, queueing included", ("route", "endpoint"))
+model_generation_seconds = metrics.histogram(
+    "model_generation_seconds", "Total model call time", ("route", "endpoint", "outcome"))
+model_queue_seconds = metrics.histogram("model_queue_wait_seconds", "Wait for a model slot", ("route",))
+model_tokens = metrics.counter("model_tokens_total", "Tokens reported by the model", ("route", "type"))
+image_preprocess_seconds = metrics.histogram("image_preprocess_seconds", "Image validation, resizing and thumbnailing", ("stage",))
+unsplash_request_seconds = metrics.histogram("unsplash_request_seconds", "Unsplash HTTP calls, to response headers", ("kind", "status"))
+
+class MetricsMiddleware:
+    """Times each HTTP request to the end of its response body, labelled by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_seconds.observe(time.perf_counter() - started, method=scope["method"],
+                                         route=route.path if route is not None else "unmatched", status=status)
+
+class UploadSizeLimitMiddleware:
+    """Caps multipart upload bodies per route while they arrive.
+
+    A Content-Length over the cap is refused before any of the body is read. Bodies
+    without one (chunked) are counted as they are received: once the cap is passed
+    the client gets 413 straight away and the app sees a disconnect, so the form
+    parser never spools more than the cap.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route_limit = UPLOAD_ROUTE_LIMITS.get(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        headers = dict(scope["headers"]) if route_limit else {}
+        if not route_limit or not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            return await self.app(scope, receive, send)
+        limit, detail = route_limit
+        
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            logger.warning(f"🚫 Rejected upload to {scope['path']}: {int(content_length)} bytes")
+            return await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+        
+        received = 0
+        rejected = False
+        response_started = False
+        
+        async def limited_receive():
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    rejected = True
+                    logger.warning(f"🚫 Cut off upload to {scope['path']} after {received} bytes")
+                    if not response_started:
+                        await JSONResponse(status_code=413, content={"detail": detail})(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def guarded_send(message):
+            nonlocal response_started
+            if rejected:
+                return  # The 413 has already been sent
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            # The app gives up on the body we cut off (ClientDisconnect or a parse error)
+            if not rejected:
+                raise
+
+app.add_middleware(UploadSizeLimitMiddleware)  # Inside the metrics middleware so its 413s are counted
+app.add_middleware(MetricsMiddleware)
+
 # Conversation phases for Aiman persona
 class ConversationPhase(str, Enum):
     GREETING = "greeting"
@@ -66,7 +701,7 @@ class ConversationPhase(str, Enum):
 class ChatRequest(BaseModel):
     message: str
     temperature: Optional[float] = 0.7
-    max_tokens: Optional[int] = 8192
+    max_tokens: Optional[int] = None  # None lets the output budget policy pick by phase
     conversation_history: Optional[list] = []
     user_session_id: Optional[str] = None
 
@@ -79,6 +714,7 @@ class ChatResponse(BaseModel):
     search_image_queries: Optional[List[str]] = []
     action_items: Optional[List[Dict[str, str]]] = []
     image_id: Optional[str] = None
+    thumbnail_url: Optional[str] = None  # Backend-relative path to a small cached preview
 
 class ImageResult(BaseModel):
     url: str
@@ -89,6 +725,8 @@ class ImageResult(BaseModel):
     photographer_name: Optional[str] = None
     photographer_url: Optional[str] = None
     download_url: Optional[str] = None  # For triggering downloads as required by Unsplash
+    thumbnail_url: Optional[str] = None  # Backend-relative path to a small cached preview
+    proxy_url: Optional[str] = None  # Backend-relative path to the cached full image (IMAGE_PROXY_ENABLED)
 
 class ImageSearchRequest(BaseModel):
     query: str
@@ -110,7 +748,7 @@ class ChatWithImageRequest(BaseModel):
     image_data: Optional[str] = None  # Base64 encoded image
     image_id: Optional[str] = None
     temperature: Optional[float] = 0.7
-    max_tokens: Optional[int] = 8192
+    max_tokens: Optional[int] = None  # None lets the output budget policy pick by phase
     conversation_history: Optional[list] = []
     user_session_id: Optional[str] = None
 
@@ -191,6 +829,150 @@ Guide users through natural conversation phases:
 - Provide direct, helpful responses to user questions
 """
 
+# Prebuilt request templates - built once at import and never mutated.
+# Per-request configs are shallow copies, so the persona and safety settings are shared.
+IMAGE_CONTEXT_NOTE = "IMPORTANT: The user has uploaded an image. Use it as context for your travel recommendations."
+
+AIMAN_SYSTEM_INSTRUCTION = types.Content(parts=[types.Part.from_text(text=AIMAN_SYSTEM_PROMPT)])
+AIMAN_IMAGE_SYSTEM_INSTRUCTION = types.Content(parts=[
+    types.Part.from_text(text=AIMAN_SYSTEM_PROMPT),
+    types.Part.from_text(text=IMAGE_CONTEXT_NOTE)
+])
+
+SAFETY_SETTINGS = [
+    types.SafetySetting(category=category, threshold="OFF")
+    for category in (
+        "HARM_CATEGORY_HATE_SPEECH",
+        "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "HARM_CATEGORY_HARASSMENT",
+    )
+]
+
+CHAT_CONFIG_TEMPLATE = types.GenerateContentConfig(
+    system_instruction=AIMAN_SYSTEM_INSTRUCTION,
+    top_p=0.95,
+    safety_settings=SAFETY_SETTINGS,
+)
+IMAGE_CHAT_CONFIG_TEMPLATE = CHAT_CONFIG_TEMPLATE.model_copy(update={"system_instruction": AIMAN_IMAGE_SYSTEM_INSTRUCTION})
+# /chat-stream sends the bare message without the persona
+STREAM_CONFIG_TEMPLATE = CHAT_CONFIG_TEMPLATE.model_copy(update={"system_instruction": None})
+IMAGE_ANALYSIS_CONFIG = types.GenerateContentConfig(
+    system_instruction=AIMAN_SYSTEM_INSTRUCTION,
+    temperature=0.4,  # Optimized for your model
+    max_output_tokens=1500,  # More tokens for detailed analysis
+    top_p=0.9,
+    top_k=40,
+)
+
+def build_generation_config(template: types.GenerateContentConfig, temperature: float, max_tokens: int,
+                            stop_sequences: Optional[List[str]] = None) -> types.GenerateContentConfig:
+    """Derive a per-request config from a template without rebuilding shared parts"""
+    update = {"temperature": temperature, "max_output_tokens": max_tokens}
+    if stop_sequences:
+        update["stop_sequences"] = list(stop_sequences)
+    return template.model_copy(update=update)
+
+# History window - filled newest-first up to a token budget instead of a fixed message count
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+PINNED_HISTORY_PREFIXES = ("[Image uploaded:",)  # Turns the Streamlit client marks as image uploads
+
+_WORD_PATTERN = re.compile(r"\w+")
+_SYMBOL_PATTERN = re.compile(r"[^\w\s]")
+# Scripts written without spaces between words (CJK, kana, Hangul, Thai) or that tokenise
+# close to a token per character (Tamil): a \w+ run there is a whole sentence, not a word
+_PER_CHARACTER_SCRIPT_PATTERN = re.compile(
+    "[\u0B80-\u0BFF\u0E00-\u0E7F\u3040-\u30FF\u3400-\u4DBF\u4E00-\u9FFF\uAC00-\uD7AF\uF900-\uFAFF]")
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """Approximate Gemini token count locally.
+
+    One token per word plus one per extra 6 characters of long words, one per
+    punctuation mark or emoji, and one per character of Chinese, Japanese, Korean,
+    Thai or Tamil text. Memoised because history messages are re-sent and
+    re-counted on every turn.
+    """
+    per_character = len(_PER_CHARACTER_SCRIPT_PATTERN.findall(text))
+    if per_character:
+        text = _PER_CHARACTER_SCRIPT_PATTERN.sub(" ", text)
+    words = _WORD_PATTERN.findall(text)
+    long_word_extra = sum((len(word) - 1) // 6 for word in words if len(word) > 6)
+    return per_character + len(words) + long_word_extra + len(_SYMBOL_PATTERN.findall(text))
+
+def approx_content_tokens(contents: List[types.Content]) -> int:
+    """Estimated tokens for Gen AI contents; images count as Gemini's fixed 258 tokens"""
+    return sum(
+        estimate_tokens(part.text) if part.text else 258
+        for content in contents for part in (content.parts or [])
+    )
+
+def _history_message_text(msg: dict) -> str:
+    content = msg.get('content', '')
+    
+    # Handle content that might be a dict (from enhanced responses)
+    if isinstance(content, dict):
+        content = content.get('response', str(content))
+    elif not isinstance(content, str):
+        content = str(content)
+    return content.strip()
+
+def _is_pinned(msg: dict, text: str) -> bool:
+    return bool(msg.get('pinned')) or text.startswith(PINNED_HISTORY_PREFIXES)
+
+def append_turn(contents: List[types.Content], role: str, parts: List[types.Part]) -> None:
+    """Append a turn, folding it into the previous content when the role repeats.
+
+    Gemini expects user and model turns to alternate; dropping turns for the budget
+    (or keeping a pinned one) can otherwise leave two user contents side by side.
+    """
+    if contents and contents[-1].role == role:
+        contents[-1].parts = list(contents[-1].parts or []) + list(parts)
+    else:
+        contents.append(types.Content(role=role, parts=list(parts)))
+
+def history_to_contents(conversation_history: list, token_budget: int = None) -> List[types.Content]:
+    """Convert client chat history into Gen AI contents that fit the token budget.
+
+    Pinned turns (uploaded-image turns, or messages sent with "pinned": true) are
+    always kept; the remaining budget is filled from the newest message backwards.
+    """
+    if token_budget is None:
+        token_budget = HISTORY_TOKEN_BUDGET
+    
+    messages = []
+    for msg in conversation_history:
+        text = _history_message_text(msg)
+        if text:
+            messages.append((msg, text, estimate_tokens(text)))
+    
+    keep = [False] * len(messages)
+    remaining = token_budget
+    for i, (msg, text, tokens) in enumerate(messages):
+        if _is_pinned(msg, text):
+            keep[i] = True
+            remaining -= tokens
+    
+    for i in range(len(messages) - 1, -1, -1):
+        if keep[i]:
+            continue
+        tokens = messages[i][2]
+        if tokens > remaining:
+            break
+        keep[i] = True
+        remaining -= tokens
+    
+    contents = []
+    for (msg, text, _), kept in zip(messages, keep):
+        if not kept:
+            continue
+        # Map role names correctly for Gemini API
+        role = msg.get('role', 'user')
+        if role == 'assistant':
+            role = 'model'
+        append_turn(contents, role, [types.Part.from_text(text=text)])
+    return contents
+
 def determine_conversation_phase(conversation_history: list, current_message: str) -> ConversationPhase:
     """Determine the current conversation phase based on history and message content"""
     
@@ -222,6 +1004,298 @@ def determine_conversation_phase(conversation_history: list, current_message: st
     # Default to ideation phase (making recommendations)
     return ConversationPhase.IDEATION
 
+# Output budgets - max_output_tokens and stop sequences by phase and intent
+# Gemini 2.5 counts thinking tokens against max_output_tokens, so these leave headroom.
+ADAPTIVE_OUTPUT_BUDGETS_ENABLED = os.getenv("ADAPTIVE_OUTPUT_BUDGETS_ENABLED", "true").lower() == "true"
+DEFAULT_MAX_OUTPUT_TOKENS = 8192
+PHASE_OUTPUT_TOKENS = {
+    ConversationPhase.GREETING: int(os.getenv("OUTPUT_TOKENS_GREETING", "2048")),
+    ConversationPhase.SCOPING: int(os.getenv("OUTPUT_TOKENS_SCOPING", "2048")),
+    ConversationPhase.IDEATION: int(os.getenv("OUTPUT_TOKENS_IDEATION", "6144")),
+    ConversationPhase.CONSOLIDATION: int(os.getenv("OUTPUT_TOKENS_CONSOLIDATION", "8192")),
+}
+# Itineraries are long whatever the phase
+ITINERARY_INTENT_PATTERN = re.compile(r"\b(itinerary|day[- ]by[- ]day|\d+\s*-?\s*(days?|nights?|d\d+n)|full plan|schedule)\b", re.IGNORECASE)
+ITINERARY_OUTPUT_TOKENS = DEFAULT_MAX_OUTPUT_TOKENS
+# Stop if the model starts writing the traveller's next turn itself
+CHAT_STOP_SEQUENCES = ("\nUser:", "\nTraveller:")
+OUTPUT_LENGTH_WINDOW = 500  # Recent replies kept per phase for the length percentiles
+
+@dataclass(frozen=True)
+class OutputBudget:
+    max_output_tokens: int
+    stop_sequences: tuple
+    source: str  # "request", "intent", "phase" or "default"
+
+def resolve_output_budget(phase: ConversationPhase, message: str, requested_max_tokens: Optional[int]) -> OutputBudget:
+    """Pick the output cap for a request; an explicit max_tokens from the client always wins"""
+    if requested_max_tokens:
+        return OutputBudget(requested_max_tokens, CHAT_STOP_SEQUENCES, "request")
+    if not ADAPTIVE_OUTPUT_BUDGETS_ENABLED:
+        return OutputBudget(DEFAULT_MAX_OUTPUT_TOKENS, CHAT_STOP_SEQUENCES, "default")
+    if ITINERARY_INTENT_PATTERN.search(message):
+        return OutputBudget(ITINERARY_OUTPUT_TOKENS, CHAT_STOP_SEQUENCES, "intent")
+    return OutputBudget(PHASE_OUTPUT_TOKENS[phase], CHAT_STOP_SEQUENCES, "phase")
+
+def generation_output(chunks: list) -> tuple[int, bool]:
+    """(output tokens incl. thinking, stopped at max tokens) for a finished stream of chunks"""
+    output_tokens = 0
+    truncated = False
+    for chunk in reversed(chunks):
+        usage = chunk.usage_metadata
+        if usage is not None and usage.candidates_token_count:
+            output_tokens = usage.candidates_token_count + (usage.thoughts_token_count or 0)
+            break
+    if not output_tokens:
+        output_tokens = sum(estimate_tokens(chunk.text) for chunk in chunks if chunk.text)
+    if chunks and chunks[-1].candidates:
+        truncated = chunks[-1].candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+    return output_tokens, truncated
+
+class OutputLengthStats:
+    """Observed reply lengths per phase, logged and reported on /health to tune PHASE_OUTPUT_TOKENS"""
+
+    def __init__(self, window: int):
+        self._lock = threading.Lock()
+        self._lengths = {phase: deque(maxlen=window) for phase in ConversationPhase}
+        self._truncated = {phase: 0 for phase in ConversationPhase}
+
+    def record(self, phase: ConversationPhase, output_tokens: int, budget: OutputBudget, truncated: bool) -> None:
+        # Client-capped replies would skew the lengths the phase budgets are tuned from
+        if budget.source != "request":
+            with self._lock:
+                self._lengths[phase].append(output_tokens)
+                if truncated:
+                    self._truncated[phase] += 1
+        logger.info(f"📏 Output [{phase.value}]: {output_tokens} of {budget.max_output_tokens} tokens "
+                    f"({budget.source} budget){' - truncated' if truncated else ''}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            result = {}
+            for phase, lengths in self._lengths.items():
+                ordered = sorted(lengths)
+                result[phase.value] = {
+                    "budget": PHASE_OUTPUT_TOKENS[phase],
+                    "replies": len(ordered),
+                    "p50": ordered[len(ordered) // 2] if ordered else 0,
+                    "p95": ordered[int(len(ordered) * 0.95)] if ordered else 0,
+                    "max": ordered[-1] if ordered else 0,
+                    "truncated": self._truncated[phase],
+                }
+            return result
+
+output_lengths = OutputLengthStats(OUTPUT_LENGTH_WINDOW)
+
+# Usage accounting - tokens, latency and cost per model call, by phase, route and session
+USAGE_PRICE_INPUT_PER_MILLION = float(os.getenv("USAGE_PRICE_INPUT_PER_MILLION", "0.30"))  # USD, Gemini 2.5 Flash list price
+USAGE_PRICE_CACHED_INPUT_PER_MILLION = float(os.getenv("USAGE_PRICE_CACHED_INPUT_PER_MILLION", "0.075"))
+USAGE_PRICE_OUTPUT_PER_MILLION = float(os.getenv("USAGE_PRICE_OUTPUT_PER_MILLION", "2.50"))  # Thinking tokens bill as output
+USAGE_BUCKET_SECONDS = 60
+USAGE_WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+USAGE_LATENCY_SAMPLES = 5000
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", "1000"))
+
+def last_usage(chunks: list):
+    """Usage metadata of the last chunk that carries it (the stream's running total)"""
+    for chunk in reversed(chunks):
+        if chunk.usage_metadata is not None:
+            return chunk.usage_metadata
+    return None
+
+@dataclass
+class UsageRecord:
+    """Tokens and timings of one upstream model call"""
+    route: str
+    phase: Optional[str]
+    session_id: Optional[str]
+    endpoint: Optional[str]
+    outcome: str  # ok, error or cancelled
+    prompt_tokens: int
+    cached_tokens: int
+    output_tokens: int  # Candidates only
+    thoughts_tokens: int
+    queue_seconds: float
+    ttft_seconds: Optional[float]
+    total_seconds: float
+    estimated: bool  # No usage metadata came back; output tokens estimated from the text
+
+    @property
+    def cost_usd(self) -> float:
+        uncached = max(0, self.prompt_tokens - self.cached_tokens)
+        return (uncached * USAGE_PRICE_INPUT_PER_MILLION
+                + self.cached_tokens * USAGE_PRICE_CACHED_INPUT_PER_MILLION
+                + (self.output_tokens + self.thoughts_tokens) * USAGE_PRICE_OUTPUT_PER_MILLION) / 1_000_000
+
+def usage_record(route: str, chunks: list, started: float, *, phase: Optional[str] = None,
+                 session_id: Optional[str] = None, endpoint: Optional[str] = None, outcome: str = "ok",
+                 admitted_at: Optional[float] = None, first_chunk_at: Optional[float] = None) -> UsageRecord:
+    """UsageRecord for a call started at `started` (time.monotonic()) that produced `chunks`"""
+    usage = last_usage(chunks)
+    output_tokens = usage.candidates_token_count if usage is not None else None
+    estimated = output_tokens is None
+    if estimated:
+        output_tokens = sum(estimate_tokens(chunk.text) for chunk in chunks if chunk.text)
+    return UsageRecord(
+        route=route,
+        phase=phase,
+        session_id=session_id,
+        endpoint=endpoint,
+        outcome=outcome,
+        prompt_tokens=(usage.prompt_token_count or 0) if usage is not None else 0,
+        cached_tokens=(usage.cached_content_token_count or 0) if usage is not None else 0,
+        output_tokens=output_tokens or 0,
+        thoughts_tokens=(usage.thoughts_token_count or 0) if usage is not None else 0,
+        queue_seconds=(admitted_at - started) if admitted_at is not None else 0.0,
+        ttft_seconds=(first_chunk_at - started) if first_chunk_at is not None else None,
+        total_seconds=time.monotonic() - started,
+        estimated=estimated
+    )
+
+@dataclass
+class UsageTotals:
+    calls: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    thoughts_tokens: int = 0
+    cost_usd: float = 0.0
+    total_seconds: float = 0.0
+
+    def add(self, record: UsageRecord) -> None:
+        self.calls += 1
+        self.errors += record.outcome == "error"
+        self.prompt_tokens += record.prompt_tokens
+        self.cached_tokens += record.cached_tokens
+        self.output_tokens += record.output_tokens
+        self.thoughts_tokens += record.thoughts_tokens
+        self.cost_usd += record.cost_usd
+        self.total_seconds += record.total_seconds
+
+    def merge(self, other: "UsageTotals") -> None:
+        for name, value in asdict(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def to_dict(self) -> dict:
+        result = asdict(self)
+        result["cost_usd"] = round(self.cost_usd, 6)
+        result["total_seconds"] = round(self.total_seconds, 2)
+        return result
+
+def _percentile(ordered: list, fraction: float):
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 3) if ordered else None
+
+class UsageAccounting:
+    """Rolling usage totals for the last hour in one-minute buckets, plus lifetime totals per session.
+
+    Each bucket keeps totals overall and per phase, route and endpoint; a window
+    summary merges the buckets it covers. Latency percentiles come from a
+    bounded sample of recent calls.
+    """
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[int, Dict[str, UsageTotals]]" = OrderedDict()
+        self._latencies = deque(maxlen=USAGE_LATENCY_SAMPLES)  # (timestamp, ttft, total)
+        self._sessions: "OrderedDict[str, UsageTotals]" = OrderedDict()
+
+    def record(self, record: UsageRecord) -> None:
+        now = time.time()
+        minute = int(now // USAGE_BUCKET_SECONDS)
+        keys = ["all", f"route:{record.route}", f"endpoint:{record.endpoint}"]
+        if record.phase:
+            keys.append(f"phase:{record.phase}")
+        with self._lock:
+            bucket = self._buckets.get(minute)
+            if bucket is None:
+                bucket = self._buckets[minute] = {}
+                oldest = minute - max(USAGE_WINDOWS.values()) // USAGE_BUCKET_SECONDS
+                while next(iter(self._buckets)) <= oldest:
+                    self._buckets.popitem(last=False)
+            for key in keys:
+                bucket.setdefault(key, UsageTotals()).add(record)
+            if record.outcome == "ok":
+                self._latencies.append((now, record.ttft_seconds, record.total_seconds))
+            if record.session_id:
+                totals = self._sessions.get(record.session_id)
+                if totals is None:
+                    totals = self._sessions[record.session_id] = UsageTotals()
+                totals.add(record)
+                self._sessions.move_to_end(record.session_id)
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+        
+        endpoint = record.endpoint.rsplit("/", 1)[-1] if record.endpoint else ""
+        if record.ttft_seconds is not None:
+            model_ttft_seconds.observe(record.ttft_seconds, route=record.route, endpoint=endpoint)
+        model_generation_seconds.observe(record.total_seconds, route=record.route, endpoint=endpoint, outcome=record.outcome)
+        model_queue_seconds.observe(record.queue_seconds, route=record.route)
+        for kind in ("prompt", "cached", "output", "thoughts"):
+            count = getattr(record, f"{kind}_tokens")
+            if count:
+                model_tokens.inc(count, route=record.route, type=kind)
+        
+        # One JSON object per call, for log-based cost attribution
+        fields = asdict(record)
+        fields["session_id"] = record.session_id[:8] if record.session_id else None
+        fields["cost_usd"] = round(record.cost_usd, 6)
+        for name in ("queue_seconds", "ttft_seconds", "total_seconds"):
+            if fields[name] is not None:
+                fields[name] = round(fields[name], 3)
+        logger.info("💰 Usage", extra={"fields": fields})
+
+    def window(self, seconds: int) -> dict:
+        """Totals overall and by phase, route and endpoint, with latency percentiles, for the last `seconds`"""
+        since = time.time() - seconds
+        first_minute = int(since // USAGE_BUCKET_SECONDS)
+        merged: Dict[str, UsageTotals] = {}
+        with self._lock:
+            for minute, bucket in self._buckets.items():
+                if minute < first_minute:
+                    continue
+                for key, totals in bucket.items():
+                    merged.setdefault(key, UsageTotals()).merge(totals)
+            samples = [(ttft, total) for at, ttft, total in self._latencies if at >= since]
+        
+        grouped = {"route": {}, "phase": {}, "endpoint": {}}
+        for key, totals in merged.items():
+            kind, _, name = key.partition(":")
+            if kind in grouped:
+                grouped[kind][name] = totals.to_dict()
+        ttfts = sorted(ttft for ttft, _ in samples if ttft is not None)
+        totals_s = sorted(total for _, total in samples)
+        return {
+            "seconds": seconds,
+            "totals": merged.get("all", UsageTotals()).to_dict(),
+            "by_route": grouped["route"],
+            "by_phase": grouped["phase"],
+            "by_endpoint": grouped["endpoint"],
+            "latency_seconds": {
+                "ttft_p50": _percentile(ttfts, 0.5),
+                "ttft_p95": _percentile(ttfts, 0.95),
+                "total_p50": _percentile(totals_s, 0.5),
+                "total_p95": _percentile(totals_s, 0.95),
+            },
+        }
+
+    def session(self, session_id: str) -> Optional[dict]:
+        with self._lock:
+            totals = self._sessions.get(session_id)
+            return totals.to_dict() if totals else None
+
+    def top_sessions(self, limit: int = 10) -> list:
+        with self._lock:
+            ranked = heapq.nlargest(limit, self._sessions.items(), key=lambda item: item[1].cost_usd)
+        return [dict(session=session_id[:8], **totals.to_dict()) for session_id, totals in ranked]
+
+    def stats(self) -> dict:
+        hour = self.window(USAGE_WINDOWS["1h"])
+        return {"last_hour": hour["totals"], "latency_seconds": hour["latency_seconds"]}
+
+usage_accounting = UsageAccounting(USAGE_MAX_SESSIONS)
+
 def process_response_directives(response_text: str) -> dict:
     """Process response text to identify SEARCH_IMAGE and ACTION directives"""
     import re
@@ -241,6 +1315,43 @@ def process_response_directives(response_text: str) -> dict:
         'action_items': [{'type': match[0].strip(), 'name': match[1].strip()} for match in action_matches]
     }
 
+# Shared Unsplash HTTP client - one connection pool and one concurrency limit for
+# searches, download tracking and image proxy fetches
+UNSPLASH_MAX_CONCURRENCY = int(os.getenv("UNSPLASH_MAX_CONCURRENCY", "4"))
+unsplash_semaphore = threading.BoundedSemaphore(UNSPLASH_MAX_CONCURRENCY)
+unsplash_session = requests.Session()
+unsplash_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=UNSPLASH_MAX_CONCURRENCY))
+
+def _unsplash_send(url: str, **kwargs) -> requests.Response:
+    """GET through the shared Unsplash session, timed to the response headers; the caller holds a slot"""
+    kind = "search" if "/search/" in url else ("download" if url.endswith("/download") or "/download?" in url else "image")
+    with trace_span(f"unsplash.{kind}") as span:
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = unsplash_session.get(url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            unsplash_request_seconds.observe(time.perf_counter() - started, kind=kind, status=status)
+            if span is not None:
+                span.attributes["status"] = status
+
+def unsplash_get(url: str, **kwargs) -> requests.Response:
+    """GET bounded by the shared concurrency limit; the body is read before the slot is released"""
+    with unsplash_semaphore:
+        return _unsplash_send(url, **kwargs)
+
+@contextmanager
+def unsplash_stream(url: str, **kwargs):
+    """Streaming GET that keeps its concurrency slot until the caller has finished with the body"""
+    with unsplash_semaphore:
+        response = _unsplash_send(url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
 def image_retrieval_tool(query: str, max_results: int = 5) -> List[ImageResult]:
     """
     Optimized image retrieval function for Malaysia tourism content
@@ -265,7 +1376,7 @@ def image_retrieval_tool(query: str, max_results: int = 5) -> List[ImageResult]:
         }
         
         # Reduced timeout for faster response
-        response = requests.get(url, headers=headers, params=params, timeout=5)
+        response = unsplash_get(url, headers=headers, params=params, timeout=5)
         
         if response.status_code == 200:
             data = response.json()
@@ -285,13 +1396,14 @@ def image_retrieval_tool(query: str, max_results: int = 5) -> List[ImageResult]:
                     source="Unsplash",
                     photographer_name=photographer_name,
                     photographer_url=photographer_url,
-                    download_url=item.get("links", {}).get("download_location")
+                    download_url=item.get("links", {}).get("download_location"),
+                    **remote_image_urls(item["urls"]["regular"])
                 ))
             
-            logger.info(f"🖼️ Retrieved {len(images)} images for query: {query}")
+            logger.info("🖼️ Retrieved %d images for query: %s", len(images), query)
             return images
         else:
-            logger.error(f"Unsplash API error: {response.status_code}")
+            logger.error("Unsplash API error: %s", response.status_code)
             return get_fallback_images(query)
             
     except Exception as e:
@@ -311,7 +1423,7 @@ def enhance_malaysia_query(query: str) -> str:
     if not any(keyword in query for keyword in tourism_keywords):
         query = f"{query} tourism"
     
-    logger.info(f"🔍 Enhanced query: '{query}'")
+    logger.debug("🔍 Enhanced query: '%s'", query)
     return query
 
 def get_fallback_images(query: str) -> List[ImageResult]:
@@ -352,39 +1464,196 @@ def get_fallback_images(query: str) -> List[ImageResult]:
             url=url,
             title=f"Malaysia Tourism - {query}",
             description="Beautiful destination in Malaysia",
-            source="Curated Collection"
+            source="Curated Collection",
+            **remote_image_urls(url)
         ))
     
     logger.info(f"🖼️ Using {len(images)} fallback images for: {query}")
     return images
 
+# Upload limits - request bodies are capped as they arrive (UploadSizeLimitMiddleware)
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 10MB
+UPLOAD_FORM_OVERHEAD_BYTES = 1024 * 1024  # Room for multipart framing, form fields and history
+MAX_UPLOAD_REQUEST_BYTES = MAX_IMAGE_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+UPLOAD_CHUNK_SIZE = 64 * 1024
+IMAGE_HEADER_PROBE_LIMIT = 512 * 1024  # Give up looking for dimensions after this many bytes
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "40000000"))  # ~40 megapixels
+MAX_IMAGE_DIMENSION = 1920
+
+# Let Pillow's own decompression bomb guard use the same limit
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+ALLOWED_IMAGE_TYPES = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp'}
+# Batch analysis limits
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "8"))
+MAX_BATCH_REQUEST_BYTES = MAX_BATCH_IMAGES * MAX_IMAGE_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+BATCH_ANALYSIS_CONCURRENCY = int(os.getenv("BATCH_ANALYSIS_CONCURRENCY", "3"))
+
+# Body ceiling and 413 message per multipart upload route
+_SINGLE_UPLOAD_TOO_LARGE = "Upload too large. Each image must be smaller than 10MB."
+UPLOAD_ROUTE_LIMITS = {
+    "/upload-image": (MAX_UPLOAD_REQUEST_BYTES, _SINGLE_UPLOAD_TOO_LARGE),
+    "/chat-with-image": (MAX_UPLOAD_REQUEST_BYTES, _SINGLE_UPLOAD_TOO_LARGE),
+    "/upload-images": (MAX_BATCH_REQUEST_BYTES,
+                       f"Batch upload too large. Send at most {MAX_BATCH_IMAGES} images of up to 10MB each "
+                       f"({MAX_BATCH_REQUEST_BYTES // (1024 * 1024)}MB in total)."),
+}
+
+def sniff_image_mime_type(head: bytes) -> Optional[str]:
+    """Detect the real image type from its magic bytes"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if len(head) >= 12 and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def _probe_webp_size(head: bytes) -> Optional[tuple[int, int]]:
+    """Read WebP canvas size from the first chunk header (Pillow needs the full file for WebP)"""
+    if len(head) < 30:
+        return None
+    chunk = head[12:16]
+    if chunk == b'VP8X':
+        width = int.from_bytes(head[24:27], 'little') + 1
+        height = int.from_bytes(head[27:30], 'little') + 1
+        return width, height
+    if chunk == b'VP8L':
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8 ':
+        width = int.from_bytes(head[26:28], 'little') & 0x3FFF
+        height = int.from_bytes(head[28:30], 'little') & 0x3FFF
+        return width, height
+    return None
+
+def probe_image_dimensions(head: bytes, mime_type: str) -> Optional[tuple[int, int]]:
+    """Read pixel dimensions from the image header without decoding pixel data.
+
+    Returns None when more bytes are needed to reach the size field.
+    """
+    if mime_type == 'image/webp':
+        return _probe_webp_size(head)
+    try:
+        # Image.open only parses the header; pixel data is decoded lazily
+        with Image.open(io.BytesIO(head)) as img:
+            return img.size
+    except Image.DecompressionBombError:
+        raise HTTPException(
+            status_code=413,
+            detail="Image dimensions are too large to process. Please upload a smaller image."
+        )
+    except Exception:
+        return None
+
+def check_image_dimensions(width: int, height: int) -> None:
+    """Reject decompression bombs before any pixel data is decoded"""
+    if width <= 0 or height <= 0:
+        raise HTTPException(status_code=400, detail="Invalid image dimensions.")
+    if width * height > MAX_IMAGE_PIXELS:
+        megapixels = width * height / 1_000_000
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image resolution too high ({width}x{height}, {megapixels:.0f}MP). Please upload an image under {MAX_IMAGE_PIXELS // 1_000_000}MP."
+        )
+
 def validate_image_file(file: UploadFile) -> tuple[bool, str]:
     """Validate uploaded image file and return status with specific error message"""
     
     # Check file type first
-    allowed_types = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp'}
-    if file.content_type not in allowed_types:
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
         return False, f"Unsupported file type '{file.content_type}'. Please upload a JPEG, PNG, or WebP image."
     
     # Check file size (max 10MB)
-    max_size = 10 * 1024 * 1024  # 10MB
-    if hasattr(file, 'size') and file.size > max_size:
+    if getattr(file, 'size', None) and file.size > MAX_IMAGE_BYTES:
         size_mb = file.size / (1024 * 1024)
         return False, f"Image too large ({size_mb:.1f}MB). Please upload an image smaller than 10MB."
     
     return True, "Valid image file"
 
-def process_uploaded_image(file: UploadFile) -> tuple[str, str, str]:
+async def read_image_upload(file: UploadFile) -> tuple[bytes, str]:
+    """Read an uploaded image in chunks, rejecting it as soon as it breaks a limit.
+
+    The request body as a whole is capped while it is received, by
+    UploadSizeLimitMiddleware; this applies the per-image cap to the spooled
+    file. The format is taken from the magic bytes rather than the client's
+    content-type, and dimensions are checked from the header before anything is
+    decoded. Returns raw bytes and mime type.
+    """
+    buffer = bytearray()
+    mime_type = None
+    dimensions = None
+    
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer += chunk
+        
+        if len(buffer) > MAX_IMAGE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail="Image too large. Please upload an image smaller than 10MB."
+            )
+        
+        if mime_type is None and len(buffer) >= 12:
+            mime_type = sniff_image_mime_type(bytes(buffer[:12]))
+            if mime_type is None:
+                raise HTTPException(
+                    status_code=415,
+                    detail="File content is not a supported image. Please upload a JPEG, PNG, or WebP image."
+                )
+        
+        if mime_type and dimensions is None and len(buffer) <= IMAGE_HEADER_PROBE_LIMIT:
+            dimensions = probe_image_dimensions(bytes(buffer), mime_type)
+            if dimensions:
+                check_image_dimensions(*dimensions)
+    
+    if dimensions is not None:
+        return bytes(buffer), mime_type
+    
+    # Small files or late headers: fall back to checking the complete body
+    image_data = bytes(buffer)
+    return image_data, inspect_image_bytes(image_data)
+
+def inspect_image_bytes(image_data: bytes) -> str:
+    """Apply the upload checks to an image already in memory and return its real mime type"""
+    started = time.perf_counter()
+    try:
+        with trace_span("image.inspect", bytes=len(image_data)):
+            return _inspect_image_bytes(image_data)
+    finally:
+        image_preprocess_seconds.observe(time.perf_counter() - started, stage="inspect")
+
+def _inspect_image_bytes(image_data: bytes) -> str:
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Uploaded image is empty.")
+    if len(image_data) > MAX_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail="Image too large. Please upload an image smaller than 10MB."
+        )
+    
+    mime_type = sniff_image_mime_type(image_data[:12])
+    if mime_type is None:
+        raise HTTPException(
+            status_code=415,
+            detail="File content is not a supported image. Please upload a JPEG, PNG, or WebP image."
+        )
+    
+    dimensions = probe_image_dimensions(image_data[:IMAGE_HEADER_PROBE_LIMIT], mime_type)
+    if dimensions is None:
+        raise HTTPException(status_code=400, detail="Could not read image header. The file may be corrupted.")
+    check_image_dimensions(*dimensions)
+    
+    return mime_type
+
+def process_uploaded_image(image_data: bytes, mime_type: str) -> tuple[str, str, str]:
     """Process uploaded image and return base64 data, image_id, and mime_type"""
     
     # Generate unique image ID
     image_id = str(uuid.uuid4())
-    
-    # Get original mime type
-    mime_type = file.content_type or 'image/jpeg'
-    
-    # Read and process image
-    image_data = file.file.read()
+    started = time.perf_counter()
     
     # Optional: Resize large images to reduce processing time
     try:
@@ -392,10 +1661,14 @@ def process_uploaded_image(file: UploadFile) -> tuple[str, str, str]:
         original_format = img.format
         
         # Resize if too large (max 1920px width)
-        if img.width > 1920:
-            ratio = 1920 / img.width
+        if img.width > MAX_IMAGE_DIMENSION:
+            ratio = MAX_IMAGE_DIMENSION / img.width
             new_height = int(img.height * ratio)
-            img = img.resize((1920, new_height), Image.Resampling.LANCZOS)
+            
+            # Let the JPEG decoder downscale via DCT so we never hold the full-size bitmap
+            if original_format == 'JPEG':
+                img.draft('RGB', (MAX_IMAGE_DIMENSION, new_height))
+            img = img.resize((MAX_IMAGE_DIMENSION, new_height), Image.Resampling.LANCZOS)
             
             # Convert back to bytes with original format
             img_bytes = io.BytesIO()
@@ -417,52 +1690,452 @@ def process_uploaded_image(file: UploadFile) -> tuple[str, str, str]:
     
     # Convert to base64
     base64_data = base64.b64encode(image_data).decode('utf-8')
+    image_preprocess_seconds.observe(time.perf_counter() - started, stage="resize")
     
     logger.info(f"📸 Processed image: {image_id}, format: {mime_type}, size: {len(image_data)} bytes")
     return base64_data, image_id, mime_type
 
-def analyze_image_with_gemini(image_data: str, mime_type: str = "image/jpeg", user_message: str = "") -> dict:
-    """Analyze uploaded image using ONLY your fine-tuned Gemini 2.5 Flash model"""
-    
+# Thumbnail derivatives - content-addressed files shared by every worker on the host
+THUMBNAIL_CACHE_DIR = os.getenv("THUMBNAIL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aiman-thumbnails"))
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "600"))  # UI renders at 250-300px, so 2x for HiDPI
+THUMBNAIL_QUALITY = 75
+THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMBNAIL_MIME_TYPE = "image/webp" if THUMBNAIL_FORMAT == "WEBP" else "image/jpeg"
+THUMBNAIL_CACHE_CONTROL = "public, max-age=31536000, immutable"
+THUMBNAIL_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+THUMBNAIL_DISK_MAX_BYTES = int(os.getenv("THUMBNAIL_DISK_MAX_BYTES", str(256 * 1024 * 1024)))
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Write via a temp file and rename so concurrent readers never see partial files"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
     try:
-        # Initialize client with your credentials - ONLY use fine-tuned model
-        client = genai.Client(
-            vertexai=True,
-            project=project_id,
-            location=location,
-            credentials=credentials
-        )
-        
-        # Use ONLY your fine-tuned model endpoint
-        model = model_endpoint
-        logger.info(f"🎯 Using fine-tuned Gemini 2.5 Flash model for image analysis: {model}")
-        
-        # Create specialized prompt for your fine-tuned model
-        analysis_prompt = f"""
-{AIMAN_SYSTEM_PROMPT}
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
-The user has uploaded an image and asked: "{user_message if user_message else 'Please analyze this image'}"
+class ThumbnailDirectory:
+    """Size-bounded LRU over the thumbnail directory: thumbnails (<key>.thumb) and
+    remote image source records (<key>.url). Files written by other workers on the
+    host are picked up when first looked for.
+    """
 
-As Aiman, your Malaysian travel concierge, please:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self.evictions = 0
 
-1. **Analyze the image carefully** - Describe what you see in detail
-2. **Identify Malaysian connections** - If it's food, landmarks, or cultural elements, relate them to Malaysia
-3. **Provide travel recommendations** - Based on what you see, suggest similar experiences in Malaysia
-4. **Use [SEARCH_IMAGE: "query"] directives** - For each recommendation, add a search directive
-5. **Use [ACTION: Type, Name] directives** - For bookable items like hotels or activities
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
 
-If you see:
-- **Food**: Identify the dish and recommend similar Malaysian cuisine or restaurants
-- **Landmarks/Buildings**: Relate to Malaysian architecture or tourist spots
-- **Nature/Scenery**: Suggest similar landscapes or outdoor activities in Malaysia
-- **Cultural elements**: Connect to Malaysian traditions, festivals, or experiences
+    def _load_index(self) -> None:
+        """Rebuild the LRU order from file access times (once per process)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith((".thumb", ".url")):
+                stat = os.stat(self._path(name))
+                entries.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._bytes += size
 
-Remember to be accurate and honest - if you're unsure about details, say so. Focus on being helpful for Malaysia travel planning.
-"""
-        
-        # Create content with image for your fine-tuned model
-        try:
-            # Create image part using the blob constructor
+    def _account(self, name: str, size: int) -> None:
+        self._bytes -= self._files.pop(name, 0)
+        self._files[name] = size
+        self._bytes += size
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def contains(self, name: str) -> bool:
+        """Whether the file exists, marking it recently used"""
+        with self._lock:
+            self._load_index()
+            if name in self._files:
+                self._files.move_to_end(name)
+                return True
+        try:
+            size = os.path.getsize(self._path(name))
+        except OSError:
+            return False
+        with self._lock:
+            self._account(name, size)
+            self._evict()
+        return True
+
+    def read(self, name: str) -> Optional[bytes]:
+        if not self.contains(name):
+            return None
+        try:
+            with open(self._path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._bytes -= self._files.pop(name, 0)
+            return None
+
+    def write(self, name: str, data: bytes) -> None:
+        _write_atomic(self._path(name), data)
+        with self._lock:
+            self._load_index()
+            self._account(name, len(data))
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self._files), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "evictions": self.evictions}
+
+thumbnail_files = ThumbnailDirectory(THUMBNAIL_CACHE_DIR, THUMBNAIL_DISK_MAX_BYTES)
+
+def make_thumbnail(image_data: bytes) -> bytes:
+    """Downscale an image to a small WebP (or JPEG) preview"""
+    started = time.perf_counter()
+    try:
+        with trace_span("image.thumbnail"):
+            return _make_thumbnail(image_data)
+    finally:
+        image_preprocess_seconds.observe(time.perf_counter() - started, stage="thumbnail")
+
+def _make_thumbnail(image_data: bytes) -> bytes:
+    with Image.open(io.BytesIO(image_data)) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE), Image.Resampling.LANCZOS)
+        
+        if img.mode not in ('RGB', 'RGBA') or (THUMBNAIL_FORMAT == "JPEG" and img.mode == 'RGBA'):
+            img = img.convert('RGB')
+        
+        output = io.BytesIO()
+        img.save(output, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+        return output.getvalue()
+
+def store_thumbnail(image_data: bytes) -> str:
+    """Create (once) the thumbnail for uploaded image bytes and return its URL path"""
+    key = hashlib.sha256(image_data).hexdigest()[:32]
+    if not thumbnail_files.contains(f"{key}.thumb"):
+        thumbnail_files.write(f"{key}.thumb", make_thumbnail(image_data))
+    return f"/thumbnails/{key}"
+
+def register_remote_image(url: str) -> Optional[str]:
+    """Record a remote image URL under a hash key so the backend can fetch it on demand.
+
+    Only registered keys can be served, so the thumbnail and proxy routes can't be
+    used to fetch arbitrary URLs.
+    """
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+    try:
+        if not thumbnail_files.contains(f"{key}.url"):
+            thumbnail_files.write(f"{key}.url", url.encode('utf-8'))
+    except OSError as e:
+        logger.warning(f"Could not register remote image source: {e}")
+        return None
+    return key
+
+def registered_image_url(key: str) -> Optional[str]:
+    """Look up the source URL recorded for a remote image key"""
+    source = thumbnail_files.read(f"{key}.url")
+    return source.decode('utf-8') if source is not None else None
+
+def remote_image_urls(url: str) -> dict:
+    """Thumbnail and (when enabled) proxy paths for a retrieved image"""
+    key = register_remote_image(url)
+    if key is None:
+        return {}
+    urls = {"thumbnail_url": f"/thumbnails/{key}"}
+    if IMAGE_PROXY_ENABLED:
+        urls["proxy_url"] = f"/img/{key}"
+    return urls
+
+def fetch_remote_image(url: str) -> bytes:
+    """Download a remote image with the same size cap as uploads"""
+    with unsplash_stream(url, timeout=10) as response:
+        response.raise_for_status()
+        buffer = bytearray()
+        for chunk in response.iter_content(UPLOAD_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > MAX_IMAGE_BYTES:
+                raise ValueError(f"Remote image exceeds {MAX_IMAGE_BYTES} bytes")
+        return bytes(buffer)
+
+def load_remote_image(key: str) -> Optional[bytes]:
+    """Source bytes for a registered remote image, via the proxy cache when it is enabled"""
+    if IMAGE_PROXY_ENABLED:
+        return image_proxy_cache.get_or_fetch(key)
+    url = registered_image_url(key)
+    if url is None:
+        return None
+    image_data = fetch_remote_image(url)
+    inspect_image_bytes(image_data)
+    return image_data
+
+def thumbnail_exists(key: str) -> bool:
+    """A thumbnail is on disk, or can be generated from a registered remote image"""
+    return thumbnail_files.contains(f"{key}.thumb") or thumbnail_files.contains(f"{key}.url")
+
+def load_thumbnail(key: str) -> Optional[bytes]:
+    """Return cached thumbnail bytes, generating them for registered remote images on a miss"""
+    thumbnail = thumbnail_files.read(f"{key}.thumb")
+    if thumbnail is not None:
+        return thumbnail
+    
+    image_data = load_remote_image(key)
+    if image_data is None:
+        return None
+    thumbnail = make_thumbnail(image_data)
+    thumbnail_files.write(f"{key}.thumb", thumbnail)
+    logger.info(f"🖼️ Generated thumbnail {key}: {len(image_data)} -> {len(thumbnail)} bytes")
+    return thumbnail
+
+# Opt-in image proxy - fetch each retrieved image once, then serve it locally
+IMAGE_PROXY_ENABLED = os.getenv("IMAGE_PROXY_ENABLED", "false").lower() == "true"
+IMAGE_PROXY_CACHE_DIR = os.getenv("IMAGE_PROXY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aiman-image-proxy"))
+IMAGE_PROXY_DISK_MAX_BYTES = int(os.getenv("IMAGE_PROXY_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_PROXY_MEMORY_MAX_BYTES = int(os.getenv("IMAGE_PROXY_MEMORY_MAX_BYTES", str(32 * 1024 * 1024)))
+IMAGE_PROXY_CACHE_CONTROL = "public, max-age=86400"
+
+class ImageProxyCache:
+    """Two-tier LRU cache for proxied images: a small in-memory tier for hot images
+    over a size-bounded directory on disk. Each key is fetched at most once at a time.
+    """
+
+    def __init__(self, directory: str, disk_max_bytes: int, memory_max_bytes: int):
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._lock = threading.Lock()
+        self._fetch_locks: Dict[str, threading.Lock] = {}
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._loaded = False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.img")
+
+    def _load_index(self) -> None:
+        """Rebuild the disk LRU order from file access times (once per process)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_atime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > self.memory_max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self) -> None:
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _touch(self, key: str) -> None:
+        """A memory hit is a use of the disk copy too, so hot images are evicted from disk last"""
+        self._memory.move_to_end(key)
+        if key in self._disk:
+            self._disk.move_to_end(key)
+
+    def get_from_memory(self, key: str) -> Optional[bytes]:
+        """Non-blocking lookup of the hot tier only, safe to call on the event loop"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._touch(key)
+            return data
+
+    def can_serve(self, key: str) -> bool:
+        """Cached, or registered so it can be fetched"""
+        with self._lock:
+            self._load_index()
+            if key in self._memory or key in self._disk:
+                return True
+        return registered_image_url(key) is not None
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._load_index()
+            data = self._memory.get(key)
+            if data is not None:
+                self._touch(key)
+                return data
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+        with self._lock:
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        _write_atomic(self._path(key), data)
+        with self._lock:
+            self._load_index()
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._remember(key, data)
+            self._evict_disk()
+
+    def get_or_fetch(self, key: str) -> Optional[bytes]:
+        """Return cached bytes, fetching the registered source URL on a miss"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        try:
+            with fetch_lock:
+                # Another thread may have fetched it while we waited
+                data = self.get(key)
+                if data is not None:
+                    return data
+                url = registered_image_url(key)
+                if url is None:
+                    return None
+                data = fetch_remote_image(url)
+                inspect_image_bytes(data)
+                self.put(key, data)
+                logger.info(f"🖼️ Proxied image {key}: {len(data)} bytes")
+                return data
+        finally:
+            with self._lock:
+                self._fetch_locks.pop(key, None)
+
+image_proxy_cache = ImageProxyCache(IMAGE_PROXY_CACHE_DIR, IMAGE_PROXY_DISK_MAX_BYTES, IMAGE_PROXY_MEMORY_MAX_BYTES)
+
+async def create_upload_thumbnail(image_data: bytes) -> Optional[str]:
+    """Best-effort thumbnail for an upload; never fails the request"""
+    try:
+        return await asyncio.to_thread(store_thumbnail, image_data)
+    except Exception as e:
+        logger.warning(f"Thumbnail generation failed: {e}")
+        return None
+
+async def parse_chat_with_image_request(http_request: Request) -> tuple[ChatWithImageRequest, Optional[bytes], Optional[str]]:
+    """Parse /chat-with-image from either JSON (base64 image) or multipart (raw image bytes).
+
+    Returns the request fields plus the decoded image bytes and detected mime type.
+    """
+    content_type = http_request.headers.get("content-type", "")
+    
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await http_request.form(max_files=1)
+            fields = {
+                key: form[key] for key in ("message", "image_id", "temperature", "max_tokens", "user_session_id")
+                if form.get(key) not in (None, "")
+            }
+            if form.get("conversation_history"):
+                try:
+                    fields["conversation_history"] = json.loads(form["conversation_history"])
+                except json.JSONDecodeError:
+                    raise HTTPException(status_code=400, detail="conversation_history must be a JSON array.")
+            request = ChatWithImageRequest(**fields)
+            
+            image_file = form.get("image")
+            if image_file is None or isinstance(image_file, str):
+                return request, None, None
+            image_bytes, mime_type = await read_image_upload(image_file)
+            return request, image_bytes, mime_type
+        
+        request = ChatWithImageRequest(**await http_request.json())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Request body must be JSON or multipart/form-data.")
+    
+    if not request.image_data:
+        return request, None, None
+    
+    try:
+        image_bytes = base64.b64decode(request.image_data)
+    except Exception as e:
+        logger.error(f"Error decoding base64 image: {e}")
+        return request, None, None
+    
+    # Free the base64 string now that we hold the bytes
+    request.image_data = None
+    return request, image_bytes, inspect_image_bytes(image_bytes)
+
+def analyze_image_with_gemini(image_data: str, mime_type: str = "image/jpeg", user_message: str = "") -> dict:
+    """Analyze uploaded image using ONLY your fine-tuned Gemini 2.5 Flash model"""
+    
+    try:
+        logger.info(f"🎯 Using fine-tuned Gemini 2.5 Flash model for image analysis: {model_endpoint}")
+        
+        # Create specialized prompt for your fine-tuned model
+        analysis_prompt = f"""
+The user has uploaded an image and asked: "{user_message if user_message else 'Please analyze this image'}"
+
+As Aiman, your Malaysian travel concierge, please:
+
+1. **Analyze the image carefully** - Describe what you see in detail
+2. **Identify Malaysian connections** - If it's food, landmarks, or cultural elements, relate them to Malaysia
+3. **Provide travel recommendations** - Based on what you see, suggest similar experiences in Malaysia
+4. **Use [SEARCH_IMAGE: "query"] directives** - For each recommendation, add a search directive
+5. **Use [ACTION: Type, Name] directives** - For bookable items like hotels or activities
+
+If you see:
+- **Food**: Identify the dish and recommend similar Malaysian cuisine or restaurants
+- **Landmarks/Buildings**: Relate to Malaysian architecture or tourist spots
+- **Nature/Scenery**: Suggest similar landscapes or outdoor activities in Malaysia
+- **Cultural elements**: Connect to Malaysian traditions, festivals, or experiences
+
+Remember to be accurate and honest - if you're unsure about details, say so. Focus on being helpful for Malaysia travel planning.
+"""
+        
+        # Create content with image for your fine-tuned model
+        try:
+            # Create image part using the blob constructor
             image_part = types.Part(
                 inline_data=types.Blob(
                     mime_type=mime_type,
@@ -493,50 +2166,55 @@ Remember to be accurate and honest - if you're unsure about details, say so. Foc
         # Generate response with optimized settings for your fine-tuned model
         response_text = ""
         
-        try:
-            for chunk in client.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    temperature=0.4,  # Optimized for your model
-                    max_output_tokens=1500,  # More tokens for detailed analysis
-                    top_p=0.9,
-                    top_k=40
-                )
-            ):
-                if chunk.text:
-                    response_text += chunk.text
-            
-            logger.info(f"🤖 Generated image analysis with fine-tuned model: {len(response_text)} chars")
-            
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            # Try non-streaming approach as fallback
+        # Least-loaded healthy endpoint; its latency and errors feed the pool's health scores
+        started = time.monotonic()
+        first_chunk_at = None
+        chunks = []
+        with endpoint_pool.route() as target:
+            client, model = target.client, target.name
             try:
-                response = client.models.generate_content(
+                for chunk in client.models.generate_content_stream(
                     model=model,
                     contents=contents,
-                    config=types.GenerateContentConfig(
-                        temperature=0.4,
-                        max_output_tokens=1500,
-                        top_p=0.9
+                    config=IMAGE_ANALYSIS_CONFIG
+                ):
+                    first_chunk_at = first_chunk_at or time.monotonic()
+                    chunks.append(chunk)
+                    if chunk.text:
+                        response_text += chunk.text
+            
+                logger.info(f"🤖 Generated image analysis with fine-tuned model: {len(response_text)} chars")
+            
+            except Exception as e:
+                logger.error(f"Error generating response: {e}")
+                # Try non-streaming approach as fallback
+                try:
+                    response = client.models.generate_content(
+                        model=model,
+                        contents=contents,
+                        config=IMAGE_ANALYSIS_CONFIG
                     )
-                )
-                response_text = response.text
-                logger.info(f"🤖 Generated image analysis (non-streaming): {len(response_text)} chars")
-            except Exception as final_error:
-                logger.error(f"Final attempt failed: {final_error}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Fine-tuned model is currently unavailable. Please try again later."
-                )
+                    response_text = response.text
+                    chunks = [response]
+                    logger.info(f"🤖 Generated image analysis (non-streaming): {len(response_text)} chars")
+                except Exception as final_error:
+                    logger.error(f"Final attempt failed: {final_error}")
+                    usage_accounting.record(usage_record("image-analysis", chunks, started, endpoint=model,
+                                                         outcome="error", first_chunk_at=first_chunk_at))
+                    raise HTTPException(
+                        status_code=500,
+                        detail="Fine-tuned model is currently unavailable. Please try again later."
+                    ) from final_error
+        
+        usage_accounting.record(usage_record("image-analysis", chunks, started, phase="ideation",
+                                             endpoint=target.name, first_chunk_at=first_chunk_at))
         
         # Process directives
         directives = process_response_directives(response_text)
         
         return {
             "response": response_text.strip() if response_text else "I analyzed the image but couldn't generate a response. Please try uploading the image again.",
-            "model_used": model,
+            "model_used": target.name,
             "phase": "ideation",
             "contains_images": directives.get('contains_images', False),
             "contains_actions": directives.get('contains_actions', False),
@@ -546,6 +2224,9 @@ Remember to be accurate and honest - if you're unsure about details, say so. Foc
         
     except HTTPException:
         raise
+    except CircuitOpen as e:
+        # No local stand-in for looking at a photo: fail fast
+        raise circuit_open_error(e)
     except Exception as e:
         logger.error(f"❌ Image analysis error: {e}")
         raise HTTPException(
@@ -559,6 +2240,738 @@ location = None
 model_endpoint = None
 credentials = None
 
+# Offline mode - serve requests from the local model stand-in (local_model.py)
+USE_LOCAL_MODEL = os.getenv("LOCAL_MODEL", "false").lower() == "true"
+
+_genai_clients: Dict[tuple, object] = {}
+_genai_client_lock = threading.Lock()
+
+def get_genai_client(project: Optional[str] = None, region: Optional[str] = None) -> genai.Client:
+    """Return the shared Gen AI client for a project and region (default: the configured ones)"""
+    key = (project or project_id, region or location)
+    client = _genai_clients.get(key)
+    if client is None:
+        with _genai_client_lock:
+            client = _genai_clients.get(key)
+            if client is None:
+                if USE_LOCAL_MODEL:
+                    from local_model import LocalModelClient
+                    client = LocalModelClient(*key)
+                else:
+                    client = genai.Client(
+                        vertexai=True,
+                        project=key[0],
+                        location=key[1],
+                        credentials=credentials
+                    )
+                _genai_clients[key] = client
+    return client
+
+# Endpoint pool - fine-tuned deployments across regions, routed by load and health.
+# Each endpoint has a circuit breaker: ejecting an endpoint opens its circuit.
+DEFAULT_VERTEX_AI_ENDPOINT = "projects/bright-coyote-463315-q8/locations/us-west1/endpoints/6528596580524621824"
+ENDPOINT_EJECT_AFTER_FAILURES = int(os.getenv("ENDPOINT_EJECT_AFTER_FAILURES", "3"))  # Consecutive endpoint faults
+ENDPOINT_EJECT_ERROR_RATE = 0.5  # Smoothed error rate that also ejects, once there are enough samples
+ENDPOINT_MIN_SAMPLES = 10
+ENDPOINT_EJECT_SECONDS = float(os.getenv("ENDPOINT_EJECT_SECONDS", "30"))  # Doubles on every repeat ejection
+ENDPOINT_MAX_EJECT_SECONDS = 300.0
+ENDPOINT_HALF_OPEN_PROBES = 1  # Calls let through at once to test an endpoint whose circuit has cooled down
+ENDPOINT_ERROR_PENALTY = 4.0  # Routing cost multiplier per unit of smoothed error rate
+ENDPOINT_AFFINITY_SLACK = 1.5  # Keep a session on its previous endpoint unless it costs this much more
+ENDPOINT_DEFAULT_TTFT_SECONDS = 1.0  # Assumed before any endpoint has latency samples
+_ENDPOINT_RESOURCE_PATTERN = re.compile(r"^projects/([^/]+)/locations/([^/]+)/endpoints/([^/]+)$")
+
+@dataclass
+class EndpointTarget:
+    """One fine-tuned model deployment and its observed health"""
+    name: str  # Full resource name, passed as `model` to the SDK
+    project: str
+    region: str
+    outstanding: int = 0
+    ttft_ewma: Optional[float] = None
+    error_ewma: float = 0.0
+    samples: int = 0
+    consecutive_failures: int = 0
+    ejections: int = 0
+    ejected_until: float = 0.0
+    probing: bool = False  # Ejected and no probe has succeeded since
+    requests: int = 0
+    failures: int = 0
+
+    @property
+    def client(self):
+        return get_genai_client(self.project, self.region)
+
+    def circuit(self, now: float) -> str:
+        """Breaker state: closed (serving), open (ejected) or half_open (letting probes through)"""
+        if self.ejected_until > now:
+            return "open"
+        return "half_open" if self.probing else "closed"
+
+    def cost(self, prior_ttft: float) -> float:
+        """Least-outstanding-requests, weighted by latency (prior_ttft until measured) and error rate"""
+        ttft = self.ttft_ewma if self.ttft_ewma is not None else prior_ttft
+        return (self.outstanding + 1) * ttft * (1 + ENDPOINT_ERROR_PENALTY * self.error_ewma)
+
+def parse_endpoint(spec: str) -> EndpointTarget:
+    """Endpoint target from a full resource name, or a bare endpoint ID in the default project/region"""
+    spec = spec.strip()
+    match = _ENDPOINT_RESOURCE_PATTERN.match(spec)
+    if match:
+        project, region, _ = match.groups()
+        return EndpointTarget(name=spec, project=project, region=region)
+    return EndpointTarget(name=f"projects/{project_id}/locations/{location}/endpoints/{spec}", project=project_id, region=location)
+
+class CircuitOpen(Exception):
+    """Every endpoint's circuit is open, so the model is not called at all"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"All model endpoints are unavailable (retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+
+class RoutedStream:
+    """Iterator over one endpoint's response stream that reports its outcome to the pool"""
+
+    def __init__(self, pool: "EndpointPool", target: EndpointTarget, iterator):
+        self.target = target
+        self._pool = pool
+        self._iterator = iterator
+        self._started = time.monotonic()
+        self._first = True
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._finish(None)
+            raise
+        except Exception as e:
+            self._finish(e)
+            raise
+        if self._first:
+            self._first = False
+            self._pool.record_ttft(self.target, time.monotonic() - self._started)
+        return chunk
+
+    def close(self) -> None:
+        try:
+            close = getattr(self._iterator, "close", None)
+            if close:
+                close()
+        finally:
+            self._finish(None, cancelled=True)
+
+    def _finish(self, error: Optional[Exception], cancelled: bool = False) -> None:
+        if not self._finished:
+            self._finished = True
+            self._pool.release(self.target, error, cancelled)
+
+class EndpointPool:
+    """Routes model calls across VERTEX_AI_ENDPOINTS.
+
+    Each call goes to the eligible endpoint with the lowest cost: outstanding
+    requests weighted by smoothed time-to-first-token and error rate. An
+    endpoint with repeated faults (429/5xx/timeouts) is ejected (circuit open)
+    for a while, doubling each time. A high smoothed error rate alone only ejects
+    an endpoint while another one is still serving, so the pool never ejects its
+    last endpoint on error rate. After the ejection the endpoint is half-open: the
+    next call is sent to it as a probe, and its success closes the circuit while
+    a fault reopens it. With every circuit open, calls fail fast with CircuitOpen.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.targets: List[EndpointTarget] = []
+        self._session_targets: "OrderedDict[str, str]" = OrderedDict()
+
+    def configure(self, specs: List[str]) -> None:
+        targets = [parse_endpoint(spec) for spec in specs if spec.strip()]
+        with self._lock:
+            self.targets = targets
+
+    @property
+    def primary(self) -> Optional[EndpointTarget]:
+        return self.targets[0] if self.targets else None
+
+    def _eligible(self, now: float) -> List[EndpointTarget]:
+        eligible = []
+        for t in self.targets:
+            state = t.circuit(now)
+            if state == "closed" or (state == "half_open" and t.outstanding < ENDPOINT_HALF_OPEN_PROBES):
+                eligible.append(t)
+        if not eligible:
+            # Come back when the first circuit cools down, or shortly if only probes are holding us up
+            cooling = [t.ejected_until - now for t in self.targets if t.ejected_until > now]
+            raise CircuitOpen(min(cooling) if len(cooling) == len(self.targets) else 1.0)
+        return eligible
+
+    def all_open(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return bool(self.targets) and all(t.circuit(now) == "open" for t in self.targets)
+
+    def check(self) -> None:
+        """Raise CircuitOpen now, before queueing for a model slot, if no endpoint would take a call"""
+        with self._lock:
+            self._eligible(time.monotonic())
+
+    def acquire(self, affinity: Optional[str] = None, avoid: Optional[set] = None) -> EndpointTarget:
+        """Pick an endpoint for one call and count it as outstanding until release()"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = self._eligible(now)
+            if avoid and len(candidates) > 1:
+                candidates = [t for t in candidates if t.name not in avoid] or candidates
+            # Unmeasured endpoints are assumed average, and ties go to the least sampled, so each gets probed
+            measured = [t.ttft_ewma for t in self.targets if t.ttft_ewma is not None]
+            prior = sum(measured) / len(measured) if measured else ENDPOINT_DEFAULT_TTFT_SECONDS
+            target = min(candidates, key=lambda t: (t.cost(prior), t.samples))
+            # A cooled-down endpoint would never win on cost with its error history; probe it
+            probe = next((t for t in candidates if t.circuit(now) == "half_open"), None)
+            if probe is not None:
+                target = probe
+            if affinity and probe is None:
+                previous = self._session_targets.get(affinity)
+                sticky = next((t for t in candidates if t.name == previous), None)
+                # Sessions stay put when it is cheap, so their context caches keep hitting
+                if sticky is not None and sticky.cost(prior) <= target.cost(prior) * ENDPOINT_AFFINITY_SLACK:
+                    target = sticky
+                self._session_targets[affinity] = target.name
+                self._session_targets.move_to_end(affinity)
+                while len(self._session_targets) > SESSION_CACHE_MAX_SESSIONS:
+                    self._session_targets.popitem(last=False)
+            target.outstanding += 1
+            target.requests += 1
+            return target
+
+    def stream(self, target: EndpointTarget, iterator) -> RoutedStream:
+        return RoutedStream(self, target, iterator)
+
+    def record_ttft(self, target: EndpointTarget, seconds: float) -> None:
+        with self._lock:
+            target.ttft_ewma = seconds if target.ttft_ewma is None else 0.8 * target.ttft_ewma + 0.2 * seconds
+
+    def release(self, target: EndpointTarget, error: Optional[Exception] = None, cancelled: bool = False) -> None:
+        """Finish a call; only endpoint faults count against health, not bad requests or cancellations"""
+        # Wrapped errors (e.g. an HTTPException raised from the SDK error) count by their cause
+        fault = error is not None and (is_transient_model_error(error) or
+                                       (error.__cause__ is not None and is_transient_model_error(error.__cause__)))
+        with self._lock:
+            target.outstanding -= 1
+            if cancelled or (error is not None and not fault):
+                return
+            target.samples += 1
+            target.error_ewma = 0.9 * target.error_ewma + (0.1 if fault else 0.0)
+            if not fault:
+                target.consecutive_failures = 0
+                if target.probing:
+                    # Probe succeeded: close the circuit and start the health history afresh
+                    target.probing = False
+                    target.ejections = 0
+                    target.error_ewma = 0.0
+                    target.samples = 0
+                    logger.info(f"✅ Circuit closed for endpoint {target.name}")
+                return
+            target.failures += 1
+            target.consecutive_failures += 1
+            now = time.monotonic()
+            others_serving = any(t is not target and t.circuit(now) == "closed" for t in self.targets)
+            unhealthy = (target.probing or target.consecutive_failures >= ENDPOINT_EJECT_AFTER_FAILURES
+                         or (others_serving and target.samples >= ENDPOINT_MIN_SAMPLES
+                             and target.error_ewma >= ENDPOINT_EJECT_ERROR_RATE))
+            if unhealthy and target.ejected_until <= now:
+                target.ejections += 1
+                duration = min(ENDPOINT_MAX_EJECT_SECONDS, ENDPOINT_EJECT_SECONDS * 2 ** (target.ejections - 1))
+                target.ejected_until = now + duration
+                target.probing = True
+                logger.warning(f"🚑 Circuit opened for endpoint {target.name} for {duration:.0f}s after repeated errors")
+
+    @contextmanager
+    def route(self, affinity: Optional[str] = None):
+        """Target for a non-streaming call; the outcome is recorded when the block exits"""
+        target = self.acquire(affinity)
+        started = time.monotonic()
+        try:
+            yield target
+        except Exception as e:
+            self.release(target, e)
+            raise
+        self.record_ttft(target, time.monotonic() - started)
+        self.release(target)
+
+    def client_for_resource(self, name: str):
+        """Client for the region a resource (e.g. a cached content) lives in"""
+        match = re.match(r"^projects/([^/]+)/locations/([^/]+)/", name)
+        return get_genai_client(*match.groups()) if match else get_genai_client()
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                "endpoint": t.name,
+                "region": t.region,
+                "circuit": t.circuit(now),
+                "outstanding": t.outstanding,
+                "ttft_ms": round(t.ttft_ewma * 1000) if t.ttft_ewma is not None else None,
+                "error_rate": round(t.error_ewma, 3),
+                "requests": t.requests,
+                "failures": t.failures,
+                "ejections": t.ejections,
+                "readmit_in_seconds": round(t.ejected_until - now, 1) if t.ejected_until > now else 0,
+            } for t in self.targets]
+
+endpoint_pool = EndpointPool()
+
+def circuit_open_error(error: CircuitOpen) -> HTTPException:
+    """503 with Retry-After for a request that can't be answered while every circuit is open"""
+    seconds = max(1, int(error.retry_after + 0.999))
+    return HTTPException(
+        status_code=503,
+        detail=f"Aiman's trip planner is temporarily unavailable. Please try again in {seconds}s.",
+        headers={"Retry-After": str(seconds)}
+    )
+
+# Degraded answers - served from local assets while every endpoint's circuit is open
+DEGRADED_MODE_ENABLED = os.getenv("DEGRADED_MODE_ENABLED", "true").lower() == "true"
+RESTAURANT_CSV_PATH = os.getenv("RESTAURANT_CSV_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "RestaurantOriginalCSV.csv"))
+DEGRADED_MAX_RESTAURANTS = 3
+FOOD_INTENT_PATTERN = re.compile(
+    r"\b(eat|eats|food|foodie|restaurants?|makan|hawker|breakfast|lunch|dinner|supper|cafes?|coffee|kopitiam|"
+    r"dish|dishes|cuisine|hungry|mamak)\b", re.IGNORECASE)
+DEGRADED_HIGHLIGHTS = {
+    "kuala lumpur": "the Petronas Twin Towers, Batu Caves and a night out on Jalan Alor 🌃",
+    "penang": "George Town's street art, Penang Hill and hawker dinners at Gurney Drive 🍜",
+    "langkawi": "the Sky Bridge, Cenang beach and a mangrove boat tour 🏝️",
+    "malacca": "Jonker Street night market, the Stadthuys and a river cruise 🛶",
+    "melaka": "Jonker Street night market, the Stadthuys and a river cruise 🛶",
+    "cameron highlands": "tea plantations, strawberry farms and the Mossy Forest 🍃",
+    "sabah": "climbing Mount Kinabalu and diving at Sipadan 🤿",
+    "kota kinabalu": "island hopping in Tunku Abdul Rahman Park and the Filipino Market 🌅",
+    "ipoh": "white coffee, the cave temples and Concubine Lane ☕",
+}
+
+@dataclass
+class Restaurant:
+    name: str
+    address: str
+    category: str
+    dishes: str
+    tip: str
+
+def _index_words(text: str) -> List[str]:
+    """Lowercase words with place aliases expanded and filler dropped, as for semantic embeddings"""
+    words = " ".join(PLACE_ALIASES.get(w, w) for w in _SEMANTIC_WORD_PATTERN.findall(text.lower())).split()
+    return [w for w in words if w not in SEMANTIC_STOPWORDS and len(w) > 1]
+
+class RestaurantIndex:
+    """Inverted word index over the restaurant guide CSV, built on first use.
+
+    A restaurant must match at least one word of its name, category or must-try
+    dishes; address words (the city, the neighbourhood) only add to the score.
+    Words are weighted by inverse document frequency.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._restaurants: Optional[List[Restaurant]] = None
+        self._food_postings: Dict[str, List[int]] = {}
+        self._place_postings: Dict[str, List[int]] = {}
+        self._dish_words: set = set()
+
+    def load(self) -> List[Restaurant]:
+        with self._lock:
+            if self._restaurants is not None:
+                return self._restaurants
+            restaurants = []
+            try:
+                with open(self.path, encoding="utf-8-sig", newline="") as f:
+                    reader = csv.reader(f)
+                    next(reader, None)  # The header cells contain line breaks; columns are read by position
+                    for row in reader:
+                        if len(row) < 9 or not row[1].strip():
+                            continue
+                        restaurant = Restaurant(name=row[1].strip(), address=row[3].strip(), category=row[4].strip(),
+                                                dishes=row[7].strip(), tip=row[8].strip())
+                        i = len(restaurants)
+                        restaurants.append(restaurant)
+                        for word in set(_index_words(f"{restaurant.name} {restaurant.category} {restaurant.dishes}")):
+                            self._food_postings.setdefault(word, []).append(i)
+                        for word in set(_index_words(restaurant.address)):
+                            self._place_postings.setdefault(word, []).append(i)
+                        self._dish_words.update(_index_words(restaurant.dishes))
+                logger.info(f"🍽️ Indexed {len(restaurants)} restaurants for degraded answers")
+            except OSError as e:
+                logger.warning(f"⚠️ Restaurant guide unavailable: {e}")
+            self._restaurants = restaurants
+            return restaurants
+
+    def is_food_query(self, text: str) -> bool:
+        """Food words, or a dish name that isn't also a place ("laksa" but not "penang")"""
+        if FOOD_INTENT_PATTERN.search(text):
+            return True
+        self.load()
+        return any(w in self._dish_words and w not in self._place_postings for w in _index_words(text))
+
+    def search(self, text: str, limit: int = DEGRADED_MAX_RESTAURANTS) -> List[Restaurant]:
+        restaurants = self.load()
+        if not restaurants:
+            return []
+        scores: Dict[int, float] = {}
+        words = set(_index_words(text))
+        for word in words:
+            postings = self._food_postings.get(word, ())
+            idf = math.log(len(restaurants) / (1 + len(postings)))
+            for i in postings:
+                scores[i] = scores.get(i, 0.0) + idf
+        for word in words:
+            postings = self._place_postings.get(word, ())
+            idf = math.log(len(restaurants) / (1 + len(postings)))
+            for i in postings:
+                if i in scores:
+                    scores[i] += idf
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [restaurants[i] for i, score in best if score > 0]
+
+    def stats(self) -> dict:
+        return {"loaded": self._restaurants is not None, "restaurants": len(self._restaurants or [])}
+
+restaurant_index = RestaurantIndex(RESTAURANT_CSV_PATH)
+degraded_answers: Dict[str, int] = {}  # Answers served per local source
+
+def _short_tip(tip: str, limit: int = 200) -> str:
+    if len(tip) <= limit:
+        return tip
+    cut = tip[:limit]
+    end = max(cut.rfind(". "), cut.rfind("! "))
+    return cut[:end + 1] if end > 0 else cut.rstrip() + "..."
+
+def degraded_answer(message: str, phase: ConversationPhase, temperature: float,
+                    allow_cached: bool = True) -> tuple[dict, str]:
+    """ChatResponse payload answered without the model, and which local asset it came from.
+
+    Cached answers are first-turn answers, so callers only allow them for requests
+    without history (a follow-up would get an answer that ignores the conversation).
+    """
+    # A real answer to the same (or a close) first-turn question beats anything canned
+    payload = response_cache.get(response_cache_key(message, phase, temperature, model_endpoint)) if allow_cached else None
+    if payload:
+        return payload, "cache"
+    if SEMANTIC_CACHE_ENABLED and allow_cached:
+        vector = embed_prompt(message)
+        match = semantic_cache.get(semantic_cache_scope(phase, temperature, model_endpoint, message), vector) if vector is not None else None
+        if match:
+            return match[0], "semantic-cache"
+    
+    lowered = " ".join(PLACE_ALIASES.get(w, w) for w in _SEMANTIC_WORD_PATTERN.findall(message.lower()))
+    places = [place for place in DEGRADED_HIGHLIGHTS if place in lowered]
+    restaurants = restaurant_index.search(message) if restaurant_index.is_food_query(message) else []
+    if restaurants:
+        source = "restaurant-index"
+        lines = ["Hello! 🇲🇾 My trip planner is taking a short breather, but here are some favourites from my makan guide:"]
+        for n, r in enumerate(restaurants, 1):
+            lines.append(f"{n}. **{r.name}** ({r.category}) - {r.address}")
+            if r.dishes:
+                lines.append(f"🍜 Must try: {r.dishes}")
+            if r.tip:
+                lines.append(f"💡 {_short_tip(r.tip)}")
+            dish = r.dishes.split(",")[0].strip()
+            if dish:
+                lines.append(f'[SEARCH_IMAGE: "{dish} Malaysia"]')
+            lines.append(f"[ACTION: Restaurant, {r.name}]")
+    else:
+        source = "highlights"
+        lines = ["Hello! 🇲🇾 My trip planner is taking a short breather, so I can't plan the details right now."]
+        for place in places or ["kuala lumpur", "penang"]:
+            lines.append(f"In {place.title()}, don't miss {DEGRADED_HIGHLIGHTS[place]}")
+            lines.append(f'[SEARCH_IMAGE: "{place}"]')
+    lines.append("Ask me again in a minute and I'll build you a full plan! 🙏")
+    
+    response = "\n".join(lines)
+    directives = process_response_directives(response)
+    return {
+        "response": response,
+        "model_used": "degraded-local",
+        "phase": phase.value,
+        "contains_images": directives["contains_images"],
+        "contains_actions": directives["contains_actions"],
+        "search_image_queries": directives["search_image_queries"],
+        "action_items": directives["action_items"],
+    }, source
+
+async def degraded_chat_payload(request, error: CircuitOpen, http_response: Optional[Response] = None,
+                                allow_cached: bool = True) -> dict:
+    """Local answer for a request the model can't take, or a fast 503 if degraded mode is off"""
+    if not DEGRADED_MODE_ENABLED:
+        raise circuit_open_error(error)
+    phase = determine_conversation_phase(request.conversation_history, request.message)
+    allow_cached = allow_cached and not request.conversation_history
+    payload, source = await asyncio.to_thread(degraded_answer, request.message, phase, request.temperature, allow_cached)
+    degraded_answers[source] = degraded_answers.get(source, 0) + 1
+    logger.warning(f"🩹 {error}; answered from {source}")
+    if http_response is not None:
+        http_response.headers["X-Degraded"] = source
+    return payload
+
+# Vertex context caching for the persona and long session prefixes
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() == "true"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "1800"))
+CONTEXT_CACHE_RENEW_MARGIN_SECONDS = 300  # Extend the TTL when less than this remains
+CONTEXT_CACHE_MIN_REMAINING_SECONDS = 30  # Don't hand out a handle that may expire mid-request
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))  # Vertex rejects smaller caches
+CONTEXT_CACHE_RETRY_AFTER_SECONDS = 600  # Back off after the endpoint refuses to create a cache
+SESSION_CACHE_MIN_MESSAGES = int(os.getenv("SESSION_CACHE_MIN_MESSAGES", "6"))
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "200"))
+
+def contents_digest(contents: List[types.Content]) -> str:
+    """Stable hash of conversation contents, used to check a cached prefix still matches"""
+    digest = hashlib.sha256()
+    for content in contents:
+        digest.update((content.role or "").encode() + b"\x00")
+        for part in content.parts or []:
+            if part.text is not None:
+                digest.update(part.text.encode("utf-8"))
+            elif part.inline_data is not None:
+                digest.update(part.inline_data.data or b"")
+            digest.update(b"\x01")
+        digest.update(b"\x02")
+    return digest.hexdigest()
+
+@dataclass
+class CachedPrefix:
+    """A live cached-content handle and the prompt prefix it holds"""
+    name: str
+    expire_at: float
+    instruction_digest: str
+    prefix_digest: str
+    prefix_len: int
+    hits: int = 0
+    renewing: bool = False
+
+class ContextCacheManager:
+    """Creates, renews and hands out Vertex cached-content handles.
+
+    One cache per model holds the static persona; sessions with long histories get
+    their own cache holding persona + history prefix. All create/renew calls run on
+    a background thread, so a request never waits on caching - it simply goes
+    uncached until a handle is ready, and falls back if a handle stops working.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._persona: Dict[str, CachedPrefix] = {}
+        self._sessions: "OrderedDict[str, CachedPrefix]" = OrderedDict()
+        self._pending: set = set()
+        self._failed_until: Dict[str, float] = {}
+        self._instruction_digests: Dict[int, tuple] = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-cache")
+        self.hits = 0
+        self.misses = 0
+
+    def _instruction_digest(self, system_instruction: types.Content) -> str:
+        # System instructions are prebuilt module constants, so memoise by identity
+        cached = self._instruction_digests.get(id(system_instruction))
+        if cached is None or cached[0] is not system_instruction:
+            cached = (system_instruction, contents_digest([system_instruction]))
+            self._instruction_digests[id(system_instruction)] = cached
+        return cached[1]
+
+    def _usable(self, entry: Optional[CachedPrefix], now: float) -> bool:
+        return entry is not None and entry.expire_at - now > CONTEXT_CACHE_MIN_REMAINING_SECONDS
+
+    def resolve(self, client, model: str, system_instruction: Optional[types.Content],
+                contents: List[types.Content], session_id: Optional[str] = None) -> tuple[Optional[str], List[types.Content]]:
+        """Pick a cache handle for this request.
+
+        Returns the cached-content name (or None) and the contents still to send.
+        """
+        if not CONTEXT_CACHE_ENABLED or system_instruction is None:
+            return None, contents
+        
+        now = time.time()
+        instruction_digest = self._instruction_digest(system_instruction)
+        history = contents[:-1]
+        session_key = f"{model}|{session_id}" if session_id else None
+        
+        with self._lock:
+            if session_key:
+                entry = self._sessions.get(session_key)
+                matches = (
+                    self._usable(entry, now)
+                    and entry.instruction_digest == instruction_digest
+                    and entry.prefix_len <= len(history)
+                    and contents_digest(history[:entry.prefix_len]) == entry.prefix_digest
+                )
+                if matches:
+                    entry.hits += 1
+                    self._sessions.move_to_end(session_key)
+                    self._maybe_renew(client, entry, now)
+                    # Re-cache once enough new turns have piled up after the cached prefix
+                    if len(history) - entry.prefix_len >= SESSION_CACHE_MIN_MESSAGES:
+                        self._schedule_create(client, model, session_key, system_instruction, instruction_digest, history)
+                    self.hits += 1
+                    return entry.name, contents[entry.prefix_len:]
+                # A prefix that never matched means the history window is sliding; don't
+                # keep paying for caches this session can't reuse
+                if len(history) >= SESSION_CACHE_MIN_MESSAGES and (entry is None or entry.hits > 0):
+                    self._schedule_create(client, model, session_key, system_instruction, instruction_digest, history)
+            
+            persona_key = f"{model}|{instruction_digest}"
+            entry = self._persona.get(persona_key)
+            if self._usable(entry, now):
+                self._maybe_renew(client, entry, now)
+                self.hits += 1
+                return entry.name, contents
+            self._schedule_create(client, model, persona_key, system_instruction, instruction_digest, [])
+            self.misses += 1
+            return None, contents
+
+    def _schedule_create(self, client, model, key, system_instruction, instruction_digest, prefix) -> None:
+        """Queue creation of a cache for key (caller holds the lock)"""
+        if key in self._pending or self._failed_until.get(model, 0) > time.time():
+            return
+        if approx_content_tokens([system_instruction] + list(prefix)) < CONTEXT_CACHE_MIN_TOKENS:
+            return
+        self._pending.add(key)
+        self._executor.submit(self._create, client, model, key, system_instruction, instruction_digest, list(prefix))
+
+    def _create(self, client, model, key, system_instruction, instruction_digest, prefix) -> None:
+        replaced = None
+        try:
+            cached = client.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    contents=prefix or None,
+                    ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                    display_name="aiman-session" if prefix else "aiman-persona"
+                )
+            )
+            expire_at = cached.expire_time.timestamp() if cached.expire_time else time.time() + CONTEXT_CACHE_TTL_SECONDS
+            entry = CachedPrefix(
+                name=cached.name,
+                expire_at=expire_at,
+                instruction_digest=instruction_digest,
+                prefix_digest=contents_digest(prefix),
+                prefix_len=len(prefix)
+            )
+            evicted = []
+            with self._lock:
+                if prefix:
+                    replaced = self._sessions.pop(key, None)
+                    self._sessions[key] = entry
+                    while len(self._sessions) > SESSION_CACHE_MAX_SESSIONS:
+                        evicted.append(self._sessions.popitem(last=False)[1])
+                else:
+                    replaced = self._persona.get(key)
+                    self._persona[key] = entry
+            logger.info(f"🧊 Created context cache {cached.name} ({len(prefix)} history messages)")
+            for old in ([replaced] if replaced else []) + evicted:
+                self._delete(client, old.name)
+        except Exception as e:
+            with self._lock:
+                self._failed_until[model] = time.time() + CONTEXT_CACHE_RETRY_AFTER_SECONDS
+            logger.warning(f"⚠️ Context cache unavailable for {model}, continuing uncached: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _maybe_renew(self, client, entry: CachedPrefix, now: float) -> None:
+        """Extend a handle's TTL in the background when it is close to expiry (caller holds the lock)"""
+        if entry.renewing or entry.expire_at - now > CONTEXT_CACHE_RENEW_MARGIN_SECONDS:
+            return
+        entry.renewing = True
+        self._executor.submit(self._renew, client, entry)
+
+    def _renew(self, client, entry: CachedPrefix) -> None:
+        try:
+            cached = client.caches.update(
+                name=entry.name,
+                config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s")
+            )
+            expire_at = cached.expire_time.timestamp() if cached.expire_time else time.time() + CONTEXT_CACHE_TTL_SECONDS
+            with self._lock:
+                entry.expire_at = expire_at
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to renew context cache {entry.name}: {e}")
+            # A transient failure leaves the handle in place; the next hit near expiry tries again
+            if is_cache_invalid_error(e):
+                self.invalidate(entry.name)
+        finally:
+            with self._lock:
+                entry.renewing = False
+
+    def _delete(self, client, name: str) -> None:
+        try:
+            client.caches.delete(name=name)
+        except Exception as e:
+            logger.debug(f"Context cache delete failed for {name}: {e}")
+
+    def invalidate(self, name: str) -> None:
+        """Forget a handle that the endpoint rejected (expired or deleted server-side)"""
+        with self._lock:
+            for table in (self._persona, self._sessions):
+                for key in [k for k, entry in table.items() if entry.name == name]:
+                    del table[key]
+
+    def clear(self, client_for_name) -> None:
+        """Delete every cache this process created (called on shutdown with a name -> client lookup)"""
+        with self._lock:
+            entries = list(self._persona.values()) + list(self._sessions.values())
+            self._persona.clear()
+            self._sessions.clear()
+        for entry in entries:
+            self._delete(client_for_name(entry.name), entry.name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": CONTEXT_CACHE_ENABLED,
+                "persona_caches": len(self._persona),
+                "session_caches": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+context_cache = ContextCacheManager()
+
+def is_cache_invalid_error(error: Exception) -> bool:
+    """The endpoint rejected the cached-content handle itself (expired, deleted or not usable)"""
+    if not isinstance(error, errors.ClientError):
+        return False
+    message = f"{error.message or ''} {error.status or ''}".lower()
+    return error.code == 404 or (error.code == 400 and ("cache" in message or "cached_content" in message))
+
+def generate_content_stream(client, model: str, contents: List[types.Content],
+                            config: types.GenerateContentConfig, session_id: Optional[str] = None):
+    """Stream a generation, reading the persona / session prefix from a context cache when one is ready.
+
+    If the endpoint rejects the cache handle itself before producing output, the
+    handle is dropped and the request is re-sent in full. Other errors (429, 503,
+    timeouts) are raised for the retry policy: re-sending uncached would only double
+    the load on an endpoint that is already struggling, and throw away a good cache.
+    """
+    cache_name, remaining_contents = context_cache.resolve(client, model, config.system_instruction, contents, session_id)
+    if cache_name:
+        cached_config = config.model_copy(update={"system_instruction": None, "cached_content": cache_name})
+        started = False
+        try:
+            for chunk in client.models.generate_content_stream(model=model, contents=remaining_contents, config=cached_config):
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            if started or not is_cache_invalid_error(e):
+                raise
+            logger.warning(f"⚠️ Context cache {cache_name} rejected, retrying uncached: {e}")
+            context_cache.invalidate(cache_name)
+    
+    yield from client.models.generate_content_stream(model=model, contents=contents, config=config)
+
 def setup_google_credentials():
     """Setup Google Cloud credentials for different environments"""
     global credentials
@@ -699,19 +3112,1237 @@ def setup_google_credentials():
             # Method 4: Try default credentials as last resort
             logger.warning(f"⚠️ No credential file found, trying default credentials")
             try:
-                from google.auth import default
-                credentials, _ = default(scopes=VERTEX_AI_SCOPES)
-                logger.info("🔄 Using default application credentials with proper scopes")
-                return True
+                from google.auth import default
+                credentials, _ = default(scopes=VERTEX_AI_SCOPES)
+                logger.info("🔄 Using default application credentials with proper scopes")
+                return True
+            except Exception as e:
+                logger.error(f"❌ Failed to use default credentials: {e}")
+                return False
+                
+    except Exception as e:
+        logger.error(f"❌ Failed to setup credentials: {e}")
+        return False
+
+# Rolling conversation summaries - older turns are folded into a short running
+# summary after the response is sent, so long sessions keep a bounded prompt
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() == "true"
+SUMMARY_KEEP_RECENT_MESSAGES = int(os.getenv("SUMMARY_KEEP_RECENT_MESSAGES", "6"))  # Always sent verbatim
+SUMMARY_BATCH_MESSAGES = int(os.getenv("SUMMARY_BATCH_MESSAGES", "6"))  # Summarize once this many old turns pile up
+SUMMARY_MAX_SESSIONS = 1000
+SUMMARY_TTL_SECONDS = 6 * 3600
+
+SUMMARY_PROMPT = """Summarize the conversation below between a traveller and Aiman, a Malaysian travel concierge.
+Keep every concrete fact the traveller shared or agreed to: destinations, dates, trip length, budget, group,
+dietary needs, preferences, and places or bookings already recommended or chosen. Drop greetings and small talk.
+Write at most 150 words in plain sentences."""
+
+SUMMARY_CONFIG = types.GenerateContentConfig(
+    temperature=0.2,
+    max_output_tokens=400,
+    safety_settings=SAFETY_SETTINGS,
+)
+
+def history_digest(conversation_history: list) -> str:
+    """Hash of the client's history messages, to check a summary still describes them"""
+    digest = hashlib.sha256()
+    for msg in conversation_history:
+        digest.update(f"{msg.get('role', 'user')}\x00{_history_message_text(msg)}\x01".encode("utf-8"))
+    return digest.hexdigest()
+
+@dataclass
+class SessionSummary:
+    """Running summary of the first `covered` messages of a session's history"""
+    text: str
+    covered: int
+    digest: str
+    updated_at: float
+
+class SessionSummaryStore:
+    """Per-process LRU of running summaries keyed by user_session_id"""
+
+    def __init__(self, max_sessions: int, ttl_seconds: int):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._summaries: "OrderedDict[str, SessionSummary]" = OrderedDict()
+        self._running: set = set()
+
+    def lookup(self, session_id: Optional[str], conversation_history: list) -> Optional[SessionSummary]:
+        """The stored summary, if it still matches the start of the client's history"""
+        if not session_id:
+            return None
+        with self._lock:
+            summary = self._summaries.get(session_id)
+            if summary is None:
+                return None
+            if time.time() - summary.updated_at > self.ttl_seconds:
+                del self._summaries[session_id]
+                return None
+            self._summaries.move_to_end(session_id)
+        if summary.covered > len(conversation_history):
+            return None
+        if history_digest(conversation_history[:summary.covered]) != summary.digest:
+            return None
+        return summary
+
+    def needs_update(self, session_id: Optional[str], conversation_history: list) -> bool:
+        if not SUMMARY_ENABLED or not session_id:
+            return False
+        summary = self.lookup(session_id, conversation_history)
+        covered = summary.covered if summary else 0
+        summarizable = len(conversation_history) - SUMMARY_KEEP_RECENT_MESSAGES
+        return summarizable - covered >= SUMMARY_BATCH_MESSAGES
+
+    def update(self, session_id: str, conversation_history: list) -> None:
+        """Fold older turns into the running summary (runs after the response is sent)"""
+        with self._lock:
+            if session_id in self._running:
+                return
+            self._running.add(session_id)
+        try:
+            summary = self.lookup(session_id, conversation_history)
+            covered = summary.covered if summary else 0
+            target = len(conversation_history) - SUMMARY_KEEP_RECENT_MESSAGES
+            if target - covered < SUMMARY_BATCH_MESSAGES:
+                return
+            
+            transcript = "\n".join(
+                f"{'Traveller' if msg.get('role', 'user') == 'user' else 'Aiman'}: {_history_message_text(msg)}"
+                for msg in conversation_history[covered:target]
+            )
+            previous = f"Summary so far:\n{summary.text}\n\n" if summary else ""
+            prompt = f"{SUMMARY_PROMPT}\n\n{previous}Conversation:\n{transcript}"
+            
+            started = time.time()
+            call_started = time.monotonic()
+            with endpoint_pool.route(session_id) as endpoint:
+                response = endpoint.client.models.generate_content(
+                    model=endpoint.name,
+                    contents=[types.Content(role="user", parts=[types.Part.from_text(text=prompt)])],
+                    config=SUMMARY_CONFIG
+                )
+            usage_accounting.record(usage_record("summary", [response], call_started, session_id=session_id, endpoint=endpoint.name))
+            text = clean_response_text(response.text or "")
+            if not text:
+                return
+            
+            with self._lock:
+                self._summaries[session_id] = SessionSummary(
+                    text=text,
+                    covered=target,
+                    digest=history_digest(conversation_history[:target]),
+                    updated_at=time.time()
+                )
+                self._summaries.move_to_end(session_id)
+                while len(self._summaries) > self.max_sessions:
+                    self._summaries.popitem(last=False)
+            logger.info(f"📝 Summarized {target - covered} messages for session {session_id[:8]} in {time.time() - started:.1f}s")
+        except Exception as e:
+            logger.warning(f"⚠️ Conversation summary failed for session {session_id[:8]}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+
+session_summaries = SessionSummaryStore(SUMMARY_MAX_SESSIONS, SUMMARY_TTL_SECONDS)
+
+def build_history_contents(conversation_history: list, session_id: Optional[str] = None) -> List[types.Content]:
+    """History contents for a request: running summary (if any) plus the turns it doesn't cover"""
+    summary = session_summaries.lookup(session_id, conversation_history)
+    if summary is None:
+        return history_to_contents(conversation_history)
+    
+    # Pinned turns survive summarization; everything else older than `covered` is in the summary
+    pinned = [msg for msg in conversation_history[:summary.covered] if _is_pinned(msg, _history_message_text(msg))]
+    summary_text = f"[Summary of our earlier conversation]\n{summary.text}"
+    budget = HISTORY_TOKEN_BUDGET - estimate_tokens(summary_text)
+    contents = [types.Content(role="user", parts=[types.Part.from_text(text=summary_text)])]
+    for content in history_to_contents(pinned + conversation_history[summary.covered:], budget):
+        append_turn(contents, content.role, content.parts)
+    return contents
+
+def schedule_summary_update(background_tasks: BackgroundTasks, session_id: Optional[str], conversation_history: list) -> None:
+    """Queue a summary refresh to run after the response has been sent"""
+    if session_summaries.needs_update(session_id, conversation_history):
+        background_tasks.add_task(run_summary_update, session_id, list(conversation_history))
+
+# Exact-match response cache for stateless first-turn prompts (opt-in)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))  # Answers kept per prompt before serving from cache
+
+_CACHE_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_prompt(message: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation so trivial variants share a key"""
+    return _CACHE_WHITESPACE_PATTERN.sub(" ", message.strip().lower()).rstrip("?!.~ ")
+
+def response_cache_key(message: str, phase: ConversationPhase, temperature: float, model: str) -> str:
+    """Cache / coalescing key: normalized prompt, phase, temperature bucket and endpoint"""
+    temperature_bucket = round(temperature or 0.0, 1)
+    return f"{model}|{phase.value}|{temperature_bucket}|{normalize_prompt(message)}"
+
+def is_cacheable_request(request: ChatRequest) -> bool:
+    """Only stateless first turns are safe to answer from cache"""
+    return not request.conversation_history and bool(request.message.strip())
+
+@dataclass
+class CachedResponseEntry:
+    """Up to RESPONSE_CACHE_VARIANTS answers for one prompt key"""
+    variants: list
+    expire_at: float
+
+class ResponseCache:
+    """TTL + LRU cache of ChatResponse payloads.
+
+    Each key collects several answers before it starts serving hits, then returns
+    one at random, so repeated prompts don't all get a word-for-word identical reply.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, variants: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedResponseEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expire_at <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None or len(entry.variants) < self.variants:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry.variants)
+
+    def put(self, key: str, payload: dict) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expire_at <= time.time():
+                entry = CachedResponseEntry(variants=[], expire_at=time.time() + self.ttl_seconds)
+                self._entries[key] = entry
+            if len(entry.variants) < self.variants:
+                entry.variants.append(payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_VARIANTS)
+
+# Semantic response cache - near-duplicate first-turn prompts share an answer (opt-in kill switch)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true" and np is not None
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.88"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_DIMENSIONS = 1024
+
+# Local place-name shorthands, expanded so "KL" and "Kuala Lumpur" embed the same
+PLACE_ALIASES = {"kl": "kuala lumpur", "jb": "johor bahru", "pj": "petaling jaya", "kk": "kota kinabalu"}
+SEMANTIC_STOPWORDS = frozenset("""
+a an the in at on to of for and or is are be i me my we you what where which how should can could would
+best good great top recommend eat find try get some any there this that with near please
+""".split())
+_SEMANTIC_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+def embed_prompt(text: str):
+    """Hashed bag of words, word bigrams and character trigrams, L2-normalised.
+
+    Stopwords and filler ("best", "where to eat") are dropped so differently worded
+    requests for the same thing land close together. Returns None if nothing is left.
+    """
+    words = " ".join(PLACE_ALIASES.get(w, w) for w in _SEMANTIC_WORD_PATTERN.findall(text.lower())).split()
+    words = [w for w in words if w not in SEMANTIC_STOPWORDS]
+    if not words:
+        return None
+    
+    features_ = [(f"w:{w}", 1.0) for w in words]
+    features_ += [(f"b:{a} {b}", 1.0) for a, b in zip(words, words[1:])]
+    for w in words:
+        padded = f"<{w}>"
+        features_ += [(f"c:{padded[i:i + 3]}", 0.5) for i in range(len(padded) - 2)]
+    
+    vector = np.zeros(SEMANTIC_CACHE_DIMENSIONS, dtype=np.float32)
+    for feature, weight in features_:
+        # crc32 rather than hash() so embeddings are stable across processes
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % SEMANTIC_CACHE_DIMENSIONS] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+class SemanticResponseCache:
+    """Bounded vector index of first-turn prompts and their ChatResponse payloads.
+
+    Rows live in one preallocated matrix so a lookup is a single matrix-vector
+    product. Only rows with the same scope (endpoint, phase, temperature bucket,
+    and the prompt's numbers, durations and months) can match. When full, the least recently used row is overwritten.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._scopes = None
+        self._expire_at = None
+        self._last_used = None
+        self._payloads: List[Optional[dict]] = [None] * max_entries
+        self._scope_ids: Dict[str, int] = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _allocate(self) -> None:
+        # Lazily, so a disabled cache costs no memory
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, SEMANTIC_CACHE_DIMENSIONS), dtype=np.float32)
+            self._scopes = np.full(self.max_entries, -1, dtype=np.int32)
+            self._expire_at = np.zeros(self.max_entries, dtype=np.float64)
+            self._last_used = np.zeros(self.max_entries, dtype=np.float64)
+
+    def _scope_id(self, scope: str) -> int:
+        return self._scope_ids.setdefault(scope, len(self._scope_ids))
+
+    def get(self, scope: str, vector) -> Optional[tuple]:
+        """Best match above the threshold as (payload, similarity), or None"""
+        now = time.time()
+        with self._lock:
+            if self._size == 0 or scope not in self._scope_ids:
+                self.misses += 1
+                return None
+            n = self._size
+            similarities = self._vectors[:n] @ vector
+            valid = (self._scopes[:n] == self._scope_ids[scope]) & (self._expire_at[:n] > now)
+            similarities = np.where(valid, similarities, -1.0)
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            return self._payloads[best], similarity
+
+    def put(self, scope: str, vector, payload: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._allocate()
+            if self._size < self.max_entries:
+                row = self._size
+                self._size += 1
+            else:
+                # Expired rows first, then least recently used
+                row = int(np.argmin(np.where(self._expire_at <= now, -1.0, self._last_used)))
+            self._vectors[row] = vector
+            self._scopes[row] = self._scope_id(scope)
+            self._expire_at[row] = now + self.ttl_seconds
+            self._last_used[row] = now
+            self._payloads[row] = payload
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": SEMANTIC_CACHE_ENABLED,
+                "entries": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "threshold": self.threshold,
+            }
+
+semantic_cache = SemanticResponseCache(SEMANTIC_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, SEMANTIC_CACHE_THRESHOLD)
+
+# Tokens that change the answer while barely moving the embedding ("3 days" vs "5 days",
+# "in December" vs "in June", "halal" vs "non-halal"): they must match exactly, so they go into the scope
+_NUMBER_WORDS = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7",
+                 "eight": "8", "nine": "9", "ten": "10", "a": "1", "an": "1", "single": "1", "couple": "2"}
+_DURATION_UNITS = {"hour": "hour", "hours": "hour", "day": "day", "days": "day", "night": "night", "nights": "night",
+                   "week": "week", "weeks": "week", "weekend": "weekend", "weekends": "weekend",
+                   "month": "month", "months": "month", "year": "year", "years": "year"}
+_MONTHS = {name: name[:3] for name in (
+    "january february march april may june july august september october november december").split()}
+_MONTHS.update({abbr: abbr for abbr in _MONTHS.values()}, sept="sep")
+_SEASONS = frozenset("monsoon raya ramadan deepavali christmas cny".split())
+_NEGATIONS = frozenset("non no not without never avoid avoiding except excluding don dont".split())
+
+def prompt_specifics(text: str) -> str:
+    """Numbers, durations, months, festive seasons and negations in a prompt, normalised
+    ("three days" -> "3 day", "non-halal" and "pork free" -> "no halal", "no pork")"""
+    words = _SEMANTIC_WORD_PATTERN.findall(text.lower())
+    specifics = set()
+    for i, word in enumerate(words):
+        if word in _NEGATIONS:
+            negated = next((w for w in words[i + 1:]
+                            if len(w) > 1 and w not in SEMANTIC_STOPWORDS and w not in _NEGATIONS), "")
+            specifics.add(f"no {negated}".strip())
+        elif word == "free" and i and words[i - 1] not in SEMANTIC_STOPWORDS:
+            specifics.add(f"no {words[i - 1]}")
+        elif any(ch.isdigit() for ch in word):
+            specifics.add(word)
+        elif word in _DURATION_UNITS:
+            previous = words[i - 1] if i else ""
+            count = previous if previous.isdigit() else _NUMBER_WORDS.get(previous, "")
+            specifics.add(f"{count} {_DURATION_UNITS[word]}".strip())
+        elif word in _NUMBER_WORDS and word not in ("a", "an"):
+            specifics.add(_NUMBER_WORDS[word])
+        elif word in _MONTHS and not (word == "may" and i + 1 < len(words) and words[i + 1] in ("i", "we")):
+            specifics.add(_MONTHS[word])
+        elif word in _SEASONS:
+            specifics.add(word)
+    return ",".join(sorted(specifics))
+
+def semantic_cache_scope(phase: ConversationPhase, temperature: float, model: str, message: str) -> str:
+    return f"{model}|{phase.value}|{round(temperature or 0.0, 1)}|{prompt_specifics(message)}"
+
+# Admission control - bounded, prioritised queue in front of the model endpoint
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "8"))  # Upstream generations per worker process
+MODEL_QUEUE_MAX_WAIT_SECONDS = float(os.getenv("MODEL_QUEUE_MAX_WAIT_SECONDS", "10"))  # Reject rather than queue longer
+MODEL_HOST_MAX_CONCURRENCY = int(os.getenv("MODEL_HOST_MAX_CONCURRENCY", "0"))  # Shared by all workers on the host; 0 = off
+MODEL_HOST_SLOTS_DIR = os.getenv("MODEL_HOST_SLOTS_DIR", os.path.join(tempfile.gettempdir(), "aiman-model-slots"))
+MODEL_HOST_SLOT_POLL_SECONDS = 0.05
+ADMISSION_PRIORITIES = {"chat": 0, "image": 1, "background": 2}  # Lower is served first
+ADMISSION_WAIT_WINDOW = 500  # Recent queue waits kept per class for the percentiles
+
+class AdmissionRejected(HTTPException):
+    """The model queue is too long to serve this request within its latency budget"""
+
+    def __init__(self, retry_after: float):
+        seconds = max(1, int(retry_after + 0.999))
+        super().__init__(
+            status_code=503,
+            detail=f"Aiman is helping a lot of travellers right now. Please try again in {seconds}s.",
+            headers={"Retry-After": str(seconds)}
+        )
+        self.retry_after = seconds
+
+@dataclass(order=True)
+class AdmissionWaiter:
+    priority: int
+    sequence: int
+    future: asyncio.Future = None
+
+class HostSlots:
+    """Concurrency slots shared by every worker process on this host.
+
+    Each slot is a lock file; holding an exclusive flock on it holds the slot.
+    The kernel drops the lock if the process dies, so slots can't leak.
+    """
+
+    def __init__(self, directory: str, count: int):
+        os.makedirs(directory, exist_ok=True)
+        self._paths = [os.path.join(directory, f"slot-{i}.lock") for i in range(count)]
+        self._fds: Dict[int, int] = {}
+        self._held: set = set()
+
+    def try_acquire(self) -> Optional[int]:
+        """Free slot index, taken without waiting, or None if every slot on the host is held"""
+        for index in random.sample(range(len(self._paths)), len(self._paths)):
+            if index in self._held:
+                continue
+            fd = self._fds.get(index)
+            if fd is None:
+                fd = self._fds[index] = os.open(self._paths[index], os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            self._held.add(index)
+            return index
+        return None
+
+    async def acquire(self, timeout: float) -> Optional[int]:
+        """Slot index, or None if no slot on the host freed up within timeout"""
+        give_up_at = time.monotonic() + timeout
+        while True:
+            index = self.try_acquire()
+            if index is not None or time.monotonic() >= give_up_at:
+                return index
+            await asyncio.sleep(MODEL_HOST_SLOT_POLL_SECONDS)
+
+    def release(self, index: int) -> None:
+        fcntl.flock(self._fds[index], fcntl.LOCK_UN)
+        self._held.discard(index)
+
+class ModelAdmissionController:
+    """Per-process limit on concurrent model calls with a priority queue in front of it.
+
+    Waiters are served by priority class, first come first served within a class.
+    A request is rejected up front with Retry-After if its estimated queue wait
+    exceeds the latency budget, and later if it actually waits that long. With
+    MODEL_HOST_MAX_CONCURRENCY set, an admitted call also takes a host-wide slot.
+    """
+
+    def __init__(self, max_concurrency: int, max_wait_seconds: float, host_slots: Optional[HostSlots] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_wait_seconds = max_wait_seconds
+        self._host_slots = host_slots
+        self._active = 0
+        self._waiters: List[AdmissionWaiter] = []
+        self._sequence = itertools.count()
+        self._average_hold_seconds = 3.0  # Moving average of how long a call keeps its slot
+        self._waits = {name: deque(maxlen=ADMISSION_WAIT_WINDOW) for name in ADMISSION_PRIORITIES}
+        self._admitted = {name: 0 for name in ADMISSION_PRIORITIES}
+        self._rejected = {name: 0 for name in ADMISSION_PRIORITIES}
+
+    def estimated_wait(self, priority_class: str) -> float:
+        """Expected queue time for a new request of this class, from the queue ahead of it"""
+        if self._active < self.max_concurrency and not self._waiters:
+            return 0.0
+        priority = ADMISSION_PRIORITIES[priority_class]
+        ahead = sum(1 for w in self._waiters if w.priority <= priority and not w.future.done())
+        return (ahead + 1) * self._average_hold_seconds / self.max_concurrency
+
+    def check(self, priority_class: str) -> None:
+        """Fail fast, before any work is done, when the queue can't serve this class in time"""
+        estimate = self.estimated_wait(priority_class)
+        if estimate > self.max_wait_seconds:
+            self._reject(priority_class, estimate)
+
+    def _reject(self, priority_class: str, retry_after: float):
+        self._rejected[priority_class] += 1
+        logger.warning(f"🚦 Model queue full, rejecting {priority_class} request (retry after {retry_after:.1f}s)")
+        raise AdmissionRejected(retry_after)
+
+    async def _acquire(self, priority_class: str, timeout: float) -> None:
+        if self._active < self.max_concurrency and not self._waiters:
+            self._active += 1
+            return
+        self.check(priority_class)
+        
+        waiter = AdmissionWaiter(ADMISSION_PRIORITIES[priority_class], next(self._sequence),
+                                 asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self._reject(priority_class, self.estimated_wait(priority_class))
+        except asyncio.CancelledError:
+            # Granted at the same moment we were cancelled: hand the slot on
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()
+            raise
+
+    def try_slot(self, priority_class: str):
+        """Take a slot only if one is idle right now; returns a release callback or None"""
+        if self._active >= self.max_concurrency or any(not w.future.done() for w in self._waiters):
+            return None
+        host_slot = None
+        if self._host_slots is not None:
+            host_slot = self._host_slots.try_acquire()
+            if host_slot is None:
+                return None
+        self._active += 1
+        self._admitted[priority_class] += 1
+        
+        def release():
+            if host_slot is not None:
+                self._host_slots.release(host_slot)
+            self._release()
+        return release
+
+    def _release(self) -> None:
+        self._active -= 1
+        while self._waiters and self._active < self.max_concurrency:
+            waiter = heapq.heappop(self._waiters)
+            if not waiter.future.done():
+                self._active += 1
+                waiter.future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str, timeout: Optional[float] = None):
+        """Hold one model-call slot for the body of the block"""
+        queued_at = time.monotonic()
+        timeout = self.max_wait_seconds if timeout is None else min(timeout, self.max_wait_seconds)
+        await self._acquire(priority_class, timeout)
+        host_slot = None
+        try:
+            if self._host_slots is not None:
+                host_slot = await self._host_slots.acquire(max(0.0, timeout - (time.monotonic() - queued_at)))
+                if host_slot is None:
+                    self._reject(priority_class, self._average_hold_seconds)
+            admitted_at = time.monotonic()
+            self._waits[priority_class].append(admitted_at - queued_at)
+            self._admitted[priority_class] += 1
+            yield
+            self._average_hold_seconds = 0.9 * self._average_hold_seconds + 0.1 * (time.monotonic() - admitted_at)
+        finally:
+            if host_slot is not None:
+                self._host_slots.release(host_slot)
+            self._release()
+
+    def stats(self) -> dict:
+        queue_wait = {}
+        for name, waits in self._waits.items():
+            ordered = sorted(waits)
+            queue_wait[name] = {
+                "admitted": self._admitted[name],
+                "rejected": self._rejected[name],
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000) if ordered else 0,
+                "p95_ms": round(ordered[int(len(ordered) * 0.95)] * 1000) if ordered else 0,
+            }
+        return {
+            "max_concurrency": self.max_concurrency,
+            "host_max_concurrency": MODEL_HOST_MAX_CONCURRENCY if self._host_slots else 0,
+            "active": self._active,
+            "queued": sum(1 for w in self._waiters if not w.future.done()),
+            "average_call_seconds": round(self._average_hold_seconds, 2),
+            "classes": queue_wait,
+        }
+
+if MODEL_HOST_MAX_CONCURRENCY > 0 and fcntl is None:
+    logger.warning("⚠️ MODEL_HOST_MAX_CONCURRENCY needs fcntl (Unix); using the per-process limit only")
+model_admission = ModelAdmissionController(
+    MODEL_MAX_CONCURRENCY,
+    MODEL_QUEUE_MAX_WAIT_SECONDS,
+    HostSlots(MODEL_HOST_SLOTS_DIR, MODEL_HOST_MAX_CONCURRENCY) if MODEL_HOST_MAX_CONCURRENCY > 0 and fcntl else None
+)
+
+async def run_summary_update(session_id: str, conversation_history: list) -> None:
+    """Summarize at the lowest admission priority; skipped if the model queue is busy"""
+    try:
+        async with model_admission.slot("background"):
+            with trace_span("summary.update", messages=len(conversation_history)):
+                await asyncio.to_thread(session_summaries.update, session_id, conversation_history)
+    except AdmissionRejected:
+        logger.info(f"📝 Summary for session {session_id[:8]} skipped, model queue is busy")
+
+async def analyze_image_admitted(base64_data: str, mime_type: str, message: str) -> dict:
+    """Image analysis off the event loop, queued behind chat in the admission controller"""
+    async with model_admission.slot("image"):
+        return await asyncio.to_thread(analyze_image_with_gemini, base64_data, mime_type, message)
+
+# Retries and hedging - transient model failures are retried before the first chunk is sent
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "2"))
+MODEL_RETRY_BASE_DELAY_SECONDS = 0.5
+MODEL_RETRY_MAX_DELAY_SECONDS = 4.0
+MODEL_RETRY_BUDGET_RATIO = float(os.getenv("MODEL_RETRY_BUDGET_RATIO", "0.1"))  # Extra calls allowed per first attempt
+MODEL_RETRY_BUDGET_RESERVE = 10  # Burst of retries allowed before the ratio kicks in
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() == "true"
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "1.0"))
+HEDGE_MIN_SAMPLES = 20  # Time-to-first-token samples needed before the p95 is trusted
+TTFT_WINDOW = 200
+
+def is_transient_model_error(error: Exception) -> bool:
+    """Quota, overload and deadline errors that are worth another attempt"""
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, TimeoutError, ConnectionError))
+
+class ModelRetryPolicy:
+    """Retry budget, time-to-first-token window and counters for model calls.
+
+    The budget is a token bucket: every first attempt deposits
+    MODEL_RETRY_BUDGET_RATIO of a token and every retry or hedge spends one,
+    so during an outage retries can't multiply the load on the endpoint.
+    """
+
+    def __init__(self):
+        self._budget = float(MODEL_RETRY_BUDGET_RESERVE)
+        self._ttft = deque(maxlen=TTFT_WINDOW)
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    def record_attempt(self) -> None:
+        self.attempts += 1
+        self._budget = min(MODEL_RETRY_BUDGET_RESERVE, self._budget + MODEL_RETRY_BUDGET_RATIO)
+
+    def spend(self) -> bool:
+        if self._budget < 1:
+            self.budget_exhausted += 1
+            return False
+        self._budget -= 1
+        return True
+
+    def record_ttft(self, seconds: float) -> None:
+        self._ttft.append(seconds)
+
+    def ttft_p95(self) -> Optional[float]:
+        if len(self._ttft) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._ttft)
+        return ordered[int(len(ordered) * 0.95)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """How long to wait for a first token before hedging, or None if hedging is off"""
+        p95 = self.ttft_p95()
+        if not HEDGING_ENABLED or p95 is None:
+            return None
+        return max(HEDGE_MIN_DELAY_SECONDS, p95)
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff"""
+        return random.uniform(0, min(MODEL_RETRY_MAX_DELAY_SECONDS, MODEL_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+
+    def stats(self) -> dict:
+        p95 = self.ttft_p95()
+        return {
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "budget_exhausted": self.budget_exhausted,
+            "budget": round(self._budget, 2),
+            "ttft_p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "hedging_enabled": HEDGING_ENABLED,
+        }
+
+retry_policy = ModelRetryPolicy()
+_background_tasks: set = set()  # Strong references so fire-and-forget tasks aren't garbage collected
+
+async def _first_chunk(start_stream, affinity: Optional[str] = None, avoid: Optional[set] = None) -> tuple:
+    """Open a model stream on the best endpoint and read its first chunk off the event loop"""
+    target = endpoint_pool.acquire(affinity, avoid)
+    if avoid is not None:
+        avoid.add(target.name)
+    with trace_span("model.open", endpoint=target.name.rsplit("/", 1)[-1]):
+        try:
+            iterator = endpoint_pool.stream(target, start_stream(target.client, target.name))
+        except Exception as e:
+            endpoint_pool.release(target, e)
+            raise
+        return iterator, await asyncio.to_thread(next, iterator, None)
+
+def _discard_stream(attempt: asyncio.Task) -> None:
+    """Close a losing hedge once its blocked first read returns"""
+    async def close():
+        try:
+            iterator, _ = await attempt
+        except Exception:
+            return
+        await asyncio.to_thread(iterator.close)
+    task = asyncio.ensure_future(close())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _first_chunk_hedged(start_stream, priority_class: str, affinity: Optional[str], tried: set) -> tuple:
+    """First chunk of a stream, sending a second identical request if it is slower than the p95"""
+    primary = asyncio.ensure_future(_first_chunk(start_stream, affinity, tried))
+    delay = retry_policy.hedge_delay()
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+    
+    # A hedge needs an idle model slot and retry budget; it never queues
+    release_hedge_slot = model_admission.try_slot(priority_class)
+    if release_hedge_slot is None:
+        return await primary
+    if not retry_policy.spend():
+        release_hedge_slot()
+        return await primary
+    
+    retry_policy.hedges += 1
+    logger.info("🪞 No first token after %.2fs, hedging the model request", delay)
+    hedge = asyncio.ensure_future(_first_chunk(start_stream, None, tried))  # Preferably on another endpoint
+    try:
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is None:
+                    for loser in pending:
+                        _discard_stream(loser)
+                    if attempt is hedge:
+                        retry_policy.hedge_wins += 1
+                    return attempt.result()
+        raise primary.exception()
+    except asyncio.CancelledError:
+        _discard_stream(primary)
+        _discard_stream(hedge)
+        raise
+    finally:
+        release_hedge_slot()
+
+async def open_model_stream(start_stream, priority_class: str = "chat", give_up_at: Optional[float] = None,
+                            affinity: Optional[str] = None) -> tuple:
+    """Start a model stream and return (iterator, first_chunk), retrying transient failures.
+
+    start_stream(client, model) opens the SDK stream on the endpoint picked by the
+    pool; retries prefer endpoints not tried yet. Only the opening of the stream is
+    retried: once a chunk has been handed out a retry would duplicate text.
+    first_chunk is None for an empty stream.
+    """
+    retry_policy.record_attempt()
+    attempt = 0
+    tried: set = set()
+    while True:
+        started = time.monotonic()
+        try:
+            iterator, chunk = await _first_chunk_hedged(start_stream, priority_class, affinity, tried)
+            retry_policy.record_ttft(time.monotonic() - started)
+            return iterator, chunk
+        except Exception as e:
+            attempt += 1
+            if not is_transient_model_error(e) or attempt > MODEL_MAX_RETRIES:
+                raise
+            delay = retry_policy.backoff(attempt)
+            if give_up_at is not None and time.monotonic() + delay >= give_up_at:
+                raise
+            if not retry_policy.spend():
+                raise
+            retry_policy.retries += 1
+            logger.warning(f"🔁 Transient model error, retry {attempt}/{MODEL_MAX_RETRIES} in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
+
+# Single-flight coalescing - identical concurrent requests share one upstream generation
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "true").lower() == "true"
+
+def coalescing_key(route: str, request: ChatRequest, phase: ConversationPhase, model: str, max_output_tokens: int) -> str:
+    """Response-cache key plus whatever else changes the upstream request for this route"""
+    return f"{route}|{max_output_tokens}|{response_cache_key(request.message, phase, request.temperature, model)}"
+
+class InFlightGeneration:
+    """Chunks of one upstream generation, replayed in order to every request attached to it"""
+
+    def __init__(self, key: Optional[str]):
+        self.key = key
+        self.chunks: list = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.abandoned = False  # Every attached request went away; stop pulling from upstream
+        self.admitted = False  # Holding a model slot (False while still queued)
+        self.endpoint: Optional[str] = None  # Deployment that served the generation
+        self.usage_tags: dict = {}  # route, phase and session_id for usage accounting
+        self.task: Optional[asyncio.Task] = None
+        self._condition = asyncio.Condition()
+
+    async def publish(self, chunk) -> None:
+        async with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None) -> None:
+        async with self._condition:
+            self.done = True
+            self.error = error
+            self._condition.notify_all()
+
+    async def subscribe(self):
+        """Yield every chunk from the start, then follow live output until the generation ends"""
+        position = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: position < len(self.chunks) or self.done)
+                pending = self.chunks[position:]
+                position += len(pending)
+                done, error = self.done, self.error
+            for chunk in pending:
+                yield chunk
+            if done and position == len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+class SingleFlight:
+    """Registry of in-flight generations by coalescing key.
+
+    The first request for a key starts the upstream stream in a worker thread;
+    identical requests arriving before it finishes attach to it instead of
+    calling the endpoint again. A None key always starts a private generation.
+    Every attach() must be paired with release(); once the last request has
+    released an unfinished generation, the upstream stream is closed.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, InFlightGeneration] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.cancelled_tokens_saved = 0
+        self._average_output_tokens = 0.0  # Moving average over completed generations
+
+    def attach(self, key: Optional[str], start_stream, priority_class: str = "chat",
+               deadline: Optional["RequestDeadline"] = None, affinity: Optional[str] = None,
+               usage_tags: Optional[dict] = None) -> tuple[InFlightGeneration, bool]:
+        """Return (generation, is_leader); start_stream(client, model) is only called by the leader.
+
+        usage_tags (route, phase, session_id) label the upstream call in usage accounting;
+        requests attached to it cost nothing extra and are not recorded.
+
+        A new generation first queues for a model slot and raises AdmissionRejected
+        straight away if that queue is already too long.
+        """
+        flight = self._flights.get(key) if key else None
+        if flight is not None:
+            flight.subscribers += 1
+            self.coalesced += 1
+            return flight, False
+        
+        model_admission.check(priority_class)
+        flight = InFlightGeneration(key)
+        flight.usage_tags = usage_tags or {}
+        flight.subscribers = 1
+        if key:
+            self._flights[key] = flight
+        self.leaders += 1
+        timeout = deadline.budget("model") if deadline else None
+        give_up_at = deadline.expires_at if deadline else None
+        flight.task = asyncio.create_task(self._produce(flight, start_stream, priority_class, timeout, give_up_at, affinity))
+        return flight, True
+
+    def release(self, flight: InFlightGeneration) -> None:
+        """Detach one request; abandon the generation if nobody is left waiting for it"""
+        flight.subscribers -= 1
+        if flight.subscribers <= 0 and not flight.done:
+            flight.abandoned = True
+            self._forget(flight)
+            if not flight.admitted:
+                flight.task.cancel()  # Still queued: give up the place in line
+
+    def _forget(self, flight: InFlightGeneration) -> None:
+        if flight.key and self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    async def _produce(self, flight: InFlightGeneration, start_stream, priority_class: str,
+                       timeout: Optional[float], give_up_at: Optional[float], affinity: Optional[str]) -> None:
+        error = None
+        iterator = None
+        finished = False
+        output_tokens = 0
+        started = time.monotonic()
+        admitted_at = first_chunk_at = None
+        try:
+            async with model_admission.slot(priority_class, timeout):
+                flight.admitted = True
+                admitted_at = time.monotonic()
+                iterator, chunk = await open_model_stream(start_stream, priority_class, give_up_at, affinity)
+                first_chunk_at = time.monotonic() if chunk is not None else None
+                flight.endpoint = iterator.target.name
+                while not flight.abandoned:
+                    if chunk is None:
+                        finished = True
+                        break
+                    usage = chunk.usage_metadata
+                    if usage is not None and usage.candidates_token_count:
+                        output_tokens = usage.candidates_token_count
+                    elif chunk.text:
+                        output_tokens += estimate_tokens(chunk.text)
+                    await flight.publish(chunk)
+                    # Pull each chunk off the event loop; the SDK stream is blocking
+                    chunk = await asyncio.to_thread(next, iterator, None)
+        except Exception as e:
+            error = e
+        finally:
+            self._forget(flight)
+            if flight.abandoned and not finished and error is None:
+                # Closing the SDK generator closes the HTTP stream to the endpoint
+                if iterator is not None:
+                    await asyncio.to_thread(iterator.close)
+                saved = max(0, round(self._average_output_tokens) - output_tokens)
+                self.cancelled += 1
+                self.cancelled_tokens_saved += saved
+                logger.info("🔌 Upstream generation cancelled after %d tokens (~%d saved)", output_tokens, saved)
+            elif finished:
+                self._average_output_tokens = output_tokens if not self._average_output_tokens else (
+                    0.9 * self._average_output_tokens + 0.1 * output_tokens)
+            outcome = "error" if error is not None else ("ok" if finished else "cancelled")
+            # Stages of the shared generation land in the leader's trace
+            record_span("model.queue", started, admitted_at or time.monotonic(), priority=priority_class)
+            record_span("model.stream", first_chunk_at, time.monotonic(), chunks=len(flight.chunks),
+                        output_tokens=output_tokens, outcome=outcome)
+            usage_accounting.record(usage_record(
+                flight.usage_tags.get("route", priority_class), flight.chunks, started, outcome=outcome,
+                phase=flight.usage_tags.get("phase"), session_id=flight.usage_tags.get("session_id"),
+                endpoint=flight.endpoint, admitted_at=admitted_at, first_chunk_at=first_chunk_at))
+            await flight.finish(error)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": REQUEST_COALESCING_ENABLED,
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "cancelled_tokens_saved": self.cancelled_tokens_saved,
+        }
+
+single_flight = SingleFlight()
+
+# Shadow traffic - mirror sampled /chat generations to a candidate endpoint for offline comparison
+SHADOW_ENDPOINT = os.getenv("SHADOW_ENDPOINT", "")  # Resource name or ID of the candidate; empty disables shadowing
+SHADOW_SAMPLE_RATE = float(os.getenv("SHADOW_SAMPLE_RATE", "0.05"))
+SHADOW_MAX_CONCURRENCY = int(os.getenv("SHADOW_MAX_CONCURRENCY", "2"))  # Mirrors beyond this are dropped, never queued
+SHADOW_STORE_PATH = os.getenv("SHADOW_STORE_PATH", "")  # Holds raw user messages; empty keeps comparisons in memory only
+SHADOW_STORE_MAX_BYTES = 50 * 1024 * 1024  # Rotated to <path>.1 beyond this
+SHADOW_RECENT_COMPARISONS = 50
+
+def prompt_token_count(chunks: list) -> Optional[int]:
+    """Prompt tokens reported by the last chunk carrying usage metadata"""
+    usage = last_usage(chunks)
+    return usage.prompt_token_count if usage is not None else None
+
+class ShadowTraffic:
+    """Mirrors a sample of /chat generations to SHADOW_ENDPOINT and stores both sides.
+
+    A mirror runs after the primary response has been sent, on its own small
+    thread pool and against its own endpoint, so it takes no model slot. It is
+    dropped rather than queued when the pool is busy or the primary model queue
+    has anyone waiting: shadow load never delays real requests.
+    The last comparisons are kept in memory; full records, including the user's
+    message and both responses, are only written when SHADOW_STORE_PATH is set.
+    """
+
+    def __init__(self, sample_rate: float, max_concurrency: int, store_path: str):
+        self.sample_rate = sample_rate
+        self.store_path = store_path
+        self.target: Optional[EndpointTarget] = None
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="shadow")
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=SHADOW_RECENT_COMPARISONS)
+        self.mirrored = 0
+        self.dropped = 0
+        self.errors = 0
+        self._totals = {"primary_ms": 0.0, "shadow_ms": 0.0, "primary_tokens": 0, "shadow_tokens": 0, "compared": 0}
+
+    def configure(self, endpoint: str) -> None:
+        self.target = parse_endpoint(endpoint) if endpoint.strip() else None
+        if self.target:
+            logger.info(f"🪞 Shadowing {self.sample_rate:.0%} of /chat traffic to {self.target.name}")
+            if not self.store_path:
+                logger.info("🪞 SHADOW_STORE_PATH is not set; comparisons are kept in memory only")
+
+    def should_sample(self) -> bool:
+        return self.target is not None and random.random() < self.sample_rate
+
+    async def submit(self, record: dict, contents: List[types.Content], config: types.GenerateContentConfig) -> None:
+        """Start a mirror of the primary call in record, or drop it if that could slow real traffic.
+
+        Async so it runs on the event loop, where the admission queue it checks lives.
+        """
+        if model_admission.estimated_wait("background") > 0 or not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            return
+        self.mirrored += 1
+        self._executor.submit(self._run, record, contents, config)
+
+    def _run(self, record: dict, contents: List[types.Content], config: types.GenerateContentConfig) -> None:
+        try:
+            started = time.monotonic()
+            ttft = None
+            chunks = []
+            try:
+                for chunk in self.target.client.models.generate_content_stream(
+                        model=self.target.name, contents=contents, config=config):
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    chunks.append(chunk)
+                output_tokens, truncated = generation_output(chunks)
+                usage_accounting.record(usage_record("shadow", chunks, started, phase=record["phase"],
+                                                     endpoint=self.target.name, first_chunk_at=started + ttft if ttft is not None else None))
+                record["shadow"] = {
+                    "endpoint": self.target.name,
+                    "latency_ms": round((time.monotonic() - started) * 1000),
+                    "ttft_ms": round(ttft * 1000) if ttft is not None else None,
+                    "prompt_tokens": prompt_token_count(chunks),
+                    "output_tokens": output_tokens,
+                    "truncated": truncated,
+                    "response": "".join(chunk.text or "" for chunk in chunks),
+                }
             except Exception as e:
-                logger.error(f"❌ Failed to use default credentials: {e}")
-                return False
-                
-    except Exception as e:
-        logger.error(f"❌ Failed to setup credentials: {e}")
-        return False
+                self.errors += 1
+                record["shadow"] = {"endpoint": self.target.name, "error": str(e)}
+                logger.warning(f"🪞 Shadow call failed: {e}")
+            self._store(record)
+        finally:
+            self._slots.release()
+
+    def _store(self, record: dict) -> None:
+        primary, shadow = record["primary"], record["shadow"]
+        comparison = {
+            "timestamp": record["timestamp"],
+            "phase": record["phase"],
+            "primary_ms": primary["latency_ms"],
+            "shadow_ms": shadow.get("latency_ms"),
+            "primary_tokens": primary["output_tokens"],
+            "shadow_tokens": shadow.get("output_tokens"),
+            "identical": "response" in shadow and shadow["response"] == primary["response"],
+            "error": shadow.get("error"),
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._recent.append(comparison)
+            if "error" not in shadow:
+                self._totals["compared"] += 1
+                self._totals["primary_ms"] += primary["latency_ms"]
+                self._totals["shadow_ms"] += shadow["latency_ms"]
+                self._totals["primary_tokens"] += primary["output_tokens"]
+                self._totals["shadow_tokens"] += shadow["output_tokens"]
+            if not self.store_path:
+                return
+            try:
+                if os.path.exists(self.store_path) and os.path.getsize(self.store_path) > SHADOW_STORE_MAX_BYTES:
+                    os.replace(self.store_path, self.store_path + ".1")
+                with open(self.store_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                logger.warning(f"⚠️ Could not write shadow comparison: {e}")
+
+    def recent(self) -> list:
+        with self._lock:
+            return list(self._recent)
+
+    def stats(self) -> dict:
+        with self._lock:
+            compared = self._totals["compared"]
+            averages = {key: round(value / compared) for key, value in self._totals.items() if key != "compared"} if compared else {}
+        return {
+            "enabled": self.target is not None,
+            "endpoint": self.target.name if self.target else None,
+            "sample_rate": self.sample_rate,
+            "mirrored": self.mirrored,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "compared": compared,
+            "averages": averages,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+shadow_traffic = ShadowTraffic(SHADOW_SAMPLE_RATE, SHADOW_MAX_CONCURRENCY, SHADOW_STORE_PATH)
+
+# Request deadlines - the client's timeout split into per-stage budgets
+REQUEST_TIMEOUT_HEADER = "X-Request-Timeout-Ms"  # Sent by the client: how long it will wait for this response
+DEFAULT_REQUEST_TIMEOUT_SECONDS = float(os.getenv("DEFAULT_REQUEST_TIMEOUT_SECONDS", "55"))
+MAX_REQUEST_TIMEOUT_SECONDS = 300.0
+DEADLINE_SAFETY_MARGIN_SECONDS = 2.0  # Give up this much earlier so our 504 reaches the client before it times out
+STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("STREAM_IDLE_TIMEOUT_SECONDS", "20"))  # Longest gap between chunks once a stream has started
+
+# Share of the total deadline reserved for each stage, in pipeline order.
+# Time a stage doesn't use rolls over to the stages after it.
+DEADLINE_STAGE_SHARES = {
+    "prompt": 0.05,      # History packing, image parsing
+    "model": 0.80,       # Upstream generation
+    "directives": 0.05,  # Cleaning and directive extraction
+    "enrichment": 0.10,  # Thumbnails and image URLs attached to the response
+}
+_DEADLINE_STAGES = list(DEADLINE_STAGE_SHARES)
+
+class DeadlineExceeded(Exception):
+    """A pipeline stage ran out of its share of the request deadline"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Request deadline exceeded during {stage}")
+        self.stage = stage
+
+class RequestDeadline:
+    """Monotonic deadline for one request with per-stage budgets"""
+
+    def __init__(self, timeout_seconds: float):
+        self.total_seconds = max(0.0, timeout_seconds - DEADLINE_SAFETY_MARGIN_SECONDS)
+        self.expires_at = time.monotonic() + self.total_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, stage: str) -> float:
+        """Seconds this stage may use: what's left minus the reservations of the stages after it"""
+        later = _DEADLINE_STAGES[_DEADLINE_STAGES.index(stage) + 1:]
+        reserved = sum(DEADLINE_STAGE_SHARES[s] for s in later) * self.total_seconds
+        return max(0.0, self.remaining() - reserved)
+
+    def check(self, stage: str) -> None:
+        """Raise DeadlineExceeded if the stage that just finished overran its budget"""
+        if self.budget(stage) <= 0:
+            raise DeadlineExceeded(stage)
+
+def request_deadline(http_request: Request) -> RequestDeadline:
+    """Deadline from the client's X-Request-Timeout-Ms header, or the server default"""
+    timeout_seconds = DEFAULT_REQUEST_TIMEOUT_SECONDS
+    header = http_request.headers.get(REQUEST_TIMEOUT_HEADER)
+    if header:
+        try:
+            timeout_seconds = min(max(float(header) / 1000, 0.0), MAX_REQUEST_TIMEOUT_SECONDS)
+        except ValueError:
+            logger.warning(f"⚠️ Ignoring invalid {REQUEST_TIMEOUT_HEADER} header: {header[:20]}")
+    return RequestDeadline(timeout_seconds)
+
+def deadline_exceeded_error(error: DeadlineExceeded) -> HTTPException:
+    logger.warning(f"⏰ {error}")
+    return HTTPException(status_code=504, detail=f"{error}. Please try again.")
+
+# Client disconnect detection - stop generating for requests nobody is waiting on
+class ClientDisconnected(Exception):
+    """The client went away before the response was complete"""
+
+async def wait_for_disconnect(http_request: Request) -> None:
+    """Return once the client disconnects (the request body must already have been read)"""
+    while (await http_request.receive())["type"] != "http.disconnect":
+        pass
+
+async def stream_until_disconnect(http_request: Request, flight: InFlightGeneration,
+                                  deadline: Optional[RequestDeadline] = None, idle_timeout: Optional[float] = None):
+    """Yield a generation's chunks, raising ClientDisconnected if the client goes away first
+    and DeadlineExceeded if the model stage of the deadline runs out.
+
+    Without idle_timeout the model budget bounds the whole generation, as a buffered
+    response shows nothing until it ends. With it, the budget only bounds the wait for
+    the first chunk and each later chunk must follow within idle_timeout seconds, so a
+    long answer that keeps streaming isn't cut off.
+
+    The flight is always released, so an upstream stream nobody is waiting on gets closed.
+    """
+    subscription = flight.subscribe()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(http_request))
+    started = False
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(subscription.__anext__())
+            if started and idle_timeout is not None:
+                timeout = idle_timeout
+            else:
+                timeout = deadline.budget("model") if deadline else None
+            await asyncio.wait({next_chunk, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not next_chunk.done():
+                next_chunk.cancel()
+                if disconnected.done():
+                    raise ClientDisconnected()
+                raise DeadlineExceeded("model")
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                return
+            started = True
+            yield chunk
+    finally:
+        disconnected.cancel()
+        single_flight.release(flight)
+
+async def collect_generation(http_request: Request, flight: InFlightGeneration,
+                             deadline: Optional[RequestDeadline] = None) -> tuple[str, int]:
+    """Concatenate a generation's text for a buffered response; returns (text, chunk_count)"""
+    response_text = ""
+    chunk_count = 0
+    async for chunk in stream_until_disconnect(http_request, flight, deadline):
+        if chunk.text:
+            response_text += chunk.text
+            chunk_count += 1
+    return response_text, chunk_count
 
-@app.on_event("startup")
 async def startup_event():
     """Initialize the backend configuration on startup"""
     global project_id, location, model_endpoint
@@ -719,21 +4350,25 @@ async def startup_event():
     logger.info("🚀 Starting AI Chat Backend with Google Gen AI SDK...")
     
     try:
-        # Setup credentials first
-        if not setup_google_credentials():
+        # Setup credentials first (the local model stand-in needs none)
+        if USE_LOCAL_MODEL:
+            logger.info("🧪 LOCAL_MODEL=true - using the offline model stand-in")
+        elif not setup_google_credentials():
             raise ValueError("Failed to setup Google Cloud credentials")
         
         # Get configuration from environment variables (set in Render)
         project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "bright-coyote-463315-q8")
         location = os.getenv("GOOGLE_CLOUD_LOCATION", "us-west1")
-        model_endpoint = os.getenv(
-            "VERTEX_AI_ENDPOINT", 
-            "projects/bright-coyote-463315-q8/locations/us-west1/endpoints/1393226367927058432"
-        )
+        # VERTEX_AI_ENDPOINTS: comma-separated resource names (or IDs) of equivalent deployments
+        endpoint_specs = os.getenv("VERTEX_AI_ENDPOINTS") or os.getenv("VERTEX_AI_ENDPOINT", DEFAULT_VERTEX_AI_ENDPOINT)
+        endpoint_pool.configure(endpoint_specs.split(","))
+        model_endpoint = endpoint_pool.primary.name
         
         logger.info(f"🔧 Project: {project_id}")
         logger.info(f"🔧 Location: {location}")
-        logger.info(f"🔧 Endpoint: {model_endpoint}")
+        for target in endpoint_pool.targets:
+            logger.info(f"🔧 Endpoint: {target.name}")
+        shadow_traffic.configure(SHADOW_ENDPOINT)
         
         # Check if we're in Render environment
         render_service = os.getenv("RENDER_SERVICE_NAME")
@@ -742,13 +4377,16 @@ async def startup_event():
         else:
             logger.info("🔐 Running in local development environment")
         
-        # Test client creation
-        test_client = genai.Client(
-            vertexai=True,
-            project=project_id,
-            location=location,
-        )
+        # Create the shared clients once so the first request doesn't pay for it
+        for target in endpoint_pool.targets:
+            target.client
         logger.info("✅ Google Gen AI client initialized successfully")
+        
+        # Index the restaurant guide in the background so the first degraded answer doesn't wait for it
+        if DEGRADED_MODE_ENABLED:
+            warm = asyncio.create_task(asyncio.to_thread(restaurant_index.load))
+            _background_tasks.add(warm)
+            warm.add_done_callback(_background_tasks.discard)
         logger.info(f"✅ Using fine-tuned model endpoint: {model_endpoint}")
         logger.info("✅ Backend initialization complete")
         
@@ -758,6 +4396,18 @@ async def startup_event():
         if not os.getenv("RENDER_SERVICE_NAME"):
             raise
 
+async def shutdown_event():
+    """Release server-side resources held by this worker"""
+    shadow_traffic.shutdown()
+    trace_exporter.shutdown()
+    if _genai_clients:
+        await asyncio.to_thread(context_cache.clear, endpoint_pool.client_for_resource)
+
+# Added last so they wrap every other middleware: the request ID is on all their logs
+# and the trace covers the whole request
+app.add_middleware(TracingMiddleware)
+app.add_middleware(RequestContextMiddleware)
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -772,225 +4422,263 @@ async def root():
 async def health_check():
     """Health check endpoint"""
     return {
-        "status": "healthy",
+        # The process is up either way; "degraded" means answers come from local assets
+        "status": "degraded" if endpoint_pool.all_open() else "healthy",
         "message": "AI Chat Backend (Google Gen AI SDK) is running",
         "model_endpoint": model_endpoint,
+        "endpoints": endpoint_pool.stats(),
         "backend_version": "2.0.0",
-        "environment": "render" if os.getenv("RENDER_SERVICE_NAME") else "local"
+        "environment": "render" if os.getenv("RENDER_SERVICE_NAME") else "local",
+        "context_cache": context_cache.stats(),
+        "response_cache": dict(response_cache.stats(), enabled=RESPONSE_CACHE_ENABLED),
+        "semantic_cache": semantic_cache.stats(),
+        "thumbnails": thumbnail_files.stats(),
+        "coalescing": single_flight.stats(),
+        "output_budgets": output_lengths.stats(),
+        "admission": model_admission.stats(),
+        "model_retries": retry_policy.stats(),
+        "shadow": shadow_traffic.stats(),
+        "usage": usage_accounting.stats(),
+        "logging": logging_stats(),
+        "tracing": trace_exporter.stats(),
+        "degraded_mode": dict(enabled=DEGRADED_MODE_ENABLED, answers=dict(degraded_answers),
+                              restaurant_index=restaurant_index.stats())
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, background_tasks: BackgroundTasks, http_request: Request, http_response: Response):
     """Chat endpoint using the correct Google Gen AI SDK approach"""
-    logger.info(f"📨 Received chat request: {request.message[:50]}...")
+    logger.info("📨 Received chat request: %.50s...", request.message)
+    deadline = request_deadline(http_request)
     
     try:
-        # Create client for Vertex AI with your fine-tuned model
-        client = genai.Client(
-            vertexai=True,
-            project=project_id,
-            location=location,
-            credentials=credentials
-        )
-        
-        # Use your fine-tuned model endpoint
+        # Cache keys use the primary endpoint; the pool picks the deployment per call
         model = model_endpoint
-        logger.info(f"🎯 Using your fine-tuned model: {model}")
         
         # Determine conversation phase
         current_phase = determine_conversation_phase(request.conversation_history, request.message)
-        logger.info(f"🎭 Conversation phase: {current_phase}")
-        
-        # Build conversation context with Aiman persona
-        contents = [
-            # System message with Aiman persona
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=AIMAN_SYSTEM_PROMPT)
-                ]
-            ),
-            types.Content(
-                role="model",
-                parts=[
-                    types.Part.from_text(text="I understand. I am Aiman, your personal Malaysian travel concierge. I will follow the phased interaction model exactly as described, using the proper greetings, emojis, and directives. I will guide users through greeting & scoping, ideation & recommendation, and consolidation & action phases appropriately.")
-                ]
-            )
-        ]
+        logger.debug("🎭 Conversation phase: %s", current_phase)
         
-        # Add conversation history if available
-        if request.conversation_history:
-            for msg in request.conversation_history[-10:]:  # Keep last 10 messages for context
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                
-                # Handle content that might be a dict (from enhanced responses)
-                if isinstance(content, dict):
-                    content = content.get('response', str(content))
-                elif not isinstance(content, str):
-                    content = str(content)
-                
-                # Map role names correctly for Gemini API
-                if role == 'assistant':
-                    role = 'model'
-                    
-                if content and content.strip():
-                    contents.append(
-                        types.Content(
-                            role=role,
-                            parts=[types.Part.from_text(text=content.strip())]
-                        )
-                    )
+        # Stateless first turns can be answered from the response caches
+        cache_key = None
+        if RESPONSE_CACHE_ENABLED and is_cacheable_request(request):
+            cache_key = response_cache_key(request.message, current_phase, request.temperature, model)
+            cached_payload = response_cache.get(cache_key)
+            http_response.headers["X-Cache"] = "HIT" if cached_payload else "MISS"
+            if cached_payload:
+                logger.info("⚡ Response cache hit")
+                return ChatResponse(**cached_payload)
+        
+        semantic_scope = semantic_vector = None
+        if SEMANTIC_CACHE_ENABLED and is_cacheable_request(request):
+            semantic_vector = embed_prompt(request.message)
+            if semantic_vector is not None:
+                semantic_scope = semantic_cache_scope(current_phase, request.temperature, model, request.message)
+                match = semantic_cache.get(semantic_scope, semantic_vector)
+                if match:
+                    cached_payload, similarity = match
+                    http_response.headers["X-Cache"] = "SEMANTIC-HIT"
+                    logger.info("⚡ Semantic cache hit (similarity %.2f)", similarity)
+                    return ChatResponse(**cached_payload)
+        
+        # Aiman persona travels as system_instruction in the prebuilt config
+        prompt_started = time.monotonic()
+        contents = build_history_contents(request.conversation_history or [], request.user_session_id)
         
         # Add current user message
-        contents.append(
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=request.message)
-                ]
-            )
-        )
+        append_turn(contents, "user", [types.Part.from_text(text=request.message)])
         
-        # Enhanced generation config following official documentation and user example
-        generate_content_config = types.GenerateContentConfig(
-            temperature=request.temperature,
-            top_p=0.95,
-            max_output_tokens=request.max_tokens,
-            # Use proper safety settings format per user's working example
-            safety_settings=[
-                types.SafetySetting(
-                    category="HARM_CATEGORY_HATE_SPEECH",
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_DANGEROUS_CONTENT", 
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                    threshold="OFF"
-                ),
-                types.SafetySetting(
-                    category="HARM_CATEGORY_HARASSMENT",
-                    threshold="OFF"
-                )
-            ],
-        )
+        output_budget = resolve_output_budget(current_phase, request.message, request.max_tokens)
+        generate_content_config = build_generation_config(
+            CHAT_CONFIG_TEMPLATE, request.temperature, output_budget.max_output_tokens, output_budget.stop_sequences)
+        record_span("prompt.build", prompt_started, time.monotonic(), messages=len(contents))
+        deadline.check("prompt")
         
-        logger.info(f"🚀 Calling model: {model}")
-        logger.info(f"🔧 Config: temp={request.temperature}, max_tokens={request.max_tokens}, top_p=0.95")
+        logger.debug("🔧 Config: temp=%s, max_tokens=%s (%s), top_p=0.95",
+                     request.temperature, output_budget.max_output_tokens, output_budget.source)
         
-        # Call model using streaming approach for better performance
-        response_text = ""
-        chunk_count = 0
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if chunk.text:
-                response_text += chunk.text
-                chunk_count += 1
-        
-        # Minimal cleaning to preserve content quality
-        cleaned_response = clean_response_text(response_text)
-        
-        # Process response directives
-        directive_info = process_response_directives(cleaned_response)
-        
-        logger.info(f"✅ Response generated: {chunk_count} chunks, {len(response_text)} chars -> {len(cleaned_response)} chars")
-        logger.info(f"🎭 Phase: {current_phase}, Images: {directive_info['contains_images']}, Actions: {directive_info['contains_actions']}")
-        logger.info(f"📄 Response preview: {cleaned_response[:100]}..." if len(cleaned_response) > 100 else f"📄 Full response: {cleaned_response}")
+        # Fail fast instead of queueing for a model slot when every endpoint is down
+        endpoint_pool.check()
         
-        return ChatResponse(
+        # Identical first turns already being generated share that upstream call
+        flight_key = None
+        if REQUEST_COALESCING_ENABLED and is_cacheable_request(request):
+            flight_key = coalescing_key("chat", request, current_phase, model, output_budget.max_output_tokens)
+        generation_started = time.monotonic()
+        flight, is_leader = single_flight.attach(flight_key, lambda client, endpoint: generate_content_stream(
+            client,
+            endpoint,
+            contents,
+            generate_content_config,
+            session_id=request.user_session_id
+        ), deadline=deadline, affinity=request.user_session_id,
+            usage_tags={"route": "chat", "phase": current_phase.value, "session_id": request.user_session_id})
+        if not is_leader:
+            http_response.headers["X-Cache"] = "COALESCED"
+            logger.info("🔗 Attached to an identical in-flight generation")
+        
+        # Call model using streaming approach, giving up if the client disconnects
+        with trace_span("generation.collect", coalesced=not is_leader):
+            response_text, chunk_count = await collect_generation(http_request, flight, deadline)
+        if is_leader:
+            output_tokens, truncated = generation_output(flight.chunks)
+            output_lengths.record(current_phase, output_tokens, output_budget, truncated)
+            if shadow_traffic.should_sample():
+                # Mirrored once the response is on its way; the shadow sees the same prompt and config
+                background_tasks.add_task(shadow_traffic.submit, {
+                    "timestamp": time.time(),
+                    "phase": current_phase.value,
+                    "message": request.message,
+                    "history_messages": len(request.conversation_history or []),
+                    "primary": {
+                        "endpoint": flight.endpoint,
+                        "latency_ms": round((time.monotonic() - generation_started) * 1000),
+                        "prompt_tokens": prompt_token_count(flight.chunks),
+                        "output_tokens": output_tokens,
+                        "truncated": truncated,
+                        "response": response_text,
+                    },
+                }, contents, generate_content_config)
+        
+        with trace_span("directives"):
+            # Minimal cleaning to preserve content quality
+            cleaned_response = clean_response_text(response_text)
+            
+            # Process response directives
+            directive_info = process_response_directives(cleaned_response)
+        deadline.check("directives")
+        
+        logger.info("✅ Response generated: %d chunks, %d chars -> %d chars, phase %s, images %s, actions %s",
+                    chunk_count, len(response_text), len(cleaned_response), current_phase.value,
+                    directive_info['contains_images'], directive_info['contains_actions'])
+        logger.debug("📄 Response preview: %.100s", cleaned_response)
+        
+        schedule_summary_update(background_tasks, request.user_session_id, request.conversation_history or [])
+        
+        chat_response = ChatResponse(
             response=cleaned_response,
-            model_used=f"vertex-ai-{model}",
+            model_used=f"vertex-ai-{flight.endpoint or model}",
             phase=current_phase.value,
             contains_images=directive_info['contains_images'],
             contains_actions=directive_info['contains_actions'],
             search_image_queries=directive_info.get('search_image_queries', []),
             action_items=directive_info.get('action_items', [])
         )
+        # Only the leader stores, so coalesced copies don't fill the cache variants
+        if cleaned_response and is_leader:
+            if cache_key:
+                response_cache.put(cache_key, chat_response.model_dump())
+            if semantic_scope:
+                semantic_cache.put(semantic_scope, semantic_vector, chat_response.model_dump())
+        return chat_response
         
+    except HTTPException:
+        raise
+    except CircuitOpen as e:
+        return ChatResponse(**await degraded_chat_payload(request, e, http_response))
+    except ClientDisconnected:
+        logger.info("🔌 Client disconnected before the response was ready")
+        return Response(status_code=499)
+    except DeadlineExceeded as e:
+        raise deadline_exceeded_error(e)
     except Exception as e:
-        logger.error(f"❌ Error generating response: {e}")
+        logger.error("❌ Error generating response: %s", e)
+        if is_transient_model_error(e):
+            try:
+                endpoint_pool.check()
+            except CircuitOpen as circuit:
+                # This failure opened the last circuit: answer locally like the requests after it
+                return ChatResponse(**await degraded_chat_payload(request, circuit, http_response))
+            # Retries ran out; tell the client it is worth coming back shortly
+            raise AdmissionRejected(MODEL_RETRY_MAX_DELAY_SECONDS)
         raise HTTPException(
             status_code=500, 
             detail=f"Failed to generate response: {str(e)}"
         )
 
 
+def degraded_stream(payload: dict):
+    """SSE events for a degraded answer: the whole text at once, flagged as degraded"""
+    yield f"data: {json.dumps({'response': payload['response'], 'degraded': True})}\n\n"
+    yield f"data: {json.dumps({'done': True})}\n\n"
+
 @app.post("/chat-stream")
-async def chat_stream_endpoint(request: ChatRequest):
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request, http_response: Response):
     """Streaming chat endpoint using Google Gen AI SDK"""
-    logger.info(f"📨 Received streaming chat request: {request.message[:50]}...")
+    logger.info("📨 Received streaming chat request: %.50s...", request.message)
+    deadline = request_deadline(http_request)
+    try:
+        endpoint_pool.check()
+    except CircuitOpen as e:
+        # Answer locally before the stream starts, while X-Degraded can still be set
+        payload = await degraded_chat_payload(request, e, http_response)
+        return StreamingResponse(degraded_stream(payload), media_type="text/event-stream",
+                                 headers={"X-Degraded": http_response.headers["X-Degraded"]})
     
-    async def generate():
-        try:
-            # Create client - pass credentials object explicitly
-            client = genai.Client(
-                vertexai=True,
-                project=project_id,
-                location=location,
-                credentials=credentials
-            )
+    # Coalescing keys use the primary endpoint; the pool picks the deployment
+    model = model_endpoint
 
-            # Use your fine-tuned model endpoint
-            model = model_endpoint
-            logger.info(f"🎯 Stream using your fine-tuned model: {model}")
-
-            # Create content following official documentation format
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=request.message)]
-                )
-            ]
-            
-            # Generation config following user's working example
-            generation_config = types.GenerateContentConfig(
-                max_output_tokens=request.max_tokens,
-                temperature=request.temperature,
-                top_p=0.95,
-                safety_settings=[
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HATE_SPEECH",
-                        threshold="OFF"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_DANGEROUS_CONTENT", 
-                        threshold="OFF"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        threshold="OFF"
-                    ),
-                    types.SafetySetting(
-                        category="HARM_CATEGORY_HARASSMENT",
-                        threshold="OFF"
-                    )
-                ]
-            )
-
-            logger.info(f"🚀 Starting stream for model: {model}")
+    # Create content following official documentation format
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=request.message)]
+        )
+    ]
+    
+    phase = determine_conversation_phase(request.conversation_history, request.message)
+    output_budget = resolve_output_budget(phase, request.message, request.max_tokens)
+    generation_config = build_generation_config(
+        STREAM_CONFIG_TEMPLATE, request.temperature, output_budget.max_output_tokens, output_budget.stop_sequences)
 
-            # Send request and get streaming response
-            responses = client.models.generate_content_stream(
-                model=model,
-                contents=contents,
-                config=generation_config,
-            )
-            
+    logger.debug("🚀 Starting stream for phase %s", phase)
+    
+    # Attach before the stream starts: a new leader that can't get a model slot raises
+    # AdmissionRejected as a real 503 + Retry-After, while followers of an identical
+    # in-flight generation never queue for admission at all
+    flight_key = None
+    if REQUEST_COALESCING_ENABLED and request.message.strip():
+        flight_key = coalescing_key("chat-stream", request, phase, model, output_budget.max_output_tokens)
+    flight, is_leader = single_flight.attach(flight_key, lambda client, endpoint: client.models.generate_content_stream(
+        model=endpoint,
+        contents=contents,
+        config=generation_config,
+    ), deadline=deadline, usage_tags={"route": "chat-stream", "phase": phase.value, "session_id": request.user_session_id})
+    if not is_leader:
+        logger.info("🔗 Stream attached to an identical in-flight generation")
+    
+    async def generate():
+        try:
             # Yield each chunk
-            for chunk in responses:
+            async for chunk in stream_until_disconnect(http_request, flight, deadline, STREAM_IDLE_TIMEOUT_SECONDS):
                 if chunk.text:
                     cleaned_chunk = clean_response_text(chunk.text)
                     if cleaned_chunk:
                         yield f"data: {json.dumps({'response': cleaned_chunk})}\n\n"
+            
+            if is_leader:
+                output_tokens, truncated = generation_output(flight.chunks)
+                output_lengths.record(phase, output_tokens, output_budget, truncated)
                                 
             yield f"data: {json.dumps({'done': True})}\n\n"
 
+        except ClientDisconnected:
+            logger.info("🔌 Stream client disconnected")
+        except DeadlineExceeded as e:
+            logger.warning(f"⏰ {e}")
+            yield f"data: {json.dumps({'error': f'{e}. Please try again.'})}\n\n"
+        except AdmissionRejected as e:
+            # Queued too long for a model slot after the stream had already started
+            yield f"data: {json.dumps({'error': e.detail, 'retry_after': e.retry_after})}\n\n"
+        except CircuitOpen as e:
+            if not DEGRADED_MODE_ENABLED:
+                error = circuit_open_error(e)
+                yield f"data: {json.dumps({'error': error.detail, 'retry_after': int(error.headers['Retry-After'])})}\n\n"
+                return
+            # The circuit opened after the headers went out; the event carries the flag instead
+            payload = await degraded_chat_payload(request, e)
+            for event in degraded_stream(payload):
+                yield event
         except Exception as e:
             error_message = f"❌ Streaming error: {str(e)}"
             logger.error(error_message)
@@ -1001,11 +4689,11 @@ async def chat_stream_endpoint(request: ChatRequest):
 @app.post("/image-search", response_model=ImageSearchResponse)
 async def image_search_endpoint(request: ImageSearchRequest):
     """Image retrieval endpoint for Malaysia tourism content"""
-    logger.info(f"🔍 Image search request: {request.query}")
+    logger.info("🔍 Image search request: %s", request.query)
     
     try:
-        # Call the image retrieval tool
-        images = image_retrieval_tool(request.query, request.max_results)
+        # Call the image retrieval tool off the event loop (it may wait on the Unsplash limit)
+        images = await asyncio.to_thread(image_retrieval_tool, request.query, request.max_results)
         
         return ImageSearchResponse(
             images=images,
@@ -1023,7 +4711,7 @@ async def image_search_endpoint(request: ImageSearchRequest):
 @app.post("/track-image-download")
 async def track_image_download(download_url: str):
     """Track image usage for Unsplash compliance - required for production access"""
-    logger.info(f"📊 Tracking image download: {download_url[:50]}...")
+    logger.info("📊 Tracking image download: %.50s...", download_url)
     
     try:
         unsplash_access_key = os.getenv("UNSPLASH_ACCESS_KEY")
@@ -1033,7 +4721,7 @@ async def track_image_download(download_url: str):
         
         # Trigger download tracking as required by Unsplash for production access
         headers = {"Authorization": f"Client-ID {unsplash_access_key}"}
-        response = requests.get(download_url, headers=headers, timeout=10)
+        response = unsplash_get(download_url, headers=headers, timeout=10)
         
         if response.status_code == 200:
             logger.info("✅ Image download tracked successfully")
@@ -1046,13 +4734,346 @@ async def track_image_download(download_url: str):
         logger.error(f"❌ Download tracking error: {e}")
         return {"success": False, "message": f"Error: {str(e)}"}
 
+# Scrape-time metrics read from the components' own counters
+@metrics.callback("cache_lookups_total", "Cache lookups by result", "counter", ("cache", "result"))
+def _cache_lookups():
+    values = {}
+    for name, stats in (("response", response_cache.stats()), ("semantic", semantic_cache.stats()),
+                        ("context", context_cache.stats())):
+        values[(name, "hit")] = stats["hits"]
+        values[(name, "miss")] = stats["misses"]
+    return values
+
+@metrics.callback("cache_hit_ratio", "Hits over lookups since start", "gauge", ("cache",))
+def _cache_hit_ratio():
+    lookups = _cache_lookups()
+    return {(name,): lookups[(name, "hit")] / total
+            for name in ("response", "semantic", "context")
+            if (total := lookups[(name, "hit")] + lookups[(name, "miss")])}
+
+@metrics.callback("model_queue_depth", "Requests waiting for a model slot")
+def _model_queue_depth():
+    return model_admission.stats()["queued"]
+
+@metrics.callback("model_slots_in_use", "Model calls holding a slot (generations in flight)")
+def _model_slots_in_use():
+    return model_admission.stats()["active"]
+
+@metrics.callback("coalesced_generations_in_flight", "Shared generations other requests can still attach to")
+def _coalesced_in_flight():
+    return single_flight.stats()["in_flight"]
+
+@metrics.callback("endpoint_outstanding_calls", "Model calls in progress per endpoint", "gauge", ("endpoint",))
+def _endpoint_outstanding():
+    return {(t["endpoint"].rsplit("/", 1)[-1],): t["outstanding"] for t in endpoint_pool.stats()}
+
+@metrics.callback("endpoint_circuit_state", "Circuit breaker per endpoint: 0 closed, 1 half-open, 2 open", "gauge", ("endpoint",))
+def _endpoint_circuit():
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    return {(t["endpoint"].rsplit("/", 1)[-1],): states[t["circuit"]] for t in endpoint_pool.stats()}
+
+@metrics.callback("model_retries_total", "Model call retries and hedges", "counter", ("kind",))
+def _model_retries():
+    stats = retry_policy.stats()
+    return {("retry",): stats["retries"], ("hedge",): stats["hedges"], ("hedge_win",): stats["hedge_wins"]}
+
+@metrics.callback("degraded_answers_total", "Answers served from local assets while circuits were open", "counter", ("source",))
+def _degraded_answers():
+    return {(source,): count for source, count in degraded_answers.items()}
+
+@metrics.callback("log_records_discarded_total", "Log records not written: sampled out or queue full", "counter", ("reason",))
+def _log_records_discarded():
+    stats = logging_stats()
+    return {("sampled",): stats["sampled_out"], ("queue_full",): stats["dropped"]}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition"""
+    return Response(content=await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/usage")
+async def usage_summary(window: str = "5m"):
+    """Token, latency and cost totals for a rolling window (1m, 5m or 1h)"""
+    if window not in USAGE_WINDOWS:
+        raise HTTPException(status_code=400, detail=f"window must be one of: {', '.join(USAGE_WINDOWS)}")
+    return dict(usage_accounting.window(USAGE_WINDOWS[window]), window=window, top_sessions=usage_accounting.top_sessions())
+
+@app.get("/usage/sessions/{session_id}")
+async def session_usage(session_id: str):
+    """Lifetime usage of one conversation"""
+    totals = usage_accounting.session(session_id)
+    if totals is None:
+        raise HTTPException(status_code=404, detail="No usage recorded for this session")
+    return dict(totals, session_id=session_id)
+
+@app.get("/debug/traces")
+async def slowest_traces(limit: int = 10, route: Optional[str] = None):
+    """Slowest recent traces with their spans, optionally for one route template (e.g. /chat-with-image)"""
+    limit = max(1, min(limit, 100))
+    traces = await asyncio.to_thread(trace_exporter.slowest, limit, route)
+    return dict(trace_exporter.stats(), traces=traces)
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Every kept request belonging to one trace"""
+    traces = trace_exporter.find(trace_id.lower())
+    if not traces:
+        raise HTTPException(status_code=404, detail="Trace not found; it may have rotated out of the buffer")
+    return {"trace_id": trace_id.lower(), "requests": traces}
+
+# Admin diagnostics - a sampling profiler and tracemalloc snapshot diffs for the live
+# worker. Disabled unless ADMIN_TOKEN is set; send it as "Authorization: Bearer <token>".
+# Each worker process answers for itself (see the pid in the response).
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILER_MAX_SECONDS = 60
+PROFILER_DEFAULT_INTERVAL_MS = 10  # 100 Hz: one stack walk per thread per sample
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "25"))  # Frames kept per allocation while tracing
+_IDLE_FRAME_FILES = ("selectors.py", "threading.py", "queue.py")  # A thread parked here is waiting, not working
+
+def require_admin(http_request: Request) -> None:
+    """Reject requests without the admin bearer token; without ADMIN_TOKEN the endpoints don't exist"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = http_request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+        logger.warning(f"🚫 Rejected admin request to {http_request.url.path}")
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
+
+@lru_cache(maxsize=8192)
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Samples every thread's Python stack with sys._current_frames() and counts collapsed stacks.
+
+    Nothing is instrumented, so the process runs at full speed between samples.
+    Only one profile runs at a time.
+    """
+
+    def __init__(self):
+        self._running = threading.Lock()
+        self.profiles = 0
+
+    def profile(self, seconds: float, interval: float, include_idle: bool) -> Optional[dict]:
+        """Collapsed stacks ("thread;outer;...;inner" -> samples), or None if a profile is already running"""
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            self.profiles += 1
+            stacks: Dict[str, int] = {}
+            thread_names: Dict[int, str] = {}
+            me = threading.get_ident()
+            samples = 0
+            started = time.monotonic()
+            while time.monotonic() - started < seconds:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    if not include_idle and frame.f_code.co_filename.endswith(_IDLE_FRAME_FILES):
+                        continue
+                    if ident not in thread_names:
+                        thread_names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(thread_names.get(ident, f"thread-{ident}"))
+                    stack = ";".join(reversed(labels))
+                    stacks[stack] = stacks.get(stack, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            return {"samples": samples, "seconds": round(time.monotonic() - started, 2), "stacks": stacks}
+        finally:
+            self._running.release()
+
+sampling_profiler = SamplingProfiler()
+
+class MemoryDiff:
+    """tracemalloc baseline and diffs; tracing only runs between snapshot() and stop()"""
+
+    def __init__(self, frames: int):
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._baseline_at: Optional[float] = None
+
+    def _take(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def snapshot(self) -> dict:
+        """Start tracing if needed and make the current heap the new baseline"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self._baseline = self._take()
+            self._baseline_at = time.time()
+        return self.stats()
+
+    def diff(self, limit: int, group_by: str, include: Optional[str]) -> Optional[dict]:
+        """Largest allocation changes since the baseline, or None without one"""
+        with self._lock:
+            if self._baseline is None or not tracemalloc.is_tracing():
+                return None
+            baseline, baseline_at, current = self._baseline, self._baseline_at, self._take()
+        if include:
+            # e.g. include=PIL keeps allocations with any frame in a matching file
+            only = (tracemalloc.Filter(True, f"*{include}*", all_frames=True),)
+            baseline, current = baseline.filter_traces(only), current.filter_traces(only)
+        stats = current.compare_to(baseline, group_by)
+        return {
+            "baseline_age_seconds": round(time.time() - baseline_at, 1),
+            "size_diff_kb": round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            "top": [{
+                "size_diff_kb": round(stat.size_diff / 1024, 1),
+                "size_kb": round(stat.size / 1024, 1),
+                "count_diff": stat.count_diff,
+                "count": stat.count,
+                "traceback": stat.traceback.format(limit=self.frames),
+            } for stat in stats[:limit]],
+        }
+
+    def stop(self) -> None:
+        with self._lock:
+            self._baseline = self._baseline_at = None
+            tracemalloc.stop()
+
+    def stats(self) -> dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "pid": os.getpid(),
+            "tracing": tracing,
+            "traced_mb": round(current / 1024 / 1024, 2),
+            "peak_mb": round(peak / 1024 / 1024, 2),
+            "tracemalloc_overhead_mb": round(tracemalloc.get_tracemalloc_memory() / 1024 / 1024, 2),
+            "baseline_at": self._baseline_at,
+        }
+
+memory_diff = MemoryDiff(TRACEMALLOC_FRAMES)
+
+@app.get("/admin/profile")
+async def profile_worker(http_request: Request, seconds: float = 10, interval_ms: float = PROFILER_DEFAULT_INTERVAL_MS,
+                         idle: bool = False, format: str = "collapsed"):
+    """Sample this worker's stacks for `seconds` and return collapsed stacks (flamegraph.pl / speedscope)"""
+    require_admin(http_request)
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILER_MAX_SECONDS}")
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or json")
+    interval = max(1.0, interval_ms) / 1000
+    logger.info(f"🔬 Profiling worker {os.getpid()} for {seconds:g}s at {1 / interval:.0f} Hz")
+    result = await asyncio.to_thread(sampling_profiler.profile, seconds, interval, idle)
+    if result is None:
+        raise HTTPException(status_code=409, detail="A profile is already running on this worker")
+    
+    stacks = sorted(result.pop("stacks").items(), key=lambda item: item[1], reverse=True)
+    if format == "json":
+        # Self time: samples where the function was the innermost frame
+        leaves: Dict[str, int] = {}
+        for stack, count in stacks:
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        top_self = heapq.nlargest(25, leaves.items(), key=lambda item: item[1])
+        return dict(result, pid=os.getpid(), stacks=dict(stacks), top_self=top_self)
+    collapsed = "".join(f"{stack} {count}\n" for stack, count in stacks)
+    return Response(content=collapsed, media_type="text/plain; charset=utf-8", headers={
+        "X-Worker-PID": str(os.getpid()),
+        "X-Profile-Samples": str(result["samples"]),
+        "X-Profile-Seconds": str(result["seconds"]),
+    })
+
+@app.post("/admin/memory/snapshot")
+async def memory_snapshot(http_request: Request):
+    """Start tracemalloc (if needed) and record the baseline for /admin/memory/diff"""
+    require_admin(http_request)
+    stats = await asyncio.to_thread(memory_diff.snapshot)
+    logger.info(f"🧠 tracemalloc baseline taken on worker {os.getpid()} ({stats['traced_mb']} MB traced)")
+    return stats
+
+@app.get("/admin/memory/diff")
+async def memory_snapshot_diff(http_request: Request, limit: int = 20, group_by: str = "lineno", include: Optional[str] = None):
+    """Allocation growth since the baseline, by line, file or full traceback"""
+    require_admin(http_request)
+    if group_by not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group_by must be lineno, filename or traceback")
+    diff = await asyncio.to_thread(memory_diff.diff, max(1, min(limit, 200)), group_by, include)
+    if diff is None:
+        raise HTTPException(status_code=409, detail="No baseline; POST /admin/memory/snapshot first")
+    return dict(memory_diff.stats(), **diff)
+
+@app.delete("/admin/memory/snapshot")
+async def memory_snapshot_stop(http_request: Request):
+    """Stop tracemalloc and drop the baseline; tracing slows allocations while it runs"""
+    require_admin(http_request)
+    await asyncio.to_thread(memory_diff.stop)
+    return memory_diff.stats()
+
+@app.get("/shadow")
+async def shadow_comparisons():
+    """Shadow traffic totals and the most recent primary/candidate comparisons"""
+    return {"stats": shadow_traffic.stats(), "recent": shadow_traffic.recent()}
+
+@app.get("/thumbnails/{key}")
+async def thumbnail_endpoint(key: str, request: Request):
+    """Serve a cached thumbnail with a long-lived, validator-backed cache policy"""
+    if not THUMBNAIL_KEY_PATTERN.match(key):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": THUMBNAIL_CACHE_CONTROL}
+    # Only keys we can still serve revalidate; evicted or unknown ones fall through to 404
+    if request.headers.get("if-none-match") == etag and await asyncio.to_thread(thumbnail_exists, key):
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        thumbnail = await asyncio.to_thread(load_thumbnail, key)
+    except Exception as e:
+        logger.error(f"❌ Thumbnail generation failed for {key}: {e}")
+        raise HTTPException(status_code=502, detail="Could not fetch source image")
+    
+    if thumbnail is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    
+    return Response(content=thumbnail, media_type=THUMBNAIL_MIME_TYPE, headers=headers)
+
+@app.get("/img/{key}")
+async def image_proxy_endpoint(key: str, request: Request):
+    """Serve a retrieved image from the local proxy cache (IMAGE_PROXY_ENABLED)"""
+    if not IMAGE_PROXY_ENABLED or not THUMBNAIL_KEY_PATTERN.match(key):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_PROXY_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag and await asyncio.to_thread(image_proxy_cache.can_serve, key):
+        return Response(status_code=304, headers=headers)
+    
+    # Hot images come straight from memory without a thread hop
+    image_data = image_proxy_cache.get_from_memory(key)
+    if image_data is None:
+        try:
+            image_data = await asyncio.to_thread(image_proxy_cache.get_or_fetch, key)
+        except Exception as e:
+            logger.error(f"❌ Image proxy fetch failed for {key}: {e}")
+            raise HTTPException(status_code=502, detail="Could not fetch source image")
+    
+    if image_data is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    media_type = sniff_image_mime_type(image_data[:12]) or "application/octet-stream"
+    return Response(content=image_data, media_type=media_type, headers=headers)
+
 @app.post("/upload-image", response_model=ChatResponse)
 async def upload_image_endpoint(
     file: UploadFile = File(...),
     message: str = Form(default="What do you see in this image?")
 ):
     """Upload and analyze image endpoint - returns unified ChatResponse format"""
-    logger.info(f"📤 Image upload request: {file.filename}, message: {message[:50]}...")
+    logger.info("📤 Image upload request: %s, message: %.50s...", file.filename, message)
     
     try:
         # Validate image file
@@ -1063,11 +5084,17 @@ async def upload_image_endpoint(
                 detail=error_message
             )
         
+        # Stream the body in with size, format and dimension checks
+        image_bytes, mime_type = await read_image_upload(file)
+        
         # Process image
-        base64_data, image_id, mime_type = process_uploaded_image(file)
+        with trace_span("image.resize", bytes=len(image_bytes)):
+            base64_data, image_id, mime_type = process_uploaded_image(image_bytes, mime_type)
+        
+        thumbnail_url = await create_upload_thumbnail(image_bytes)
         
         # Analyze with fine-tuned Gemini model
-        analysis_result = analyze_image_with_gemini(base64_data, mime_type, message)
+        analysis_result = await analyze_image_admitted(base64_data, mime_type, message)
         
         # Return unified ChatResponse format
         return ChatResponse(
@@ -1078,7 +5105,8 @@ async def upload_image_endpoint(
             contains_actions=analysis_result["contains_actions"],
             search_image_queries=analysis_result.get("search_image_queries", []),
             action_items=analysis_result.get("action_items", []),
-            image_id=image_id
+            image_id=image_id,
+            thumbnail_url=thumbnail_url
         )
         
     except HTTPException:
@@ -1090,140 +5118,207 @@ async def upload_image_endpoint(
             detail=f"Failed to process image: {str(e)}"
         )
 
-@app.post("/chat-with-image", response_model=ChatResponse)
-async def chat_with_image_endpoint(request: ChatWithImageRequest):
-    """Enhanced chat endpoint that can handle images"""
-    logger.info(f"📨🖼️ Chat with image request: {request.message[:50]}...")
+async def analyze_uploaded_image(image_bytes: bytes, mime_type: str, message: str, semaphore: asyncio.Semaphore) -> dict:
+    """Preprocess one image off the event loop, then analyze it under the batch concurrency cap"""
+    with trace_span("image.resize", bytes=len(image_bytes)):
+        base64_data, image_id, mime_type = await asyncio.to_thread(process_uploaded_image, image_bytes, mime_type)
+    thumbnail_url = await create_upload_thumbnail(image_bytes)
     
-    try:
-        # Create client for your fine-tuned model
-        client = genai.Client(
-            vertexai=True,
-            project=project_id,
-            location=location,
-            credentials=credentials
+    async with semaphore:
+        analysis_result = await analyze_image_admitted(base64_data, mime_type, message)
+    
+    return dict(analysis_result, image_id=image_id, thumbnail_url=thumbnail_url)
+
+@app.post("/upload-images")
+async def upload_images_endpoint(
+    files: List[UploadFile] = File(...),
+    message: str = Form(default="What do you see in these images?")
+):
+    """Analyze several images against one question, streaming each result as it finishes.
+
+    Emits server-sent events: one per image with its `index` and `filename` plus the
+    ChatResponse fields (or an `error`), then a final `done` event.
+    """
+    logger.info("📤 Batch image upload: %d files, message: %.50s...", len(files), message)
+    
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many images ({len(files)}). Please upload at most {MAX_BATCH_IMAGES} images at once."
         )
+    
+    # Read and check every upload before streaming starts; a bad file only fails its own slot
+    images = []
+    for index, file in enumerate(files):
+        try:
+            is_valid, error_message = validate_image_file(file)
+            if not is_valid:
+                raise HTTPException(status_code=400, detail=error_message)
+            image_bytes, mime_type = await read_image_upload(file)
+            images.append((index, file.filename, image_bytes, mime_type, None))
+        except HTTPException as e:
+            images.append((index, file.filename, None, None, e.detail))
+    
+    async def generate():
+        semaphore = asyncio.Semaphore(BATCH_ANALYSIS_CONCURRENCY)
+        
+        async def run(index, filename, image_bytes, mime_type, error):
+            if error:
+                return {"index": index, "filename": filename, "error": error}
+            try:
+                result = await analyze_uploaded_image(image_bytes, mime_type, message, semaphore)
+                return dict(result, index=index, filename=filename)
+            except HTTPException as e:
+                return {"index": index, "filename": filename, "error": e.detail}
+            except Exception as e:
+                logger.error(f"❌ Batch image {index} failed: {e}")
+                return {"index": index, "filename": filename, "error": "Failed to process image"}
         
-        # Use your fine-tuned model
+        tasks = [asyncio.create_task(run(*image)) for image in images]
+        succeeded = 0
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                if "error" not in result:
+                    succeeded += 1
+                yield f"data: {json.dumps(result)}\n\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        logger.info("✅ Batch analysis complete: %d/%d images", succeeded, len(images))
+        yield f"data: {json.dumps({'done': True, 'total': len(images), 'succeeded': succeeded})}\n\n"
+    
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+@app.post("/chat-with-image", response_model=ChatResponse)
+async def chat_with_image_endpoint(http_request: Request, background_tasks: BackgroundTasks, http_response: Response):
+    """Enhanced chat endpoint that can handle images.
+
+    Accepts the JSON body described by ChatWithImageRequest (base64 image_data),
+    or multipart/form-data with the raw image in an `image` file field, the same
+    fields as form values and conversation_history as a JSON string.
+    """
+    with trace_span("request.parse"):
+        request, image_bytes, image_mime_type = await parse_chat_with_image_request(http_request)
+    # The client's read timeout only starts once the upload has been sent
+    deadline = request_deadline(http_request)
+    logger.info("📨🖼️ Chat with image request: %.50s...", request.message)
+    
+    thumbnail_task = None
+    try:
+        # The pool picks the deployment; this is the primary endpoint
         model = model_endpoint
-        logger.info(f"🎯 Using your fine-tuned model with image: {model}")
         
         # Determine conversation phase
         current_phase = determine_conversation_phase(request.conversation_history, request.message)
-        logger.info(f"🎭 Conversation phase: {current_phase}")
-        
-        # Build conversation context with Aiman persona
-        contents = [
-            # System message with Aiman persona (updated for image handling)
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=AIMAN_SYSTEM_PROMPT + "\n\nIMPORTANT: The user has uploaded an image. Use it as context for your travel recommendations.")
-                ]
-            ),
-            types.Content(
-                role="model",
-                parts=[
-                    types.Part.from_text(text="I understand. I am Aiman, your personal Malaysian travel concierge. I can now see and analyze images to provide better travel recommendations. I will follow the phased interaction model and use the image context appropriately.")
-                ]
-            )
-        ]
+        logger.debug("🎭 Conversation phase: %s", current_phase)
         
-        # Add conversation history
-        if request.conversation_history:
-            for msg in request.conversation_history[-10:]:
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                
-                if isinstance(content, dict):
-                    content = content.get('response', str(content))
-                elif not isinstance(content, str):
-                    content = str(content)
-                
-                if role == 'assistant':
-                    role = 'model'
-                    
-                if content and content.strip():
-                    contents.append(
-                        types.Content(
-                            role=role,
-                            parts=[types.Part.from_text(text=content.strip())]
-                        )
-                    )
+        # Aiman persona (with the image note) travels as system_instruction in the prebuilt config
+        prompt_started = time.monotonic()
+        contents = build_history_contents(request.conversation_history or [], request.user_session_id)
+        
+        # Thumbnail is enrichment: render it alongside the model call and drop it if it runs late
+        if image_bytes:
+            thumbnail_task = asyncio.ensure_future(create_upload_thumbnail(image_bytes))
         
         # Add current user message with image
         parts = [types.Part.from_text(text=request.message)]
         
-        if request.image_data:
+        if image_bytes:
             # Add image to the conversation
             try:
                 image_part = types.Part(
                     inline_data=types.Blob(
-                        mime_type="image/jpeg",
-                        data=base64.b64decode(request.image_data)
+                        mime_type=image_mime_type,
+                        data=image_bytes
                     )
                 )
                 parts.append(image_part)
             except Exception as e:
                 logger.error(f"Error adding image to conversation: {e}")
                 # Continue without image if there's an error
-            logger.info("🖼️ Added image to conversation context")
+            logger.debug("🖼️ Added image to conversation context")
         
-        contents.append(
-            types.Content(
-                role="user",
-                parts=parts
-            )
-        )
+        append_turn(contents, "user", parts)
         
-        # Enhanced generation config
-        generate_content_config = types.GenerateContentConfig(
-            temperature=request.temperature,
-            top_p=0.95,
-            max_output_tokens=request.max_tokens,
-            safety_settings=[
-                types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="OFF"),
-                types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="OFF"),
-                types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="OFF"),
-                types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="OFF")
-            ],
-        )
+        output_budget = resolve_output_budget(current_phase, request.message, request.max_tokens)
+        generate_content_config = build_generation_config(
+            IMAGE_CHAT_CONFIG_TEMPLATE, request.temperature, output_budget.max_output_tokens, output_budget.stop_sequences)
+        record_span("prompt.build", prompt_started, time.monotonic(), messages=len(contents), image=image_bytes is not None)
+        deadline.check("prompt")
         
-        logger.info(f"🚀 Calling model with image: {model}")
+        endpoint_pool.check()
         
-        # Generate response
-        response_text = ""
-        chunk_count = 0
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if chunk.text:
-                response_text += chunk.text
-                chunk_count += 1
+        # Generate response (never coalesced: the image makes every request unique)
+        flight, _ = single_flight.attach(None, lambda client, endpoint: generate_content_stream(
+            client,
+            endpoint,
+            contents,
+            generate_content_config,
+            session_id=request.user_session_id
+        ), deadline=deadline, affinity=request.user_session_id,
+            usage_tags={"route": "chat-with-image", "phase": current_phase.value, "session_id": request.user_session_id})
+        with trace_span("generation.collect"):
+            response_text, chunk_count = await collect_generation(http_request, flight, deadline)
+        output_tokens, truncated = generation_output(flight.chunks)
+        output_lengths.record(current_phase, output_tokens, output_budget, truncated)
         
         # Process response
-        cleaned_response = clean_response_text(response_text)
-        directive_info = process_response_directives(cleaned_response)
+        with trace_span("directives"):
+            cleaned_response = clean_response_text(response_text)
+            directive_info = process_response_directives(cleaned_response)
+        deadline.check("directives")
+        
+        thumbnail_url = None
+        if thumbnail_task is not None:
+            done, _ = await asyncio.wait({thumbnail_task}, timeout=deadline.budget("enrichment"))
+            if done:
+                thumbnail_url = thumbnail_task.result()
+            else:
+                logger.warning("⏰ Thumbnail not ready within the deadline, responding without it")
+        
+        logger.info("✅ Image chat response: %d chunks, %d chars, phase %s, images %s, actions %s",
+                    chunk_count, len(response_text), current_phase.value,
+                    directive_info['contains_images'], directive_info['contains_actions'])
         
-        logger.info(f"✅ Image chat response: {chunk_count} chunks, {len(response_text)} chars")
-        logger.info(f"🎭 Phase: {current_phase}, Images: {directive_info['contains_images']}, Actions: {directive_info['contains_actions']}")
+        schedule_summary_update(background_tasks, request.user_session_id, request.conversation_history or [])
         
         return ChatResponse(
             response=cleaned_response,
-            model_used=f"vertex-ai-{model}",
+            model_used=f"vertex-ai-{flight.endpoint or model}",
             phase=current_phase.value,
             contains_images=directive_info['contains_images'],
-            contains_actions=directive_info['contains_actions']
+            contains_actions=directive_info['contains_actions'],
+            thumbnail_url=thumbnail_url
         )
         
+    except HTTPException:
+        raise
+    except CircuitOpen as e:
+        # The text question can still get a local answer; the photo itself goes unanalysed,
+        # so a cached text-only answer would read as if it had been looked at
+        return ChatResponse(**await degraded_chat_payload(request, e, http_response, allow_cached=image_bytes is None))
+    except ClientDisconnected:
+        logger.info("🔌 Client disconnected before the image response was ready")
+        return Response(status_code=499)
+    except DeadlineExceeded as e:
+        raise deadline_exceeded_error(e)
     except Exception as e:
         logger.error(f"❌ Error in chat with image: {e}")
+        if is_transient_model_error(e):
+            try:
+                endpoint_pool.check()
+            except CircuitOpen as circuit:
+                return ChatResponse(**await degraded_chat_payload(request, circuit, http_response, allow_cached=image_bytes is None))
+            raise AdmissionRejected(MODEL_RETRY_MAX_DELAY_SECONDS)
         raise HTTPException(
             status_code=500, 
             detail=f"Failed to generate response: {str(e)}"
         )
+    finally:
+        if thumbnail_task is not None and not thumbnail_task.done():
+            thumbnail_task.cancel()
 
 # Test endpoint removed - only use fine-tuned Gemini 2.5 Flash model
 
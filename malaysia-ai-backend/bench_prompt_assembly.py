@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+⏱️ Prompt assembly microbenchmark
+Compares the per-request cost of building the Aiman persona turns and
+generation config from scratch (the old /chat path) against deriving them
+from the prebuilt templates in api_server_genai.
+
+Usage: python bench_prompt_assembly.py [iterations]
+"""
+
+import sys
+import timeit
+
+from google.genai import types
+
+import api_server_genai as server
+
+HISTORY = [
+    {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i} about Penang street food and Langkawi beaches"}
+    for i in range(12)
+]
+MESSAGE = "What should I eat in Penang?"
+
+def legacy_assembly():
+    """Rebuild persona turns, safety settings and config on every call (pre-template behaviour)"""
+    contents = [
+        types.Content(role="user", parts=[types.Part.from_text(text=server.AIMAN_SYSTEM_PROMPT)]),
+        types.Content(role="model", parts=[types.Part.from_text(text="I understand. I am Aiman, your personal Malaysian travel concierge.")]),
+    ]
+    contents.extend(server.history_to_contents(HISTORY))
+    contents.append(types.Content(role="user", parts=[types.Part.from_text(text=MESSAGE)]))
+    config = types.GenerateContentConfig(
+        temperature=0.7,
+        top_p=0.95,
+        max_output_tokens=8192,
+        safety_settings=[
+            types.SafetySetting(category="HARM_CATEGORY_HATE_SPEECH", threshold="OFF"),
+            types.SafetySetting(category="HARM_CATEGORY_DANGEROUS_CONTENT", threshold="OFF"),
+            types.SafetySetting(category="HARM_CATEGORY_SEXUALLY_EXPLICIT", threshold="OFF"),
+            types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="OFF"),
+        ],
+    )
+    return contents, config
+
+def template_assembly():
+    """Derive the config from the prebuilt template; persona rides in system_instruction"""
+    contents = server.history_to_contents(HISTORY)
+    contents.append(types.Content(role="user", parts=[types.Part.from_text(text=MESSAGE)]))
+    config = server.build_generation_config(server.CHAT_CONFIG_TEMPLATE, 0.7, 8192)
+    return contents, config
+
+def bench(label: str, func, iterations: int) -> float:
+    best = min(timeit.repeat(func, number=iterations, repeat=5)) / iterations
+    print(f"{label:<20} {best * 1e6:8.1f} µs/request")
+    return best
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"🧪 Prompt assembly, {len(HISTORY)} history messages, best of 5 x {iterations}")
+    legacy = bench("legacy", legacy_assembly, iterations)
+    template = bench("template", template_assembly, iterations)
+    config_only = bench("config only", lambda: server.build_generation_config(server.CHAT_CONFIG_TEMPLATE, 0.7, 8192), iterations)
+    print(f"📊 Speedup: {legacy / template:.1f}x (config derivation alone: {config_only * 1e6:.1f} µs)")
+
+if __name__ == "__main__":
+    main()
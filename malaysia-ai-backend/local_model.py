@@ -0,0 +1,246 @@
+"""
+🧪 Local model stand-in for offline development and testing
+Implements the part of the Google Gen AI client the backend uses
+(models.generate_content_stream / generate_content and caches.*) with
+canned Aiman-style replies, simulated latency and token usage metadata.
+Enable it with LOCAL_MODEL=true; no credentials or network are needed.
+
+Each (project, location) gets its own client, so several VERTEX_AI_ENDPOINTS
+can be simulated at once. LOCAL_MODEL_FAULTS injects per-endpoint latency and
+errors to exercise the endpoint pool offline, e.g.
+LOCAL_MODEL_FAULTS='{"asia-southeast1": {"delay_ms": 800}, "222": {"error_rate": 0.5, "error_code": 503}}'
+Keys are a location or an endpoint ID.
+"""
+
+import datetime
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+from google.genai import errors, types
+
+# Simulated behaviour - tune to mimic the real endpoint
+LOCAL_MODEL_CACHE_MIN_TOKENS = int(os.getenv("LOCAL_MODEL_CACHE_MIN_TOKENS", "1024"))  # Vertex minimum for cached content
+LOCAL_MODEL_PREFILL_MS_PER_1K_TOKENS = float(os.getenv("LOCAL_MODEL_PREFILL_MS_PER_1K_TOKENS", "40"))
+LOCAL_MODEL_CHUNK_DELAY = float(os.getenv("LOCAL_MODEL_CHUNK_DELAY", "0.02"))
+LOCAL_MODEL_WORDS_PER_CHUNK = 8
+LOCAL_MODEL_FAULTS = json.loads(os.getenv("LOCAL_MODEL_FAULTS", "{}"))
+
+_ENDPOINT_PATTERN = re.compile(r"locations/([^/]+)/endpoints/([^/]+)")
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token)"""
+    return (len(text) + 3) // 4
+
+def count_content_tokens(contents) -> int:
+    """Estimated tokens for a Content, a list of Contents or a plain string"""
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, types.Content):
+        contents = [contents]
+    total = 0
+    for content in contents:
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content.parts or []:
+            if part.text:
+                total += estimate_tokens(part.text)
+            elif part.inline_data is not None:
+                total += 258  # Gemini bills a small image as a fixed 258 tokens
+    return total
+
+def _fault_for(model: str) -> dict:
+    """Injected faults for an endpoint resource name, matched by endpoint ID, then location"""
+    match = _ENDPOINT_PATTERN.search(model or "")
+    if not match:
+        return {}
+    location, endpoint_id = match.groups()
+    return LOCAL_MODEL_FAULTS.get(endpoint_id) or LOCAL_MODEL_FAULTS.get(location) or {}
+
+def _inject_faults(model: str) -> None:
+    """Simulate a slow or failing endpoint before the first token"""
+    fault = _fault_for(model)
+    if fault.get("delay_ms"):
+        time.sleep(fault["delay_ms"] / 1000)
+    if random.random() < fault.get("error_rate", 0):
+        code = fault.get("error_code", 503)
+        error_class = errors.ServerError if code >= 500 else errors.ClientError
+        raise error_class(code, {"error": {"code": code, "message": "Injected fault", "status": "UNAVAILABLE"}})
+
+def _not_found(name: str) -> errors.ClientError:
+    return errors.ClientError(404, {"error": {"code": 404, "message": f"Cached content {name} not found", "status": "NOT_FOUND"}})
+
+class LocalCaches:
+    """In-memory stand-in for client.caches with TTL expiry and a minimum size like Vertex"""
+
+    def __init__(self, resource_prefix: str = "projects/local/locations/local"):
+        self._prefix = resource_prefix
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self._ids = itertools.count(1)
+
+    def create(self, *, model: str, config: Optional[types.CreateCachedContentConfig] = None) -> types.CachedContent:
+        config = config or types.CreateCachedContentConfig()
+        tokens = count_content_tokens(config.system_instruction) + count_content_tokens(config.contents)
+        if tokens < LOCAL_MODEL_CACHE_MIN_TOKENS:
+            raise errors.ClientError(400, {"error": {
+                "code": 400,
+                "message": f"Cached content is too small. total_token_count={tokens}, min_total_token_count={LOCAL_MODEL_CACHE_MIN_TOKENS}",
+                "status": "INVALID_ARGUMENT"
+            }})
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ttl_seconds = float((config.ttl or "3600s").rstrip("s"))
+        cached = types.CachedContent(
+            name=f"{self._prefix}/cachedContents/{next(self._ids)}",
+            display_name=config.display_name,
+            model=model,
+            create_time=now,
+            update_time=now,
+            expire_time=now + datetime.timedelta(seconds=ttl_seconds),
+            usage_metadata=types.CachedContentUsageMetadata(total_token_count=tokens)
+        )
+        with self._lock:
+            self._entries[cached.name] = {
+                "cached": cached,
+                "system_instruction": config.system_instruction,
+                "contents": list(config.contents or []),
+                "tokens": tokens,
+            }
+        return cached
+
+    def _lookup(self, name: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                raise _not_found(name)
+            if entry["cached"].expire_time <= datetime.datetime.now(datetime.timezone.utc):
+                del self._entries[name]
+                raise _not_found(name)
+            return entry
+
+    def get(self, *, name: str, config=None) -> types.CachedContent:
+        return self._lookup(name)["cached"]
+
+    def update(self, *, name: str, config: Optional[types.UpdateCachedContentConfig] = None) -> types.CachedContent:
+        entry = self._lookup(name)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ttl_seconds = float(((config and config.ttl) or "3600s").rstrip("s"))
+        entry["cached"] = entry["cached"].model_copy(update={
+            "update_time": now,
+            "expire_time": now + datetime.timedelta(seconds=ttl_seconds)
+        })
+        return entry["cached"]
+
+    def delete(self, *, name: str, config=None) -> types.DeleteCachedContentResponse:
+        with self._lock:
+            if self._entries.pop(name, None) is None:
+                raise _not_found(name)
+        return types.DeleteCachedContentResponse()
+
+class LocalModels:
+    """Stand-in for client.models producing deterministic Aiman-style replies"""
+
+    def __init__(self, caches: LocalCaches):
+        self._caches = caches
+
+    def _compose_reply(self, contents: List[types.Content], config: Optional[types.GenerateContentConfig]) -> tuple[str, types.FinishReason]:
+        last_text = ""
+        has_image = False
+        for content in reversed(contents):
+            if content.role in (None, "user"):
+                for part in content.parts or []:
+                    if part.text and not last_text:
+                        last_text = part.text.strip()
+                    if part.inline_data is not None:
+                        has_image = True
+                break
+
+        topic = last_text[:80] or "your trip"
+        lines = ["Hello! 🇲🇾 I'm Aiman, your Malaysian travel concierge."]
+        if has_image:
+            lines.append("What a lovely photo! It reminds me of the colourful hawker stalls along Gurney Drive in Penang. 🍜")
+        lines.append(f"You asked about \"{topic}\" - here are my top picks:")
+        lines.append("1. Nasi Lemak at Village Park Restaurant, Petaling Jaya 🍛")
+        lines.append("2. A sunset walk at Batu Ferringhi beach in Penang 🏖️")
+        lines.append('[SEARCH_IMAGE: "Nasi Lemak with fried chicken and sambal"]')
+        lines.append("[ACTION: Hotel, Eastern & Oriental Hotel Penang]")
+        reply = "\n".join(lines)
+
+        max_tokens = config.max_output_tokens if config and config.max_output_tokens else None
+        if max_tokens and estimate_tokens(reply) > max_tokens:
+            return reply[:max_tokens * 4], types.FinishReason.MAX_TOKENS
+        return reply, types.FinishReason.STOP
+
+    def _prepare(self, model: str, contents, config: Optional[types.GenerateContentConfig]):
+        _inject_faults(model)
+        if isinstance(contents, (str, types.Content)):
+            contents = [contents]
+        contents = [types.Content(role="user", parts=[types.Part.from_text(text=c)]) if isinstance(c, str) else c for c in contents]
+
+        cached_tokens = 0
+        full_contents = list(contents)
+        if config is not None and config.cached_content:
+            entry = self._caches._lookup(config.cached_content)
+            cached_tokens = entry["tokens"]
+            full_contents = entry["contents"] + full_contents
+
+        system_tokens = count_content_tokens(config.system_instruction) if config is not None and config.system_instruction else 0
+        prompt_tokens = cached_tokens + system_tokens + count_content_tokens(contents)
+
+        # Prefill cost scales with the tokens that were not served from the cache
+        time.sleep((prompt_tokens - cached_tokens) / 1000 * LOCAL_MODEL_PREFILL_MS_PER_1K_TOKENS / 1000)
+        return full_contents, prompt_tokens, cached_tokens
+
+    def _usage(self, prompt_tokens: int, cached_tokens: int, output_tokens: int) -> types.GenerateContentResponseUsageMetadata:
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens or None,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens
+        )
+
+    def _response(self, text: str, usage=None, finish_reason: Optional[types.FinishReason] = None) -> types.GenerateContentResponse:
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(
+                content=types.Content(role="model", parts=[types.Part.from_text(text=text)]),
+                finish_reason=finish_reason
+            )],
+            usage_metadata=usage
+        )
+
+    def generate_content_stream(self, *, model: str, contents, config: Optional[types.GenerateContentConfig] = None):
+        full_contents, prompt_tokens, cached_tokens = self._prepare(model, contents, config)
+        reply, finish_reason = self._compose_reply(full_contents, config)
+
+        words = reply.split(" ")
+        output_tokens = 0
+        for i in range(0, len(words), LOCAL_MODEL_WORDS_PER_CHUNK):
+            text = " ".join(words[i:i + LOCAL_MODEL_WORDS_PER_CHUNK])
+            last = i + LOCAL_MODEL_WORDS_PER_CHUNK >= len(words)
+            if not last:
+                text += " "
+            output_tokens += estimate_tokens(text)
+            time.sleep(LOCAL_MODEL_CHUNK_DELAY)
+            yield self._response(text, self._usage(prompt_tokens, cached_tokens, output_tokens), finish_reason if last else None)
+
+    def generate_content(self, *, model: str, contents, config: Optional[types.GenerateContentConfig] = None) -> types.GenerateContentResponse:
+        full_contents, prompt_tokens, cached_tokens = self._prepare(model, contents, config)
+        reply, finish_reason = self._compose_reply(full_contents, config)
+        time.sleep(LOCAL_MODEL_CHUNK_DELAY)
+        return self._response(reply, self._usage(prompt_tokens, cached_tokens, estimate_tokens(reply)), finish_reason)
+
+class LocalModelClient:
+    """Drop-in replacement for genai.Client(vertexai=True, ...) when LOCAL_MODEL=true"""
+
+    def __init__(self, project: str = "local", location: str = "local"):
+        self.caches = LocalCaches(f"projects/{project}/locations/{location}")
+        self.models = LocalModels(self.caches)
@@ -28,6 +28,18 @@ import os
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
 BACKEND_URL = API_BASE_URL
 
+# How long we wait for a chat answer; sent to the backend so it gives up before we do
+CHAT_TIMEOUT_SECONDS = 60
+CHAT_DEADLINE_HEADERS = {"X-Request-Timeout-Ms": str(CHAT_TIMEOUT_SECONDS * 1000)}
+
+# Leave the sampling decision to the backend (TRACE_SAMPLE_RATE) unless every turn should be traced
+TRACE_CLIENT_SAMPLED = os.getenv("TRACE_CLIENT_SAMPLED", "false").lower() == "true"
+
+def trace_headers(trace_id: str, headers: Dict[str, str] = None) -> Dict[str, str]:
+    """Add a W3C traceparent so the backend records its spans under this turn's trace ID"""
+    flags = "01" if TRACE_CLIENT_SAMPLED else "00"
+    return dict(headers or {}, traceparent=f"00-{trace_id}-{uuid.uuid4().hex[:16]}-{flags}")
+
 # Enhanced CSS for modern UI with integrated upload
 st.markdown("""
 <style>
@@ -564,6 +576,13 @@ def process_aiman_directives(response_text: str) -> tuple:
     
     return clean_text, regular_images, all_image_queries, actions
 
+def display_image_url(image_info: Dict[str, Any]) -> str:
+    """Prefer the backend's small cached thumbnail, then its image proxy, over the source URL"""
+    local_url = image_info.get("thumbnail_url") or image_info.get("proxy_url")
+    if local_url:
+        return f"{BACKEND_URL}{local_url}"
+    return image_info["url"]
+
 @st.cache_data(ttl=300)  # Cache for 5 minutes
 def retrieve_images_for_queries(image_queries: List[str]) -> List[str]:
     """Retrieve images for the given search queries using the backend API - with caching"""
@@ -581,6 +600,7 @@ def retrieve_images_for_queries(image_queries: List[str]) -> List[str]:
             response = requests.post(
                 f"{BACKEND_URL}/image-search",
                 json={"query": query, "max_results": 1},
+                headers=trace_headers(st.session_state.get("last_trace_id") or uuid.uuid4().hex),
                 timeout=10
             )
             
@@ -589,7 +609,7 @@ def retrieve_images_for_queries(image_queries: List[str]) -> List[str]:
                 images = data.get("images", [])
                 if images:
                     image_info = images[0]
-                    retrieved_urls.append(image_info["url"])
+                    retrieved_urls.append(display_image_url(image_info))
                     # Store complete image metadata for attribution
                     st.session_state[cache_key] = {
                         "url": image_info["url"],
@@ -631,15 +651,21 @@ def upload_and_analyze_image(uploaded_file, user_message: str = "What do you see
         st.error(f"Error uploading image: {str(e)}")
         return None
 
-def send_message_with_image(prompt: str, history: List[Dict[str, str]], image_data: str = None, session_id: str = None) -> Dict[str, Any]:
-    """Send message with optional image to backend - with retry mechanism"""
+def send_message_with_image(prompt: str, history: List[Dict[str, str]], image_file=None, session_id: str = None) -> Dict[str, Any]:
+    """Send message with optional image to backend - with retry mechanism
+
+    The image is sent as raw bytes in a multipart upload rather than base64 in JSON.
+    """
     max_retries = 3
     retry_delay = 1
+    # One trace per turn; every retry is a separate request in it
+    trace_id = uuid.uuid4().hex
+    st.session_state["last_trace_id"] = trace_id
     
     for attempt in range(max_retries):
         try:
             # Get user-configured parameters or use defaults
-            max_tokens = st.session_state.get("max_tokens", 8192)
+            max_tokens = st.session_state.get("max_tokens")
             temperature = st.session_state.get("temperature", 0.7)
             
             # Enhanced payload with image support
@@ -651,18 +677,24 @@ def send_message_with_image(prompt: str, history: List[Dict[str, str]], image_da
                 "user_session_id": session_id or str(uuid.uuid4())
             }
             
-            # Add image data if provided
-            if image_data:
-                payload["image_data"] = image_data
-                endpoint = "/chat-with-image"
+            if image_file is not None:
+                # Multipart: raw image bytes plus the other fields as form values
+                form_data = dict(payload, conversation_history=json.dumps(history))
+                files = {"image": (image_file.name, image_file.getvalue(), image_file.type or "application/octet-stream")}
+                response = requests.post(
+                    f"{BACKEND_URL}/chat-with-image",
+                    data=form_data,
+                    files=files,
+                    headers=trace_headers(trace_id, CHAT_DEADLINE_HEADERS),
+                    timeout=CHAT_TIMEOUT_SECONDS
+                )
             else:
-                endpoint = "/chat"
-            
-            response = requests.post(
-                f"{BACKEND_URL}{endpoint}",
-                json=payload,
-                timeout=60
-            )
+                response = requests.post(
+                    f"{BACKEND_URL}/chat",
+                    json=payload,
+                    headers=trace_headers(trace_id, CHAT_DEADLINE_HEADERS),
+                    timeout=CHAT_TIMEOUT_SECONDS
+                )
             
             if response.status_code == 200:
                 response_data = response.json()
@@ -685,8 +717,9 @@ def send_message_with_image(prompt: str, history: List[Dict[str, str]], image_da
                     "actions": len(action_items),
                     "temp": temperature,
                     "max_tokens": max_tokens,
-                    "had_image": image_data is not None,
-                    "attempts": attempt + 1
+                    "had_image": image_file is not None,
+                    "attempts": attempt + 1,
+                    "trace_id": trace_id
                 }
                 
                 return {
@@ -699,8 +732,11 @@ def send_message_with_image(prompt: str, history: List[Dict[str, str]], image_da
                     "model_used": model_used
                 }
             else:
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
+                # The backend retries the model itself; only come back when it was busy or unreachable
+                if attempt < max_retries - 1 and response.status_code in (502, 503):
+                    # A busy backend says when to come back (503 + Retry-After)
+                    retry_after = response.headers.get("Retry-After", "")
+                    time.sleep(max(retry_delay, min(int(retry_after), 10)) if retry_after.isdigit() else retry_delay)
                     retry_delay *= 2  # Exponential backoff
                     continue
                     
@@ -728,6 +764,7 @@ def fetch_search_images(queries: list) -> dict:
             response = requests.post(
                 f"{BACKEND_URL}/image-search",
                 json={"query": query, "max_results": 1},
+                headers=trace_headers(st.session_state.get("last_trace_id") or uuid.uuid4().hex),
                 timeout=10
             )
             if response.status_code == 200:
@@ -761,7 +798,7 @@ def render_search_images(search_queries: list):
             # Show only 1 image per query with smaller size
             if images:
                 st.image(
-                    images[0]["url"], 
+                    display_image_url(images[0]), 
                     caption=images[0].get("title", "Malaysia Tourism"),
                     width=300  # Set fixed width to make images smaller
                 )
@@ -793,7 +830,7 @@ def send_message(prompt: str, history: List[Dict[str, str]], session_id: str = N
     """Send message to backend and get response with Aiman persona features"""
     try:
         # Get user-configured parameters or use defaults
-        max_tokens = st.session_state.get("max_tokens", 8192)
+        max_tokens = st.session_state.get("max_tokens")
         temperature = st.session_state.get("temperature", 0.7)
         
         # Enhanced payload with Aiman persona features
@@ -805,10 +842,13 @@ def send_message(prompt: str, history: List[Dict[str, str]], session_id: str = N
             "user_session_id": session_id or str(uuid.uuid4())
         }
         
+        trace_id = uuid.uuid4().hex
+        st.session_state["last_trace_id"] = trace_id
         response = requests.post(
             f"{BACKEND_URL}/chat",
             json=payload,
-            timeout=60  # Increased timeout for longer responses
+            headers=trace_headers(trace_id, CHAT_DEADLINE_HEADERS),
+            timeout=CHAT_TIMEOUT_SECONDS  # Increased timeout for longer responses
         )
         
         if response.status_code == 200:
@@ -827,7 +867,8 @@ def send_message(prompt: str, history: List[Dict[str, str]], session_id: str = N
                 "contains_images": contains_images,
                 "contains_actions": contains_actions,
                 "temp": temperature,
-                "max_tokens": max_tokens
+                "max_tokens": max_tokens,
+                "trace_id": trace_id
             }
             
             return {
@@ -877,7 +918,7 @@ def main():
         st.markdown("### ⚙️ Settings")
         
         # Set optimal defaults for Aiman
-        st.session_state["max_tokens"] = 8192
+        st.session_state["max_tokens"] = None  # Backend sizes the reply to the conversation phase
         st.session_state["temperature"] = 0.7
         
         # Clear chat button
@@ -902,7 +943,7 @@ def main():
                 "Response Length": f"{info.get('length', 0)} chars",
                 "API Attempts": f"{info.get('attempts', 1)} tries",
                 "Temperature": f"{info.get('temp', 0.7)}",
-                "Max Tokens": f"{info.get('max_tokens', 8192)}"
+                "Max Tokens": f"{info.get('max_tokens') or 'auto'}"
             }
             st.json(perf_data)
         
@@ -1758,11 +1799,6 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
                 
-                # Process with image analysis
-                import base64
-                image_bytes = uploaded_file.getvalue()
-                image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                
                 # Get conversation history
                 history = []
                 for msg in st.session_state.messages[:-1]:
@@ -1783,7 +1819,7 @@ def main():
                 response_data = send_message_with_image(
                     user_message,
                     history,
-                    image_base64,
+                    uploaded_file,
                     st.session_state.session_id
                 )
                 
@@ -0,0 +1,57 @@
+"""Shared fixtures: the API server running against the offline model stand-in (LOCAL_MODEL=true)"""
+
+import io
+import os
+import sys
+import time
+
+# Configuration is read when the server module is imported
+os.environ.update(
+    LOCAL_MODEL="true",
+    GOOGLE_CLOUD_PROJECT="test-project",
+    GOOGLE_CLOUD_LOCATION="us-west1",
+    VERTEX_AI_ENDPOINTS="111",
+    RESPONSE_CACHE_ENABLED="false",
+    SEMANTIC_CACHE_ENABLED="false",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import api_server_genai
+import local_model
+
+ENDPOINT_ID = "111"
+
+@pytest.fixture
+def server(monkeypatch):
+    """The server module, with a slow enough local model that concurrent requests overlap"""
+    monkeypatch.setattr(local_model, "LOCAL_MODEL_CHUNK_DELAY", 0.05)
+    monkeypatch.setattr(api_server_genai, "MODEL_RETRY_BASE_DELAY_SECONDS", 0.01)
+    return api_server_genai
+
+@pytest.fixture
+def client(server):
+    # Startup reconfigures the endpoint pool, so every test starts with closed circuits
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    """Poll until condition() holds; work finishing on the event loop lands after the response"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+def model_calls(server, route: str) -> int:
+    """Upstream generations for a route recorded by usage accounting in the last hour"""
+    return server.usage_accounting.window(3600)["by_route"].get(route, {}).get("calls", 0)
+
+def jpeg_bytes(size=(320, 240), color="orange") -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "JPEG")
+    return buffer.getvalue()
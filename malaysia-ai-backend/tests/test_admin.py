@@ -0,0 +1,46 @@
+"""Admin profiler and tracemalloc endpoints behind ADMIN_TOKEN"""
+
+import pytest
+
+TOKEN = "s3cret-admin-token"
+ADMIN_REQUESTS = [
+    ("GET", "/admin/profile?seconds=0.05"),
+    ("POST", "/admin/memory/snapshot"),
+    ("GET", "/admin/memory/diff"),
+    ("DELETE", "/admin/memory/snapshot"),
+]
+
+@pytest.fixture
+def admin(server, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", TOKEN)
+    return {"Authorization": f"Bearer {TOKEN}"}
+
+@pytest.mark.parametrize("method, path", ADMIN_REQUESTS)
+def test_admin_endpoints_do_not_exist_without_a_token(server, client, monkeypatch, method, path):
+    monkeypatch.setattr(server, "ADMIN_TOKEN", "")
+    assert client.request(method, path, headers={"Authorization": "Bearer anything"}).status_code == 404
+
+@pytest.mark.parametrize("method, path", ADMIN_REQUESTS)
+@pytest.mark.parametrize("authorization", [None, "Bearer wrong-token", f"Basic {TOKEN}", TOKEN])
+def test_admin_endpoints_reject_a_missing_or_wrong_token(server, client, admin, method, path, authorization):
+    headers = {"Authorization": authorization} if authorization else {}
+    response = client.request(method, path, headers=headers)
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+
+def test_profile_returns_collapsed_stacks(server, client, admin):
+    response = client.get("/admin/profile", params={"seconds": 0.2, "interval_ms": 5, "idle": True}, headers=admin)
+
+    assert response.status_code == 200
+    assert int(response.headers["X-Profile-Samples"]) > 0
+    stack, count = response.text.splitlines()[0].rsplit(" ", 1)
+    assert ";" in stack and int(count) > 0
+
+def test_memory_diff_needs_a_baseline(server, client, admin):
+    assert client.get("/admin/memory/diff", headers=admin).status_code == 409
+
+    assert client.post("/admin/memory/snapshot", headers=admin).status_code == 200
+    try:
+        assert client.get("/admin/memory/diff", params={"limit": 5}, headers=admin).status_code == 200
+    finally:
+        client.delete("/admin/memory/snapshot", headers=admin)
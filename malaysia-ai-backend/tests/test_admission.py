@@ -0,0 +1,42 @@
+"""Admission control in front of the model endpoint"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import wait_until
+
+def fill_model_queue(server, monkeypatch):
+    """Make every model slot busy and the estimated queue wait far beyond the latency budget"""
+    admission = server.model_admission
+    monkeypatch.setattr(admission, "_active", admission.max_concurrency)
+    monkeypatch.setattr(admission, "_average_hold_seconds", 1000.0)
+
+def test_full_queue_rejects_new_requests_with_retry_after(server, client, monkeypatch):
+    fill_model_queue(server, monkeypatch)
+
+    for path in ("/chat", "/chat-stream"):
+        response = client.post(path, json={"message": "Best beaches in Langkawi?"})
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) > 0
+
+def test_full_queue_still_lets_streams_join_an_in_flight_generation(server, client, monkeypatch):
+    request = {"message": "Two days in Melaka"}
+    with ThreadPoolExecutor(1) as pool:
+        leader = pool.submit(client.post, "/chat-stream", json=request)
+        assert wait_until(lambda: bool(server.single_flight._flights))
+        fill_model_queue(server, monkeypatch)
+        follower = client.post("/chat-stream", json=request)
+        leader = leader.result()
+
+    assert leader.status_code == follower.status_code == 200
+    assert follower.text == leader.text
+
+def test_host_slots_are_shared_between_processes(server, tmp_path):
+    # Each worker process opens its own lock files; two instances stand in for two workers
+    first, second = server.HostSlots(str(tmp_path), 1), server.HostSlots(str(tmp_path), 1)
+
+    index = first.try_acquire()
+    assert index == 0
+    assert second.try_acquire() is None
+
+    first.release(index)
+    assert second.try_acquire() == 0
@@ -0,0 +1,69 @@
+"""Cancelling the upstream generation when the client goes away"""
+
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import model_calls, wait_until
+
+async def post_then_disconnect(app, path: str, payload: dict, disconnect_after: float) -> list:
+    """POST straight to the ASGI app and hang up after `disconnect_after` seconds.
+
+    TestClient buffers the whole response before returning, so it can't hang up early.
+    """
+    body = json.dumps(payload).encode()
+    pending = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if pending:
+            return pending.pop(0)
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+    await app(scope, receive, send)
+    return sent
+
+def test_client_disconnect_cancels_the_upstream_generation(server, client):
+    cancelled_before = server.single_flight.cancelled
+    calls_before = model_calls(server, "chat")
+
+    sent = client.portal.call(post_then_disconnect, server.app, "/chat",
+                              {"message": "Plan a food trail around Ipoh"}, 0.15)
+
+    assert sent[0]["status"] == 499
+    assert wait_until(lambda: server.single_flight.cancelled - cancelled_before == 1)
+    # Still accounted for, as one cancelled generation
+    assert wait_until(lambda: model_calls(server, "chat") - calls_before == 1)
+
+def test_stream_disconnect_cancels_the_upstream_generation(server, client):
+    cancelled_before = server.single_flight.cancelled
+
+    client.portal.call(post_then_disconnect, server.app, "/chat-stream", {"message": "Three days in Sabah"}, 0.15)
+
+    assert wait_until(lambda: server.single_flight.cancelled - cancelled_before == 1)
+
+def test_generation_continues_while_a_coalesced_request_is_still_waiting(server, client):
+    cancelled_before = server.single_flight.cancelled
+    request = {"message": "Weekend in Cameron Highlands"}
+
+    with ThreadPoolExecutor(1) as pool:
+        staying = pool.submit(client.post, "/chat", json=request)
+        assert wait_until(lambda: bool(server.single_flight._flights))
+        client.portal.call(post_then_disconnect, server.app, "/chat", request, 0.05)
+        response = staying.result()
+
+    assert response.status_code == 200
+    assert response.json()["response"]
+    assert server.single_flight.cancelled == cancelled_before
@@ -0,0 +1,28 @@
+"""Single-flight coalescing of identical concurrent requests"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import model_calls, wait_until
+
+def test_coalesced_followers_share_the_leader_text_and_are_not_billed(server, client):
+    calls_before = model_calls(server, "chat")
+    coalesced_before = server.single_flight.coalesced
+
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda _: client.post("/chat", json={"message": "Where to eat laksa in Penang?"}),
+                                  range(4)))
+
+    assert [r.status_code for r in responses] == [200] * 4
+    assert len({r.json()["response"] for r in responses}) == 1
+    assert server.single_flight.coalesced - coalesced_before == 3
+    assert wait_until(lambda: model_calls(server, "chat") - calls_before == 1)
+
+def test_different_prompts_are_not_coalesced(server, client):
+    calls_before = model_calls(server, "chat")
+
+    with ThreadPoolExecutor(2) as pool:
+        responses = list(pool.map(lambda message: client.post("/chat", json={"message": message}),
+                                  ["Nasi lemak in KL?", "Cendol in Melaka?"]))
+
+    assert [r.status_code for r in responses] == [200, 200]
+    assert wait_until(lambda: model_calls(server, "chat") - calls_before == 2)
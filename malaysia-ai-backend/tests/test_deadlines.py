@@ -0,0 +1,48 @@
+"""Request deadlines from X-Request-Timeout-Ms on buffered and streamed chat"""
+
+import json
+
+import local_model
+from conftest import ENDPOINT_ID
+
+# Half a second of total budget once the safety margin is taken off
+TIMEOUT_HEADERS = {"X-Request-Timeout-Ms": "2500"}
+
+def events(response) -> list:
+    return [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+
+def test_slow_model_answers_504_on_chat(server, client, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, ENDPOINT_ID, {"delay_ms": 1500})
+
+    response = client.post("/chat", json={"message": "Hawker food in Ipoh"}, headers=TIMEOUT_HEADERS)
+
+    assert response.status_code == 504
+    assert "deadline exceeded during model" in response.json()["detail"]
+
+def test_slow_first_chunk_ends_the_stream_with_an_error_event(server, client, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, ENDPOINT_ID, {"delay_ms": 1500})
+
+    response = client.post("/chat-stream", json={"message": "Hawker food in Ipoh"}, headers=TIMEOUT_HEADERS)
+
+    assert response.status_code == 200
+    assert "deadline exceeded during model" in events(response)[-1]["error"]
+
+def test_stream_that_keeps_flowing_outlives_the_model_budget(server, client, monkeypatch):
+    monkeypatch.setattr(local_model, "LOCAL_MODEL_CHUNK_DELAY", 0.15)
+    request = {"message": "Plan a weekend in Cameron Highlands"}
+
+    streamed = events(client.post("/chat-stream", json=request, headers=TIMEOUT_HEADERS))
+    assert streamed[-1] == {"done": True}
+    assert len(streamed) > 5  # Well past half a second of chunks
+
+    # A buffered response shows nothing until the end, so the budget bounds all of it
+    assert client.post("/chat", json=request, headers=TIMEOUT_HEADERS).status_code == 504
+
+def test_stalled_stream_ends_after_the_idle_timeout(server, client, monkeypatch):
+    monkeypatch.setattr(local_model, "LOCAL_MODEL_CHUNK_DELAY", 0.3)
+    monkeypatch.setattr(server, "STREAM_IDLE_TIMEOUT_SECONDS", 0.1)
+
+    streamed = events(client.post("/chat-stream", json={"message": "Plan a weekend in Cameron Highlands"}))
+
+    assert "response" in streamed[0]
+    assert "deadline exceeded during model" in streamed[-1]["error"]
@@ -0,0 +1,56 @@
+"""Circuit breaker with degraded local answers"""
+
+import time
+
+import local_model
+from conftest import ENDPOINT_ID
+
+def open_circuit(client, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, ENDPOINT_ID, {"error_rate": 1.0, "error_code": 503})
+    # Retries of the first request fail on the only endpoint and open its circuit
+    client.post("/chat", json={"message": "hello"})
+
+def test_open_circuit_answers_degraded_with_header(server, client, monkeypatch):
+    open_circuit(client, monkeypatch)
+    assert server.endpoint_pool.stats()[0]["circuit"] == "open"
+
+    response = client.post("/chat", json={"message": "Where can I eat nasi lemak in KL?"})
+    assert response.status_code == 200
+    assert response.json()["model_used"] == "degraded-local"
+    assert response.headers["X-Degraded"] == "restaurant-index"
+
+    response = client.post("/chat-stream", json={"message": "Things to do in Penang"})
+    assert response.headers["X-Degraded"] == "highlights"
+    assert '"degraded": true' in response.text
+
+    response = client.post("/chat-with-image", json={"message": "What should I see in Melaka?"})
+    assert response.status_code == 200
+    assert response.headers["X-Degraded"] == "highlights"
+
+def test_degraded_answers_use_cached_replies_only_for_first_turns(server, client, monkeypatch):
+    message = "Best time to visit Langkawi"
+    phase = server.determine_conversation_phase([], message)
+    cached = {"response": "Cached Langkawi answer", "model_used": "vertex-ai", "phase": phase.value,
+              "contains_images": False, "contains_actions": False}
+    key = server.response_cache_key(message, phase, 0.7, server.model_endpoint)
+    for _ in range(server.response_cache.variants):
+        server.response_cache.put(key, cached)
+    open_circuit(client, monkeypatch)
+
+    first_turn = client.post("/chat", json={"message": message})
+    assert first_turn.headers["X-Degraded"] == "cache"
+    assert first_turn.json()["response"] == "Cached Langkawi answer"
+
+    follow_up = client.post("/chat", json={"message": message, "conversation_history": [
+        {"role": "user", "content": "We are going in March"}, {"role": "assistant", "content": "Lovely!"}]})
+    assert follow_up.headers["X-Degraded"] == "highlights"
+
+def test_open_circuit_without_degraded_mode_fails_fast(server, client, monkeypatch):
+    monkeypatch.setattr(server, "DEGRADED_MODE_ENABLED", False)
+    open_circuit(client, monkeypatch)
+
+    started = time.monotonic()
+    response = client.post("/chat", json={"message": "Plan a trip to Sabah"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    assert time.monotonic() - started < 1.0
@@ -0,0 +1,114 @@
+"""Routing across the endpoint pool, driven by LOCAL_MODEL_FAULTS"""
+
+import time
+
+import pytest
+from google.genai import errors
+
+import local_model
+
+def endpoint_id(target) -> str:
+    return target.name.rsplit("/", 1)[-1]
+
+def endpoint_fault(code: int = 503) -> errors.APIError:
+    return errors.ServerError(code, {"error": {"code": code, "message": "Injected fault", "status": "UNAVAILABLE"}})
+
+@pytest.fixture
+def pool(server, client, monkeypatch):
+    """Two endpoints in the default project; the client fixture has already run startup"""
+    server.endpoint_pool.configure(["111", "222"])
+    monkeypatch.setattr(server, "ENDPOINT_EJECT_SECONDS", 0.2)
+    return server.endpoint_pool
+
+def requests_per_endpoint(pool) -> dict:
+    return {endpoint_id(t): t.requests for t in pool.targets}
+
+def test_least_outstanding_endpoint_is_chosen(pool):
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    pool.release(first)
+
+    assert pool.acquire() is first
+
+def test_slow_endpoint_gets_less_traffic(pool, client, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "222", {"delay_ms": 300})
+    for i in range(8):
+        assert client.post("/chat", json={"message": f"Kuih in Melaka #{i}"}).status_code == 200
+
+    counts = requests_per_endpoint(pool)
+    assert counts["111"] > counts["222"]
+
+def test_sessions_stick_to_their_endpoint_while_it_is_cheap(pool):
+    chosen = pool.acquire(affinity="session-a")
+    pool.release(chosen)
+    for _ in range(3):
+        again = pool.acquire(affinity="session-a")
+        assert again is chosen
+        pool.release(again)
+
+    # Too busy compared with the other endpoint: the session moves
+    chosen.outstanding += 3
+    moved = pool.acquire(affinity="session-a")
+    assert moved is not chosen
+    pool.release(moved)
+    chosen.outstanding -= 3
+
+def test_traffic_moves_off_a_failing_endpoint_without_failing_requests(pool, client, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "222", {"error_rate": 1.0, "error_code": 503})
+    for i in range(6):
+        assert client.post("/chat", json={"message": f"Satay in Kajang #{i}"}).status_code == 200
+
+    stats = {s["endpoint"].rsplit("/", 1)[-1]: s for s in pool.stats()}
+    assert stats["222"]["failures"] >= 1
+    assert stats["222"]["error_rate"] > 0
+    # The failed call was retried on the healthy endpoint, and later calls go there directly
+    assert stats["111"]["requests"] >= 6
+    assert stats["222"]["requests"] <= 2
+
+def test_ejection_doubles_and_probe_readmits(server, pool, client, monkeypatch):
+    faulty = pool.targets[1]
+    for _ in range(server.ENDPOINT_EJECT_AFTER_FAILURES):
+        pool.release(pool.acquire(avoid={pool.targets[0].name}), endpoint_fault())
+    assert faulty.circuit(time.monotonic()) == "open"
+    first_ejection = faulty.ejected_until - time.monotonic()
+    assert first_ejection == pytest.approx(0.2, abs=0.05)
+
+    # Cooled down: the next call probes it, and a failed probe reopens the circuit for twice as long
+    time.sleep(0.25)
+    probe = pool.acquire()
+    assert probe is faulty
+    pool.release(probe, endpoint_fault())
+    assert faulty.ejections == 2
+    assert faulty.ejected_until - time.monotonic() == pytest.approx(0.4, abs=0.05)
+
+    # A successful probe through a real request closes it again
+    time.sleep(0.45)
+    assert client.post("/chat", json={"message": "Roti canai in Penang"}).status_code == 200
+    assert faulty.circuit(time.monotonic()) == "closed"
+    assert faulty.requests >= 5
+
+def test_error_rate_never_ejects_the_last_serving_endpoint(server, pool):
+    healthy, flaky = pool.targets
+    for target in (healthy, flaky):
+        target.samples = server.ENDPOINT_MIN_SAMPLES
+        target.error_ewma = 0.9
+
+    # With a healthy peer, a high error rate ejects without consecutive failures
+    pool.release(pool.acquire(avoid={healthy.name}), endpoint_fault())
+    assert flaky.circuit(time.monotonic()) == "open"
+
+    # The last serving endpoint keeps its traffic until faults are consecutive
+    pool.release(pool.acquire(), endpoint_fault())
+    assert healthy.circuit(time.monotonic()) == "closed"
+    for _ in range(server.ENDPOINT_EJECT_AFTER_FAILURES - 1):
+        pool.release(pool.acquire(), endpoint_fault())
+    assert healthy.circuit(time.monotonic()) == "open"
+
+def test_bad_requests_do_not_count_against_endpoint_health(server, pool):
+    target = pool.acquire()
+    for _ in range(server.ENDPOINT_EJECT_AFTER_FAILURES + 1):
+        pool.release(target, errors.ClientError(400, {"error": {"code": 400, "message": "Bad request"}}))
+        target = pool.acquire(avoid={t.name for t in pool.targets if t is not target})
+    pool.release(target)
+    assert all(s["circuit"] == "closed" for s in pool.stats())
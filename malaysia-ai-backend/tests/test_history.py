@@ -0,0 +1,60 @@
+"""Packing conversation history into a token budget"""
+
+def turn(role: str, content: str, **extra) -> dict:
+    return {"role": role, "content": content, **extra}
+
+def texts(contents) -> list:
+    return [part.text for content in contents for part in content.parts]
+
+def test_newest_turns_fill_the_budget(server):
+    history = [turn("user" if i % 2 == 0 else "assistant", f"message number {i} about Sarawak") for i in range(10)]
+    per_message = server.estimate_tokens(history[0]["content"])
+
+    contents = server.history_to_contents(history, token_budget=per_message * 3)
+
+    assert texts(contents) == [msg["content"] for msg in history[-3:]]
+
+def test_older_turns_are_dropped_once_one_does_not_fit(server):
+    history = [turn("user", "short"), turn("assistant", "word " * 200), turn("user", "also short")]
+
+    contents = server.history_to_contents(history, token_budget=50)
+
+    # The long turn ends the window; the short one before it is not squeezed in
+    assert texts(contents) == ["also short"]
+
+def test_pinned_turns_survive_the_budget(server):
+    history = [
+        turn("user", "[Image uploaded: rendang.jpg] What is this?"),
+        turn("assistant", "That is beef rendang. " * 50),
+        turn("user", "Remember we are vegetarian", pinned=True),
+        turn("assistant", "Noted! " * 50),
+        turn("user", "Where to eat tonight?"),
+    ]
+
+    contents = server.history_to_contents(history, token_budget=40)
+
+    assert texts(contents) == [history[0]["content"], history[2]["content"], history[4]["content"]]
+
+def test_dropped_turns_never_leave_two_turns_with_the_same_role_adjacent(server):
+    history = [
+        turn("user", "[Image uploaded: satay.jpg] Where can I get this?"),
+        turn("assistant", "Kajang is famous for satay. " * 50),
+        turn("user", "How far is it from KL?"),
+    ]
+
+    contents = server.history_to_contents(history, token_budget=40)
+
+    assert [content.role for content in contents] == ["user"]
+    assert texts(contents) == [history[0]["content"], history[2]["content"]]
+
+def test_assistant_turns_map_to_the_model_role(server):
+    contents = server.history_to_contents([turn("user", "Hi"), turn("assistant", "Selamat datang!")])
+    assert [content.role for content in contents] == ["user", "model"]
+
+def test_token_estimates_count_unspaced_scripts_per_character(server):
+    assert server.estimate_tokens("nasi lemak") == 2
+    assert server.estimate_tokens("马来西亚美食") == 6
+    assert server.estimate_tokens("マレーシア") == 5
+    assert server.estimate_tokens("말레이시아") == 5
+    # Mixed text: words and characters are both counted
+    assert server.estimate_tokens("KL 美食") == 3
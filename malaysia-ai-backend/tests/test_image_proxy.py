@@ -0,0 +1,69 @@
+"""Opt-in /img/{key} proxy cache for retrieved images"""
+
+import pytest
+
+from conftest import jpeg_bytes
+
+SOURCE_URL = "https://images.example.com/kek-lok-si.jpg"
+
+@pytest.fixture
+def proxy(server, tmp_path, monkeypatch):
+    """Proxy enabled with empty caches; the fetch log lists every download of a source URL"""
+    monkeypatch.setattr(server, "IMAGE_PROXY_ENABLED", True)
+    monkeypatch.setattr(server, "thumbnail_files", server.ThumbnailDirectory(str(tmp_path / "thumbnails"), 10 * 1024 * 1024))
+    cache = server.ImageProxyCache(str(tmp_path / "proxy"), 10 * 1024 * 1024, 1024 * 1024)
+    monkeypatch.setattr(server, "image_proxy_cache", cache)
+    cache.fetched = []
+    def fetch(url):
+        cache.fetched.append(url)
+        return jpeg_bytes(color="purple")
+    monkeypatch.setattr(server, "fetch_remote_image", fetch)
+    return cache
+
+def test_retrieved_image_is_proxied_and_fetched_once(server, client, proxy):
+    url = server.remote_image_urls(SOURCE_URL)["proxy_url"]
+
+    responses = [client.get(url) for _ in range(3)]
+
+    assert all(r.status_code == 200 for r in responses)
+    assert responses[0].headers["Content-Type"] == "image/jpeg"
+    assert responses[0].content == jpeg_bytes(color="purple")
+    assert proxy.fetched == [SOURCE_URL]
+
+def test_matching_etag_revalidates_with_304(server, client, proxy):
+    url = server.remote_image_urls(SOURCE_URL)["proxy_url"]
+    etag = client.get(url).headers["ETag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    unknown = "0" * 32
+    assert client.get(f"/img/{unknown}", headers={"If-None-Match": f'"{unknown}"'}).status_code == 404
+
+def test_proxy_is_off_by_default(server, client, monkeypatch):
+    monkeypatch.setattr(server, "IMAGE_PROXY_ENABLED", False)
+    key = server.register_remote_image(SOURCE_URL)
+
+    assert "proxy_url" not in server.remote_image_urls(SOURCE_URL)
+    assert client.get(f"/img/{key}").status_code == 404
+
+def test_disk_tier_evicts_least_recently_used(server, tmp_path):
+    cache = server.ImageProxyCache(str(tmp_path), 250, 0)  # No memory tier, so every hit reads the disk
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert cache.get("a") is not None  # Now b is the least recently used
+
+    cache.put("c", b"c" * 100)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.img", "c.img"]
+    assert cache.get("b") is None
+
+def test_memory_tier_keeps_only_the_hottest_images(server, tmp_path):
+    cache = server.ImageProxyCache(str(tmp_path), 10_000, 250)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.encode() * 100)
+
+    assert cache.get_from_memory("a") is None
+    assert cache.get_from_memory("c") == b"c" * 100
+    # Still on disk, and read back into memory on the next use
+    assert cache.get("a") == b"a" * 100
+    assert cache.get_from_memory("a") == b"a" * 100
@@ -0,0 +1,71 @@
+"""Request IDs on log records, per-path sampling and the log formatters"""
+
+import json
+import logging
+
+import pytest
+
+class RecordList(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+@pytest.fixture
+def records(server):
+    """Records as they would be written: through a RequestLogFilter like the real handler"""
+    handler = RecordList()
+    log_filter = server.RequestLogFilter()
+    handler.addFilter(log_filter)
+    handler.sampled_out = lambda: log_filter.sampled_out
+    logging.getLogger().addHandler(handler)
+    yield handler
+    logging.getLogger().removeHandler(handler)
+
+def test_request_id_is_echoed_and_tags_every_record(server, client, records):
+    response = client.post("/chat", json={"message": "Cendol in Melaka"}, headers={"X-Request-ID": "trip-42"})
+
+    assert response.headers["X-Request-ID"] == "trip-42"
+    tagged = [r for r in records.records if getattr(r, "request_id", None) == "trip-42"]
+    assert {r.request_path for r in tagged} == {"/chat"}
+    # Including the usage line logged by the generation task
+    assert any(r.getMessage() == "💰 Usage" for r in tagged)
+
+def test_unusable_request_ids_are_replaced(server, client):
+    response = client.get("/health", headers={"X-Request-ID": "not valid; " + "x" * 80})
+    request_id = response.headers["X-Request-ID"]
+    assert len(request_id) == 16 and int(request_id, 16) >= 0
+
+def test_unsampled_requests_keep_only_warnings(server, client, records, monkeypatch):
+    monkeypatch.setattr(server, "LOG_SAMPLE_RATES", {"/chat": 0.0})
+
+    client.post("/chat", json={"message": "Cendol in Melaka"}, headers={"X-Request-Timeout-Ms": "soon"})
+
+    chat_records = [r for r in records.records if getattr(r, "request_path", None) == "/chat"]
+    assert chat_records
+    assert all(r.levelno >= logging.WARNING for r in chat_records)
+    assert any("Ignoring invalid X-Request-Timeout-Ms" in r.getMessage() for r in chat_records)
+    assert records.sampled_out() > 0
+
+    # Other paths fall back to the default rate and keep everything
+    client.post("/chat-stream", json={"message": "Cendol in Melaka"})
+    assert any(r.levelno == logging.INFO and getattr(r, "request_path", None) == "/chat-stream" for r in records.records)
+
+def make_record(**attributes) -> logging.LogRecord:
+    record = logging.LogRecord("api_server_genai", logging.INFO, __file__, 1, "💰 %s", ("Usage",), None)
+    record.__dict__.update(attributes)
+    return record
+
+def test_json_lines_merge_structured_fields(server):
+    line = server.JsonLogFormatter().format(make_record(request_id="trip-42", request_path="/chat",
+                                                        fields={"route": "chat", "output_tokens": 12}))
+    entry = json.loads(line)
+    assert entry["message"] == "💰 Usage"
+    assert (entry["request_id"], entry["path"]) == ("trip-42", "/chat")
+    assert (entry["route"], entry["output_tokens"]) == ("chat", 12)
+
+def test_text_lines_keep_the_basic_layout(server):
+    line = server.TextLogFormatter().format(make_record(request_id="trip-42", fields={"route": "chat"}))
+    assert line == 'INFO:api_server_genai:💰 Usage {"route": "chat"} [trip-42]'
@@ -0,0 +1,71 @@
+"""Prometheus exposition on /metrics"""
+
+import re
+
+# name{labels} value, as in the text exposition format
+SAMPLE_PATTERN = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*"(,[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*")*\})? \S+$')
+
+def sample(text: str, name: str, **labels) -> float:
+    """Value of the sample with exactly these labels, or 0 if it isn't there yet"""
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    line = f"{name}{{{label_text}}} " if labels else f"{name} "
+    for candidate in text.splitlines():
+        if candidate.startswith(line):
+            return float(candidate[len(line):])
+    return 0.0
+
+def test_histogram_buckets_are_cumulative(server):
+    registry = server.MetricsRegistry()
+    latency = registry.histogram("test_latency_seconds", "Test latency", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        latency.observe(value, route="/chat")
+
+    lines = registry.render().splitlines()
+
+    assert lines[:2] == ["# HELP aiman_test_latency_seconds Test latency", "# TYPE aiman_test_latency_seconds histogram"]
+    assert lines[2:] == [
+        'aiman_test_latency_seconds_bucket{route="/chat",le="0.1"} 1',
+        'aiman_test_latency_seconds_bucket{route="/chat",le="1"} 3',
+        'aiman_test_latency_seconds_bucket{route="/chat",le="+Inf"} 4',
+        'aiman_test_latency_seconds_sum{route="/chat"} 4.25',
+        'aiman_test_latency_seconds_count{route="/chat"} 4',
+    ]
+
+def test_label_values_are_escaped_and_failing_callbacks_are_skipped(server):
+    registry = server.MetricsRegistry()
+    registry.counter("test_total", "Test counter", ("name",)).inc(2, name='say "hi"\nthere')
+
+    @registry.callback("test_broken", "Raises at scrape time")
+    def broken():
+        raise RuntimeError("boom")
+
+    text = registry.render()
+    assert 'aiman_test_total{name="say \\"hi\\" there"} 2' in text
+    assert "# TYPE aiman_test_broken gauge" in text
+
+def test_metrics_endpoint_counts_requests_by_route_template(server, client):
+    before = client.get("/metrics").text
+    client.post("/chat", json={"message": "Kuih lapis in Sarawak"})
+    client.get("/thumbnails/not-a-key")
+
+    response = client.get("/metrics")
+    text = response.text
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+
+    name = "aiman_http_request_duration_seconds_count"
+    chat = dict(method="POST", route="/chat", status="200")
+    assert sample(text, name, **chat) == sample(before, name, **chat) + 1
+    # Path parameters are labelled by template, so cardinality stays bounded
+    assert sample(text, name, method="GET", route="/thumbnails/{key}", status="404") >= 1
+    assert sample(text, "aiman_model_tokens_total", route="chat", type="output") > 0
+    assert "# TYPE aiman_model_slots_in_use gauge" in text
+
+    for line in text.splitlines():
+        assert line.startswith("# ") or SAMPLE_PATTERN.match(line), line
+
+def test_disabled_metrics_record_nothing(server, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_ENABLED", False)
+    registry = server.MetricsRegistry()
+    registry.counter("test_total", "Test counter").inc()
+
+    assert registry.render() == "# HELP aiman_test_total Test counter\n# TYPE aiman_test_total counter\n"
@@ -0,0 +1,57 @@
+"""Output token budgets and stop sequences by phase and intent"""
+
+import pytest
+
+import local_model
+
+@pytest.fixture
+def sent_configs(monkeypatch):
+    """Generation configs of every streamed call the local model receives"""
+    configs = []
+    original = local_model.LocalModels.generate_content_stream
+    def record(self, *, model, contents, config=None):
+        configs.append(config)
+        return original(self, model=model, contents=contents, config=config)
+    monkeypatch.setattr(local_model.LocalModels, "generate_content_stream", record)
+    return configs
+
+@pytest.fixture
+def lengths(server, monkeypatch):
+    stats = server.OutputLengthStats(server.OUTPUT_LENGTH_WINDOW)
+    monkeypatch.setattr(server, "output_lengths", stats)
+    return stats
+
+def test_budget_comes_from_request_then_intent_then_phase(server):
+    greeting, ideation = server.ConversationPhase.GREETING, server.ConversationPhase.IDEATION
+
+    assert server.resolve_output_budget(ideation, "Plan a 3-day trip", 500).source == "request"
+    assert server.resolve_output_budget(ideation, "Plan a 3-day trip", 500).max_output_tokens == 500
+    assert server.resolve_output_budget(greeting, "Day-by-day plan for Sabah", None) == server.OutputBudget(
+        server.ITINERARY_OUTPUT_TOKENS, server.CHAT_STOP_SEQUENCES, "intent")
+    assert server.resolve_output_budget(greeting, "Hi Aiman!", None).max_output_tokens == server.PHASE_OUTPUT_TOKENS[greeting]
+    assert server.resolve_output_budget(ideation, "More food ideas", None).max_output_tokens == server.PHASE_OUTPUT_TOKENS[ideation]
+
+def test_adaptive_budgets_can_be_switched_off(server, monkeypatch):
+    monkeypatch.setattr(server, "ADAPTIVE_OUTPUT_BUDGETS_ENABLED", False)
+    budget = server.resolve_output_budget(server.ConversationPhase.GREETING, "Hi Aiman!", None)
+    assert (budget.max_output_tokens, budget.source) == (server.DEFAULT_MAX_OUTPUT_TOKENS, "default")
+
+@pytest.mark.parametrize("path", ["/chat", "/chat-stream"])
+def test_model_receives_the_budget_and_stop_sequences(server, client, sent_configs, path):
+    client.post(path, json={"message": "Hi Aiman!"})
+    client.post(path, json={"message": "Give me a 5 day itinerary for Sabah", "max_tokens": 300})
+
+    assert [config.max_output_tokens for config in sent_configs] == [
+        server.PHASE_OUTPUT_TOKENS[server.ConversationPhase.GREETING], 300]
+    assert all(config.stop_sequences == list(server.CHAT_STOP_SEQUENCES) for config in sent_configs)
+
+def test_truncated_replies_are_counted_for_phase_budgets_only(server, client, lengths, monkeypatch):
+    greeting = server.ConversationPhase.GREETING
+    monkeypatch.setitem(server.PHASE_OUTPUT_TOKENS, greeting, 10)
+
+    client.post("/chat", json={"message": "Hi Aiman!"})
+    client.post("/chat", json={"message": "Hi Aiman!", "max_tokens": 10})
+
+    stats = lengths.stats()[greeting.value]
+    assert (stats["replies"], stats["truncated"]) == (1, 1)
+    assert client.get("/health").json()["output_budgets"][greeting.value]["budget"] == 10
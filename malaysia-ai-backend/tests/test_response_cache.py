@@ -0,0 +1,62 @@
+"""Exact-match response cache for first-turn prompts"""
+
+import pytest
+
+@pytest.fixture
+def cache(server, monkeypatch):
+    """Response cache enabled, keeping two answers per prompt"""
+    monkeypatch.setattr(server, "RESPONSE_CACHE_ENABLED", True)
+    cache = server.ResponseCache(100, 3600, 2)
+    monkeypatch.setattr(server, "response_cache", cache)
+    return cache
+
+def test_hits_start_once_enough_variants_are_collected(server, cache):
+    cache.put("key", {"response": "first"})
+    assert cache.get("key") is None
+
+    cache.put("key", {"response": "second"})
+    cache.put("key", {"response": "third"})  # Beyond the variant limit: not kept
+    answers = {cache.get("key")["response"] for _ in range(50)}
+
+    assert answers == {"first", "second"}
+
+def test_expired_entries_are_dropped(server, cache, monkeypatch):
+    for answer in ("first", "second"):
+        cache.put("key", {"response": answer})
+    assert cache.get("key") is not None
+
+    now = server.time.time()
+    monkeypatch.setattr(server.time, "time", lambda: now + 3601)
+    assert cache.get("key") is None
+    assert cache.stats()["entries"] == 0
+
+def test_least_recently_used_key_is_evicted(server):
+    cache = server.ResponseCache(2, 3600, 1)
+    cache.put("a", {"response": "a"})
+    cache.put("b", {"response": "b"})
+    assert cache.get("a") is not None
+
+    cache.put("c", {"response": "c"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+def test_trivial_rewording_shares_a_key_but_settings_do_not(server):
+    phase = server.ConversationPhase.GREETING
+    key = server.response_cache_key("Best laksa in Penang?", phase, 0.7, "model-a")
+
+    assert server.response_cache_key("  best   LAKSA in penang ", phase, 0.71, "model-a") == key
+    assert server.response_cache_key("Best laksa in Penang?", phase, 1.0, "model-a") != key
+    assert server.response_cache_key("Best laksa in Penang?", phase, 0.7, "model-b") != key
+    assert server.response_cache_key("Best laksa in Penang?", server.ConversationPhase.IDEATION, 0.7, "model-a") != key
+
+def test_chat_serves_first_turns_from_the_cache(server, client, cache):
+    request = {"message": "Best laksa in Penang?"}
+    assert [client.post("/chat", json=request).headers["X-Cache"] for _ in range(3)] == ["MISS", "MISS", "HIT"]
+
+def test_follow_up_turns_are_never_cached(server, client, cache):
+    request = {"message": "Best laksa in Penang?", "conversation_history": [
+        {"role": "user", "content": "We land on Friday"}, {"role": "assistant", "content": "Great!"}]}
+    for _ in range(3):
+        assert "X-Cache" not in client.post("/chat", json=request).headers
+    assert cache.stats()["entries"] == 0
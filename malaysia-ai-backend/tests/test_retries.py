@@ -0,0 +1,136 @@
+"""Retries, the retry budget and hedging in open_model_stream, driven by LOCAL_MODEL_FAULTS"""
+
+import time
+
+import httpx
+import pytest
+from google.genai import errors, types
+
+import local_model
+from conftest import wait_until
+
+@pytest.fixture
+def policy(server, monkeypatch):
+    """A fresh retry policy, so budget and time-to-first-token samples don't leak between tests"""
+    policy = server.ModelRetryPolicy()
+    monkeypatch.setattr(server, "retry_policy", policy)
+    return policy
+
+@pytest.fixture
+def pool(server, client):
+    """Two endpoints; ties go to the first, so "111" takes the first attempt"""
+    server.endpoint_pool.configure(["111", "222"])
+    return server.endpoint_pool
+
+def start_stream(client, model):
+    contents = [types.Content(role="user", parts=[types.Part(text="Street food in Georgetown")])]
+    return client.models.generate_content_stream(model=model, contents=contents)
+
+def open_stream(server, client, give_up_at=None):
+    return client.portal.call(lambda: server.open_model_stream(start_stream, give_up_at=give_up_at))
+
+def requests_per_endpoint(pool) -> dict:
+    return {t.name.rsplit("/", 1)[-1]: t.requests for t in pool.targets}
+
+def test_only_transient_errors_are_retryable(server):
+    assert server.is_transient_model_error(errors.ServerError(503, {"error": {"code": 503, "message": "Overloaded"}}))
+    assert server.is_transient_model_error(errors.ClientError(429, {"error": {"code": 429, "message": "Quota"}}))
+    assert server.is_transient_model_error(httpx.ConnectTimeout("timed out"))
+    assert not server.is_transient_model_error(errors.ClientError(400, {"error": {"code": 400, "message": "Bad request"}}))
+    assert not server.is_transient_model_error(ValueError("bad prompt"))
+
+def test_transient_failure_is_retried_on_the_other_endpoint(server, client, pool, policy, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "111", {"error_rate": 1.0, "error_code": 503})
+
+    iterator, chunk = open_stream(server, client)
+    iterator.close()
+
+    assert chunk.text
+    assert iterator.target is pool.targets[1]
+    assert policy.retries == 1
+
+def test_bad_request_is_not_retried(server, client, pool, policy, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "111", {"error_rate": 1.0, "error_code": 400})
+
+    with pytest.raises(errors.ClientError):
+        open_stream(server, client)
+    assert policy.retries == 0
+    assert requests_per_endpoint(pool) == {"111": 1, "222": 0}
+
+def test_backoff_never_sleeps_past_the_deadline(server, client, pool, policy, monkeypatch):
+    for endpoint_id in ("111", "222"):
+        monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, endpoint_id, {"error_rate": 1.0, "error_code": 503})
+    monkeypatch.setattr(policy, "backoff", lambda attempt: 0.5)
+
+    started = time.monotonic()
+    with pytest.raises(errors.ServerError):
+        open_stream(server, client, give_up_at=started + 0.3)
+    assert time.monotonic() - started < 0.3
+    assert policy.retries == 0
+
+    # Without a deadline the same failure is retried up to MODEL_MAX_RETRIES times
+    monkeypatch.setattr(policy, "backoff", lambda attempt: 0.01)
+    with pytest.raises(errors.ServerError):
+        open_stream(server, client)
+    assert policy.retries == server.MODEL_MAX_RETRIES
+
+def test_retries_stop_when_the_budget_is_drained(server, client, pool, monkeypatch):
+    monkeypatch.setattr(server, "MODEL_RETRY_BUDGET_RESERVE", server.MODEL_MAX_RETRIES)
+    policy = server.ModelRetryPolicy()
+    monkeypatch.setattr(server, "retry_policy", policy)
+    for endpoint_id in ("111", "222"):
+        monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, endpoint_id, {"error_rate": 1.0, "error_code": 503})
+
+    with pytest.raises(errors.ServerError):
+        open_stream(server, client)
+    assert policy.retries == server.MODEL_MAX_RETRIES
+
+    # One first attempt only deposits a fraction of a retry
+    with pytest.raises(errors.ServerError):
+        open_stream(server, client)
+    assert policy.retries == server.MODEL_MAX_RETRIES
+    assert policy.budget_exhausted == 1
+
+@pytest.fixture
+def hedging(server, policy, monkeypatch):
+    """Hedge after 50ms without a first token; the p95 of the recorded samples is below that"""
+    monkeypatch.setattr(server, "HEDGING_ENABLED", True)
+    monkeypatch.setattr(server, "HEDGE_MIN_DELAY_SECONDS", 0.05)
+    for _ in range(server.HEDGE_MIN_SAMPLES):
+        policy.record_ttft(0.01)
+    return policy
+
+def test_hedge_wins_against_a_slow_endpoint_and_the_primary_is_closed(server, client, pool, hedging, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "111", {"delay_ms": 400})
+
+    iterator, chunk = open_stream(server, client)
+    iterator.close()
+
+    assert chunk.text
+    assert iterator.target is pool.targets[1]
+    assert (hedging.hedges, hedging.hedge_wins) == (1, 1)
+    # The losing stream is closed once its blocked first read returns
+    assert wait_until(lambda: all(t.outstanding == 0 for t in pool.targets))
+
+def test_hedge_loses_to_the_primary_and_is_closed(server, client, pool, hedging, monkeypatch):
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "111", {"delay_ms": 150})
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "222", {"delay_ms": 600})
+
+    iterator, chunk = open_stream(server, client)
+    iterator.close()
+
+    assert iterator.target is pool.targets[0]
+    assert (hedging.hedges, hedging.hedge_wins) == (1, 0)
+    assert pool.targets[1].outstanding == 1
+    assert wait_until(lambda: pool.targets[1].outstanding == 0)
+
+def test_exhausted_retries_answer_503_with_retry_after(server, client, policy, monkeypatch):
+    # Fewer failures than it takes to open the circuit, so the request isn't answered degraded
+    monkeypatch.setattr(server, "MODEL_MAX_RETRIES", server.ENDPOINT_EJECT_AFTER_FAILURES - 2)
+    monkeypatch.setitem(local_model.LOCAL_MODEL_FAULTS, "111", {"error_rate": 1.0, "error_code": 503})
+
+    response = client.post("/chat", json={"message": "Cendol in Melaka"})
+
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) > 0
+    assert server.endpoint_pool.stats()[0]["circuit"] == "closed"
@@ -0,0 +1,53 @@
+"""Semantic response cache for near-duplicate first-turn prompts"""
+
+import pytest
+
+# Pairs that embed close together but need different answers
+OPPOSITE_PAIRS = [
+    ("best halal food in kuala lumpur", "best non-halal food in kuala lumpur"),
+    ("vegetarian restaurants near petronas towers", "non vegetarian restaurants near petronas towers"),
+    ("3 day family itinerary for penang with kids", "5 day family itinerary for penang with kids"),
+    ("visiting langkawi in december", "visiting langkawi in june"),
+]
+
+@pytest.fixture
+def semantic_cache(server, monkeypatch):
+    monkeypatch.setattr(server, "SEMANTIC_CACHE_ENABLED", True)
+    cache = server.SemanticResponseCache(100, 3600, server.SEMANTIC_CACHE_THRESHOLD)
+    monkeypatch.setattr(server, "semantic_cache", cache)
+    return cache
+
+def scope(server, message: str) -> str:
+    phase = server.determine_conversation_phase([], message)
+    return server.semantic_cache_scope(phase, 0.7, server.model_endpoint, message)
+
+@pytest.mark.parametrize("cached, asked", OPPOSITE_PAIRS)
+def test_opposite_requirements_never_share_an_answer(server, semantic_cache, cached, asked):
+    semantic_cache.put(scope(server, cached), server.embed_prompt(cached), {"response": cached})
+
+    assert semantic_cache.get(scope(server, asked), server.embed_prompt(asked)) is None
+    assert semantic_cache.get(scope(server, cached), server.embed_prompt(cached)) is not None
+
+def test_prompt_specifics_normalise_wording(server):
+    assert server.prompt_specifics("Plan three days in Ipoh") == server.prompt_specifics("plan a 3-day trip to ipoh")
+    assert server.prompt_specifics("gluten-free cafes") == server.prompt_specifics("cafes without gluten")
+    assert server.prompt_specifics("Penang in Sept") == server.prompt_specifics("Penang in September")
+    assert server.prompt_specifics("Best laksa in Penang") == ""
+
+def test_reworded_prompt_is_served_from_the_semantic_cache(server, client, semantic_cache):
+    first = client.post("/chat", json={"message": "Where to find halal dim sum in Kuala Lumpur?"})
+    assert first.status_code == 200
+
+    reworded = client.post("/chat", json={"message": "halal dim sum in KL"})
+    assert reworded.headers.get("X-Cache") == "SEMANTIC-HIT"
+    assert reworded.json()["response"] == first.json()["response"]
+
+    negated = client.post("/chat", json={"message": "non-halal dim sum in KL"})
+    assert negated.headers.get("X-Cache") != "SEMANTIC-HIT"
+
+def test_follow_up_turns_skip_the_semantic_cache(server, client, semantic_cache):
+    client.post("/chat", json={"message": "Durian stalls in Penang"})
+
+    response = client.post("/chat", json={"message": "Durian stalls in Penang", "conversation_history": [
+        {"role": "user", "content": "We love fruit"}, {"role": "assistant", "content": "Great!"}]})
+    assert response.headers.get("X-Cache") != "SEMANTIC-HIT"
@@ -0,0 +1,61 @@
+"""Shadow traffic mirrored to a candidate endpoint after /chat responds"""
+
+import json
+
+import pytest
+from google.genai import types
+
+from conftest import wait_until
+from test_admission import fill_model_queue
+
+@pytest.fixture
+def shadow(server, client, monkeypatch):
+    """Mirror every /chat generation to local endpoint "222"; the client fixture has already run startup"""
+    shadow = server.ShadowTraffic(1.0, 1, "")
+    shadow.configure("222")
+    monkeypatch.setattr(server, "shadow_traffic", shadow)
+    yield shadow
+    shadow.shutdown()
+
+def mirror(server, client, shadow):
+    record = {"timestamp": 0, "phase": "greeting", "message": "Hi",
+              "primary": {"latency_ms": 10, "output_tokens": 1, "response": "Hello"}}
+    contents = [types.Content(role="user", parts=[types.Part(text="Hi")])]
+    client.portal.call(shadow.submit, record, contents, types.GenerateContentConfig())
+
+def test_sampled_chat_is_compared_against_the_candidate(server, client, shadow):
+    response = client.post("/chat", json={"message": "Teh tarik in Kuala Lumpur"})
+    assert response.status_code == 200
+
+    assert wait_until(lambda: shadow.recent())
+    comparison = shadow.recent()[0]
+    assert comparison["error"] is None
+    assert comparison["shadow_ms"] is not None
+    assert shadow.stats()["mirrored"] == 1
+
+def test_shadow_calls_are_dropped_while_the_model_queue_is_busy(server, client, shadow, monkeypatch):
+    fill_model_queue(server, monkeypatch)
+
+    mirror(server, client, shadow)
+
+    assert (shadow.mirrored, shadow.dropped) == (0, 1)
+
+def test_shadow_calls_beyond_the_concurrency_limit_are_dropped(server, client, shadow):
+    assert shadow._slots.acquire(blocking=False)  # The only slot is taken by a running mirror
+
+    mirror(server, client, shadow)
+
+    assert (shadow.mirrored, shadow.dropped) == (0, 1)
+    shadow._slots.release()
+
+def test_records_are_only_written_to_an_explicit_store_path(server, client, shadow, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    mirror(server, client, shadow)
+    assert wait_until(lambda: shadow.recent())
+    assert list(tmp_path.iterdir()) == []
+
+    store = tmp_path / "shadow.jsonl"
+    shadow.store_path = str(store)
+    mirror(server, client, shadow)
+    assert wait_until(lambda: store.exists())
+    assert json.loads(store.read_text(encoding="utf-8"))["message"] == "Hi"
@@ -0,0 +1,72 @@
+"""Rolling conversation summaries that replace older turns"""
+
+import uuid
+
+from conftest import wait_until
+
+def conversation(turns: int, pinned_at: int = None) -> list:
+    history = []
+    for i in range(turns):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = f"Turn {i}: what about Penang day {i}?" if role == "user" else f"Turn {i}: Penang day {i} plan"
+        if i == pinned_at:
+            content = "[Image uploaded: char_koay_teow.jpg] What is this dish?"
+        history.append({"role": role, "content": content})
+    return history
+
+def texts(contents) -> list:
+    return [part.text for content in contents for part in content.parts]
+
+def test_update_stores_a_summary_once_enough_turns_pile_up(server, client):
+    session_id = uuid.uuid4().hex
+    history = conversation(server.SUMMARY_KEEP_RECENT_MESSAGES + server.SUMMARY_BATCH_MESSAGES)
+
+    server.session_summaries.update(session_id, history[:-1])
+    assert server.session_summaries.lookup(session_id, history) is None
+
+    server.session_summaries.update(session_id, history)
+    summary = server.session_summaries.lookup(session_id, history)
+    assert summary is not None
+    assert summary.covered == server.SUMMARY_BATCH_MESSAGES
+    assert summary.text
+
+def test_chat_schedules_the_summary_in_the_background(server, client):
+    session_id = uuid.uuid4().hex
+    history = conversation(20)
+
+    response = client.post("/chat", json={"message": "And day 11?", "conversation_history": history,
+                                          "user_session_id": session_id})
+
+    assert response.status_code == 200
+    assert wait_until(lambda: server.session_summaries.lookup(session_id, history) is not None)
+
+def test_summary_leads_the_history_and_pinned_turns_survive(server, client):
+    session_id = uuid.uuid4().hex
+    history = conversation(20, pinned_at=2)
+    server.session_summaries.update(session_id, history)
+    summary = server.session_summaries.lookup(session_id, history)
+
+    contents = server.build_history_contents(history, session_id)
+
+    assert contents[0].role == "user"
+    assert contents[0].parts[0].text.startswith("[Summary of our earlier conversation]")
+    sent = texts(contents)
+    assert history[2]["content"] in sent
+    # Summarized turns are not sent again; the recent ones are sent verbatim
+    assert history[3]["content"] not in sent
+    assert all(msg["content"] in sent for msg in history[summary.covered:])
+    roles = [content.role for content in contents]
+    assert all(a != b for a, b in zip(roles, roles[1:]))
+
+def test_edited_history_falls_back_to_the_full_conversation(server, client):
+    session_id = uuid.uuid4().hex
+    history = conversation(20)
+    server.session_summaries.update(session_id, history)
+
+    edited = [dict(msg) for msg in history]
+    edited[1]["content"] = "Turn 1: actually, let's go to Langkawi instead"
+
+    assert server.session_summaries.lookup(session_id, edited) is None
+    contents = server.build_history_contents(edited, session_id)
+    assert not any(text.startswith("[Summary") for text in texts(contents))
+    assert texts(contents) == [msg["content"] for msg in edited]
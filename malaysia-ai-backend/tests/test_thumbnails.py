@@ -0,0 +1,73 @@
+"""Cached thumbnails for uploaded and retrieved images"""
+
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes
+
+@pytest.fixture
+def thumbnails(server, tmp_path, monkeypatch):
+    directory = server.ThumbnailDirectory(str(tmp_path), 10 * 1024 * 1024)
+    monkeypatch.setattr(server, "thumbnail_files", directory)
+    return directory
+
+@pytest.fixture
+def remote_images(server, monkeypatch):
+    """Retrieved image URLs served from memory instead of the network; returns the fetch log"""
+    fetched = []
+    def fetch(url):
+        fetched.append(url)
+        return jpeg_bytes((1600, 1200), "green")
+    monkeypatch.setattr(server, "fetch_remote_image", fetch)
+    return fetched
+
+def test_uploaded_image_thumbnail_is_small_and_immutable(server, client, thumbnails):
+    url = server.store_thumbnail(jpeg_bytes((2000, 1500)))
+
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == server.THUMBNAIL_MIME_TYPE
+    assert "immutable" in response.headers["Cache-Control"]
+    assert max(Image.open(io.BytesIO(response.content)).size) == server.THUMBNAIL_MAX_SIZE
+
+def test_matching_etag_revalidates_with_304(server, client, thumbnails):
+    url = server.store_thumbnail(jpeg_bytes())
+    etag = client.get(url).headers["ETag"]
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # An unknown key never revalidates, even with its own ETag
+    unknown = "0" * 32
+    assert client.get(f"/thumbnails/{unknown}", headers={"If-None-Match": f'"{unknown}"'}).status_code == 404
+
+def test_retrieved_image_is_fetched_once(server, client, thumbnails, remote_images):
+    url = server.remote_image_urls("https://images.example.com/petronas.jpg")["thumbnail_url"]
+
+    for _ in range(3):
+        assert client.get(url).status_code == 200
+    assert remote_images == ["https://images.example.com/petronas.jpg"]
+
+def test_directory_evicts_least_recently_used(server, tmp_path):
+    directory = server.ThumbnailDirectory(str(tmp_path), 250)
+    directory.write("a.thumb", b"a" * 100)
+    directory.write("b.thumb", b"b" * 100)
+    assert directory.contains("a.thumb")  # Now b is the least recently used
+
+    directory.write("c.thumb", b"c" * 100)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.thumb", "c.thumb"]
+    assert directory.stats()["evictions"] == 1
+    assert directory.read("b.thumb") is None
+
+def test_evicted_thumbnail_no_longer_revalidates(server, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "thumbnail_files", server.ThumbnailDirectory(str(tmp_path), 1))
+    first = server.store_thumbnail(jpeg_bytes(color="red"))
+    server.store_thumbnail(jpeg_bytes(color="blue"))
+
+    key = first.rsplit("/", 1)[-1]
+    assert client.get(first, headers={"If-None-Match": f'"{key}"'}).status_code == 404
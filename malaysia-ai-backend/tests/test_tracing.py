@@ -0,0 +1,54 @@
+"""Request traces and W3C traceparent propagation"""
+
+import pytest
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+CLIENT_SPAN_ID = "00f067aa0ba902b7"
+
+@pytest.fixture
+def traces(server, monkeypatch):
+    exporter = server.TraceExporter(100, "")
+    monkeypatch.setattr(server, "trace_exporter", exporter)
+    return exporter
+
+def traceparent(flags: str = "01") -> dict:
+    return {"traceparent": f"00-{TRACE_ID}-{CLIENT_SPAN_ID}-{flags}"}
+
+def test_client_trace_is_continued(server, client, traces):
+    response = client.post("/chat", json={"message": "Rendang in Negeri Sembilan"}, headers=traceparent())
+    assert response.headers["X-Trace-ID"] == TRACE_ID
+
+    [trace] = client.get(f"/debug/traces/{TRACE_ID}").json()["requests"]
+    assert trace["parent_id"] == CLIENT_SPAN_ID
+    assert trace["name"] == "POST /chat"
+    assert trace["attributes"]["status"] == 200
+
+    # Stages run in the generation task and worker threads still land under this request's root
+    names = {span["name"] for span in trace["spans"]}
+    assert {"model.queue", "model.open", "model.stream", "generation.collect", "directives"} <= names
+    span_ids = {trace["span_id"]} | {span["span_id"] for span in trace["spans"]}
+    assert all(span["parent_id"] in span_ids for span in trace["spans"])
+
+def test_backend_samples_unless_the_client_flags_the_trace(server, client, traces, monkeypatch):
+    monkeypatch.setattr(server, "TRACE_SAMPLE_RATE", 0.0)
+
+    unflagged = client.post("/chat", json={"message": "Hi Aiman!"}, headers=traceparent("00"))
+    assert "X-Trace-ID" not in unflagged.headers
+
+    flagged = client.post("/chat", json={"message": "Hi Aiman!"}, headers=traceparent("01"))
+    assert flagged.headers["X-Trace-ID"] == TRACE_ID
+    assert traces.finished == 1
+
+def test_malformed_traceparent_starts_a_new_trace(server, client, traces):
+    response = client.post("/chat", json={"message": "Hi Aiman!"}, headers={"traceparent": f"00-{TRACE_ID}-bad-01"})
+
+    trace_id = response.headers["X-Trace-ID"]
+    assert trace_id != TRACE_ID and len(trace_id) == 32
+    [trace] = client.get(f"/debug/traces/{trace_id}").json()["requests"]
+    assert trace["parent_id"] is None
+
+def test_operational_paths_are_not_traced(server, client, traces):
+    for path in ("/health", "/metrics", "/debug/traces"):
+        assert "X-Trace-ID" not in client.get(path, headers=traceparent()).headers
+    assert traces.finished == 0
+    assert client.get(f"/debug/traces/{TRACE_ID}").status_code == 404
@@ -0,0 +1,93 @@
+"""Upload limits: body size caps, magic-byte sniffing and header dimension checks"""
+
+import base64
+import json
+import struct
+import zlib
+
+from conftest import jpeg_bytes
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+def png_header(width: int, height: int) -> bytes:
+    """A PNG claiming the given size, with only a sliver of (compressed) pixel data after the header"""
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + png_chunk(b"IHDR", ihdr)
+            + png_chunk(b"IDAT", zlib.compress(b"\0" * 4096)) + png_chunk(b"IEND", b""))
+
+def upload(client, data: bytes, content_type: str = "image/jpeg", path: str = "/upload-image"):
+    return client.post(path, files={"file": ("photo.jpg", data, content_type)}, data={"message": "What is this?"})
+
+def test_valid_upload_is_analysed(client):
+    response = upload(client, jpeg_bytes())
+    assert response.status_code == 200
+    assert response.json()["response"]
+
+def test_oversized_body_is_rejected_with_413(server, client):
+    body = b"\xff\xd8\xff" + b"\0" * server.MAX_UPLOAD_REQUEST_BYTES
+    response = upload(client, body)
+    assert response.status_code == 413
+    assert response.json()["detail"] == server._SINGLE_UPLOAD_TOO_LARGE
+
+def test_chunked_body_without_content_length_is_capped(server, client):
+    boundary = "limit-test"
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"a.jpg\"\r\n"
+            "Content-Type: image/jpeg\r\n\r\n").encode()
+
+    def body():
+        yield head + b"\xff\xd8\xff"
+        for _ in range(server.MAX_UPLOAD_REQUEST_BYTES // (1024 * 1024) + 2):
+            yield b"\0" * (1024 * 1024)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = client.post("/upload-image", content=body(),
+                           headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert response.status_code == 413
+
+def test_oversized_image_inside_the_request_cap_is_rejected(server, client):
+    image = jpeg_bytes() + b"\0" * (server.MAX_IMAGE_BYTES + 1024)
+    assert len(image) < server.MAX_UPLOAD_REQUEST_BYTES
+    response = client.post("/chat-with-image", files={"image": ("photo.jpg", image, "image/jpeg")},
+                           data={"message": "What is this?"})
+    assert response.status_code == 413
+    assert "smaller than 10MB" in response.json()["detail"]
+
+def test_non_image_content_is_rejected_with_415_despite_its_content_type(client):
+    response = upload(client, b"%PDF-1.7\n" + b"0" * 4096, content_type="image/jpeg")
+    assert response.status_code == 415
+
+def test_oversized_dimensions_are_rejected_from_the_header(server, client):
+    # 8000x8000 is over MAX_IMAGE_PIXELS but under Pillow's own bomb threshold
+    response = upload(client, png_header(8000, 8000), content_type="image/png")
+    assert response.status_code == 413
+    assert "8000x8000" in response.json()["detail"]
+
+def test_decompression_bomb_is_rejected_from_the_header(client):
+    response = upload(client, png_header(50000, 50000), content_type="image/png")
+    assert response.status_code == 413
+
+def test_webp_dimensions_are_checked_from_the_header(client):
+    # VP8X canvas of 10000x10000, stored minus one as 24-bit little-endian values
+    vp8x = b"VP8X" + struct.pack("<I", 10) + b"\0" * 4 + (9999).to_bytes(3, "little") * 2
+    webp = b"RIFF" + struct.pack("<I", 4 + len(vp8x)) + b"WEBP" + vp8x
+    response = upload(client, webp + b"\0" * 1024, content_type="image/webp")
+    assert response.status_code == 413
+
+def test_multipart_chat_with_image_accepts_form_encoded_history(client):
+    history = [{"role": "user", "content": "We are in Penang"}, {"role": "assistant", "content": "Welcome!"}]
+    response = client.post("/chat-with-image", files={"image": ("dish.jpg", jpeg_bytes(), "image/jpeg")},
+                           data={"message": "What dish is this?", "conversation_history": json.dumps(history),
+                                 "temperature": "0.5"})
+    assert response.status_code == 200
+    assert response.json()["response"]
+
+def test_multipart_chat_with_image_rejects_malformed_history(client):
+    response = client.post("/chat-with-image", files={"image": ("dish.jpg", jpeg_bytes(), "image/jpeg")},
+                           data={"message": "What dish is this?", "conversation_history": "not json"})
+    assert response.status_code == 400
+
+def test_json_chat_with_image_still_accepts_base64(client):
+    response = client.post("/chat-with-image", json={"message": "What dish is this?",
+                                                      "image_data": base64.b64encode(jpeg_bytes()).decode()})
+    assert response.status_code == 200
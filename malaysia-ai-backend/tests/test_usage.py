@@ -0,0 +1,61 @@
+"""Token, latency and cost accounting behind /usage"""
+
+import uuid
+
+import pytest
+
+from conftest import wait_until
+
+@pytest.fixture
+def usage(server, monkeypatch):
+    accounting = server.UsageAccounting(server.USAGE_MAX_SESSIONS)
+    monkeypatch.setattr(server, "usage_accounting", accounting)
+    return accounting
+
+def record(server, route="chat", **fields) -> "server.UsageRecord":
+    values = dict(route=route, phase="greeting", session_id=None, endpoint="111", outcome="ok",
+                  prompt_tokens=1000, cached_tokens=0, output_tokens=200, thoughts_tokens=0,
+                  queue_seconds=0.0, ttft_seconds=0.1, total_seconds=0.5, estimated=False)
+    values.update(fields)
+    return server.UsageRecord(**values)
+
+def test_cost_prices_cached_prompt_and_thinking_tokens(server):
+    call = record(server, prompt_tokens=1_000_000, cached_tokens=400_000, output_tokens=100_000, thoughts_tokens=100_000)
+    assert call.cost_usd == pytest.approx(0.6 * server.USAGE_PRICE_INPUT_PER_MILLION
+                                          + 0.4 * server.USAGE_PRICE_CACHED_INPUT_PER_MILLION
+                                          + 0.2 * server.USAGE_PRICE_OUTPUT_PER_MILLION)
+
+def test_chat_calls_are_totalled_by_route_phase_and_session(server, client, usage):
+    session_id = uuid.uuid4().hex
+    for message in ("Hi Aiman!", "Where to stay in Melaka?"):
+        client.post("/chat", json={"message": message, "user_session_id": session_id})
+    client.post("/chat-stream", json={"message": "Hi Aiman!", "user_session_id": session_id})
+    assert wait_until(lambda: usage.window(300)["totals"]["calls"] == 3)
+
+    summary = client.get("/usage", params={"window": "5m"}).json()
+    assert summary["by_route"]["chat"]["calls"] == 2
+    assert summary["by_route"]["chat-stream"]["calls"] == 1
+    assert summary["by_phase"]["greeting"]["calls"] == 3
+    totals = summary["totals"]
+    assert totals["prompt_tokens"] > 0 and totals["output_tokens"] > 0
+    assert summary["latency_seconds"]["ttft_p50"] is not None
+
+    session = client.get(f"/usage/sessions/{session_id}").json()
+    assert session["calls"] == 3
+    assert session["cost_usd"] == pytest.approx(totals["cost_usd"], abs=1e-6)
+    assert summary["top_sessions"][0]["session"] == session_id[:8]
+
+def test_windows_only_cover_their_own_minutes(server, usage, monkeypatch):
+    now = server.time.time()
+    monkeypatch.setattr(server.time, "time", lambda: now - 600)
+    usage.record(record(server))
+    monkeypatch.setattr(server.time, "time", lambda: now)
+    usage.record(record(server, outcome="error"))
+
+    assert usage.window(300)["totals"]["calls"] == 1
+    assert usage.window(300)["totals"]["errors"] == 1
+    assert usage.window(3600)["totals"]["calls"] == 2
+
+def test_unknown_window_and_session_are_rejected(client, usage):
+    assert client.get("/usage", params={"window": "1d"}).status_code == 400
+    assert client.get(f"/usage/sessions/{uuid.uuid4().hex}").status_code == 404